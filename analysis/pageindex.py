@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+An index of the pages a trace touches, built in one pass over the trace and
+then queried with binary searches and array operations instead of re-reading
+it.
+
+The index holds the sorted unique pages, each with its accesses of each type
+and its lowest and highest block, plus which pages each timestep of
+timestep accesses touches. From those it finds:
+
+  - segments and the heap/stack boundary, as find_segments and
+    find_boundaries in plot.py do
+  - the accesses of each type in a range of addresses
+  - the distinct pages touched in each window of a multiple of timestep
+    accesses
+  - the working set: at the end of each timestep, the distinct pages touched
+    in the last tau accesses, for tau a multiple of timestep
+  - the footprint: the distinct pages touched so far
+
+Indexes are saved as .npz files. Needs NumPy.
+
+Usage: ./pageindex.py build timestep index_file [trace_file | binary_trace]
+       ./pageindex.py build timestep index_file < trace_file
+       ./pageindex.py show index_file [window]
+"""
+import sys
+
+import numpy
+
+from plot import *
+
+SEGMENT_GAP = 2**20
+
+def group_starts(keys):
+    """
+    Index of the first of each run of equal values in a sorted array.
+    """
+    return numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+
+def page_extremes(pages, low_blocks, high_blocks):
+    """
+    Reduce parallel arrays of pages and blocks to one entry per page with
+    its lowest and highest block.
+    """
+    order = numpy.argsort(pages, kind="mergesort")
+    pages = pages[order]
+    starts = group_starts(pages)
+    return (pages[starts], numpy.minimum.reduceat(low_blocks[order], starts),
+            numpy.maximum.reduceat(high_blocks[order], starts))
+
+class PageIndex(object):
+    FIELDS = ("pages", "counts", "low_blocks", "high_blocks", "touch_chunks", "touch_pages")
+
+    def __init__(self, timestep, accesses, pages, counts, low_blocks, high_blocks,
+                 touch_chunks, touch_pages):
+        self.timestep = timestep
+        self.accesses = accesses
+        # Sorted page addresses, and for each its accesses through each
+        # image channel of plot.py and its lowest and highest block
+        self.pages = pages
+        self.counts = counts
+        self.low_blocks = low_blocks
+        self.high_blocks = high_blocks
+        # Timestep and page index of each distinct (timestep, page) touch,
+        # sorted by timestep then page
+        self.touch_chunks = touch_chunks
+        self.touch_pages = touch_pages
+
+    def num_chunks(self):
+        """
+        Number of timesteps, counted as plot.py does.
+        """
+        return self.accesses/self.timestep + 1
+
+    def page_range(self, low, high):
+        """
+        Indices (first, last) of the pages overlapping addresses low up to high.
+        """
+        return (numpy.searchsorted(self.pages, get_page(low)),
+                numpy.searchsorted(self.pages, high))
+
+    def access_counts(self, low=0, high=2**64):
+        """
+        Accesses of each type to addresses low up to high.
+        """
+        first, last = self.page_range(low, high)
+        totals = self.counts[first:last].sum(axis=0)
+        return dict((access_type, int(totals[channel]))
+                    for (access_type, channel) in CHANNELS.items())
+
+    def segments(self, gap=SEGMENT_GAP):
+        """
+        Runs of blocks with no more than gap bytes between neighbours, as
+        (first block, last block, size) like find_segments.
+        """
+        breaks = numpy.flatnonzero(self.low_blocks[1:] - self.high_blocks[:-1] > gap)
+        starts = self.low_blocks[numpy.concatenate(([0], breaks + 1))]
+        ends = self.high_blocks[numpy.concatenate((breaks, [len(self.pages) - 1]))]
+        return [(start, end, end - start) for (start, end) in zip(starts.tolist(), ends.tolist())]
+
+    def boundaries(self):
+        """
+        Split the address space at the widest gap between pages into the
+        heap below and the stack above, as (low, high, size) each like
+        find_boundaries. Gaps within a page are never chosen.
+        """
+        if len(self.pages) < 2:
+            raise ValueError("Need at least two pages to find a boundary")
+        gap = numpy.argmax(self.low_blocks[1:] - self.high_blocks[:-1])
+        heap_low, heap_high = int(self.low_blocks[0]), int(self.high_blocks[gap])
+        stack_low, stack_high = int(self.low_blocks[gap + 1]), int(self.high_blocks[-1])
+        return (heap_low, heap_high, heap_high - heap_low), (stack_low, stack_high, stack_high - stack_low)
+
+    def window_pages(self, window):
+        """
+        Distinct pages touched in each window of window accesses, which must
+        be a multiple of the timestep.
+        """
+        if window % self.timestep:
+            raise ValueError("The window must be a multiple of %d" % self.timestep)
+        windows = self.accesses/window + 1
+        keys = numpy.unique((self.touch_chunks / (window / self.timestep)) * len(self.pages) +
+                            self.touch_pages)
+        return numpy.bincount(keys / len(self.pages), minlength=windows)
+
+    def working_set(self, tau):
+        """
+        Distinct pages touched in the tau accesses up to the end of each
+        timestep, where tau must be a multiple of the timestep.
+        """
+        if tau % self.timestep:
+            raise ValueError("tau must be a multiple of %d" % self.timestep)
+        chunks = self.num_chunks()
+        order = numpy.lexsort((self.touch_chunks, self.touch_pages))
+        touched = self.touch_chunks[order]
+        pages = self.touch_pages[order]
+        # Each touch keeps its page in the working set until tau later or
+        # the page's next touch, whichever is first
+        next_touch = numpy.append(touched[1:], chunks)
+        next_touch[numpy.flatnonzero(pages[1:] != pages[:-1])] = chunks
+        until = numpy.minimum(touched + tau / self.timestep, next_touch)
+        delta = (numpy.bincount(touched, minlength=chunks + 1) -
+                 numpy.bincount(until, minlength=chunks + 1))
+        return numpy.cumsum(delta)[:chunks]
+
+    def footprint(self):
+        """
+        Distinct pages touched by the end of each timestep.
+        """
+        pages, first = numpy.unique(self.touch_pages, return_index=True)
+        return numpy.cumsum(numpy.bincount(self.touch_chunks[first], minlength=self.num_chunks()))
+
+    def save(self, filename):
+        numpy.savez(filename, timestep=self.timestep, accesses=self.accesses,
+                    **dict((field, getattr(self, field)) for field in self.FIELDS))
+
+def load_index(filename):
+    data = numpy.load(filename)
+    return PageIndex(int(data["timestep"]), int(data["accesses"]),
+                     *[data[field] for field in PageIndex.FIELDS])
+
+def build_index(batches, timestep):
+    """
+    Index the (blocks, channels) batches from access_batches or
+    trace_access_batches, in timesteps of timestep accesses.
+    """
+    extremes = []
+    def track_blocks(batches):
+        for blocks, channels in batches:
+            pages = (blocks >> PAGE_BITS) << PAGE_BITS
+            batch_extremes = page_extremes(pages, blocks, blocks)
+            if extremes:
+                batch_extremes = page_extremes(*[numpy.concatenate(pair) for pair
+                                                 in zip(extremes.pop(), batch_extremes)])
+            extremes.append(batch_extremes)
+            yield blocks, channels
+
+    accesses, chunks, pages, channels, counts = sparse_counts(track_blocks(batches), timestep)
+    if not accesses:
+        raise ValueError("No memory accesses found")
+    unique_pages, low_blocks, high_blocks = extremes[0]
+    page_index = numpy.searchsorted(unique_pages, pages)
+    page_counts = numpy.zeros((len(unique_pages), 3), dtype=numpy.int64)
+    numpy.add.at(page_counts, (page_index, channels), counts)
+    touches = numpy.unique(chunks * len(unique_pages) + page_index)
+    return PageIndex(timestep, accesses, unique_pages, page_counts, low_blocks, high_blocks,
+                     touches / len(unique_pages), touches % len(unique_pages))
+
+if __name__ == "__main__":
+    if len(sys.argv) in (4, 5) and sys.argv[1] == "build":
+        if len(sys.argv) == 5:
+            batches = file_access_batches(sys.argv[4])
+        else:
+            batches = access_batches(memory_access_blocks(sys.stdin))
+        build_index(batches, int(sys.argv[2])).save(sys.argv[3])
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == "show":
+        index = load_index(sys.argv[2])
+        print "%d accesses to %d pages" % (index.accesses, len(index.pages))
+        print "Segments"
+        total = 0
+        for seg in index.segments():
+            total += seg[2]
+            print "%09x-%09x (%s)" % (seg[0], seg[1], human_friendly(seg[2]))
+        print "Total memory usage: %s" % human_friendly(total)
+        if len(index.pages) > 1:
+            heap, stack = index.boundaries()
+            print "heap: %08x-%08x (%d)" % heap
+            print "stack:%08x-%08x (%d)" % stack
+        if len(sys.argv) == 4:
+            window = int(sys.argv[3])
+            ends = numpy.minimum(numpy.arange(1, index.accesses/window + 2) * (window / index.timestep),
+                                 index.num_chunks()) - 1
+            print "window,pages,working_set,footprint"
+            for i, (pages, working_set, footprint) in enumerate(zip(
+                    index.window_pages(window), index.working_set(window)[ends],
+                    index.footprint()[ends])):
+                print "%d,%d,%d,%d" % (i, pages, working_set, footprint)
+    else:
+        print "Usage: ./pageindex.py build timestep index_file [trace_file | binary_trace]"
+        print "       ./pageindex.py build timestep index_file < trace_file"
+        print "       ./pageindex.py show index_file [window]"
+        sys.exit(1)
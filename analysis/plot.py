@@ -1,8 +1,19 @@
 #!/usr/bin/env python
+import csv
+import itertools
+import os
 import sys
 import Image
 import math
 from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# tracefile.py lives with the cache simulator
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cachem"))
 access_mapping = {"ir": "INST_READ",
                   "dr": "DATA_READ",
                   "dw": "DATA_WRITE"}
@@ -19,10 +30,36 @@ def get_block(addr):
 def get_page(addr):
     return (addr >> PAGE_BITS) << PAGE_BITS
 
-def memory_access_blocks(it):
+# Access type of the event markers passed through by memory_access_blocks
+EVENT = "EVENT"
+
+def parse_event(line):
+    """
+    Parse a '# N comment' marker line, as inserted into the trace by
+    squid/runWithInsertComment.py, into (N, comment), or None.
+    """
+    fields = line[1:].strip().split(None, 1)
+    try:
+        number = int(fields[0])
+    except (IndexError, ValueError):
+        return None
+    return (number, fields[1] if len(fields) > 1 else "")
+
+def memory_access_blocks(it, events=False):
+    """
+    Parse a text trace into (access_type, block) tuples. Event markers are
+    skipped, or with events passed through as (EVENT, (N, comment)).
+    """
     for i,line in enumerate(it):
         if line.startswith('==') or line.startswith('--'):
             continue
+        if line.startswith('#'):
+            event = parse_event(line)
+            if event is None:
+                sys.stderr.write("Unable to parse event marker on line %d\n" % (i+1))
+            elif events:
+                yield (EVENT, event)
+            continue
         try:
             access_type, addr_str = [x.strip().lower() for x in line.strip().split(":")]
         except ValueError:
@@ -40,6 +77,43 @@ def memory_access_blocks(it):
 
         yield (access_mapping[access_type], get_block(address))
 
+# Map lackey reference types stored in binary trace files onto access types
+trace_mapping = {"I": "INST_READ",
+                 "L": "DATA_READ",
+                 "S": "DATA_WRITE",
+                 "M": "DATA_WRITE"}
+
+def trace_access_blocks(filename):
+    """
+    Like memory_access_blocks, but reads a binary trace file written by
+    cachem/tracefile.py instead of parsing text.
+    """
+    from tracefile import TraceReader, numpy
+    trace = TraceReader(filename)
+    if numpy is None:
+        for (ref_type, addr, length) in trace:
+            yield (trace_mapping[ref_type], get_block(addr))
+    else:
+        for refs in trace.arrays():
+            blocks = (refs["addr"] >> BLOCK_BITS) << BLOCK_BITS
+            for ref_type, block in zip(refs["type"].tolist(), blocks.tolist()):
+                yield (trace_mapping[ref_type], block)
+    trace.close()
+
+def file_access_blocks(filename):
+    """
+    Read the accesses in a binary trace file, or a text trace file in the
+    format memory_access_blocks takes.
+    """
+    from tracefile import is_trace_file
+    if is_trace_file(filename):
+        for access in trace_access_blocks(filename):
+            yield access
+    else:
+        with open(filename) as f:
+            for access in memory_access_blocks(f):
+                yield access
+
 def find_segments(it):
     accessed = set(addr for (access_type, addr) in it)
     x = list(accessed)
@@ -99,6 +173,211 @@ def mark_region_accesses(it):
         regions[(page, access_type)] += 1
     return regions
 
+def chunk_counts(it, chunk_size):
+    """
+    Yield the mark_region_accesses counts of each chunk_size accesses in
+    turn, without holding on to the accesses themselves. Like chunk_process,
+    the last chunk may be short or empty.
+    """
+    it = iter(it)
+    while True:
+        regions = defaultdict(int)
+        count = 0
+        for (access_type, addr) in itertools.islice(it, chunk_size):
+            regions[(get_page(addr), access_type)] += 1
+            count += 1
+        yield regions
+        if count < chunk_size:
+            return
+
+def event_columns(it):
+    """
+    Split the output of memory_access_blocks(it, events=True) at its event
+    markers, yielding the event_stats and mark_region_accesses counts of
+    each event in turn. Accesses before the first marker, if any, make up
+    an event numbered None.
+    """
+    seen_pages = set()
+    event = (None, "")
+    regions = defaultdict(int)
+    blocks = set()
+    for (access_type, addr) in it:
+        if access_type == EVENT:
+            if regions or event[0] is not None:
+                yield event_stats(event, regions, blocks, seen_pages), regions
+            event = addr
+            regions = defaultdict(int)
+            blocks = set()
+            continue
+        regions[(get_page(addr), access_type)] += 1
+        blocks.add(addr)
+    if regions or event[0] is not None:
+        yield event_stats(event, regions, blocks, seen_pages), regions
+
+EVENT_COLUMNS = ("event", "comment", "accesses", "inst_reads", "data_reads", "data_writes",
+                 "pages", "new_pages", "total_pages", "working_set")
+
+def event_stats(event, regions, blocks, seen_pages):
+    """
+    Summarize one event: its accesses of each type, the pages it touches,
+    how many of them no earlier event touched, the pages touched so far
+    (adding this event's to seen_pages), and its working set in bytes of
+    distinct blocks.
+    """
+    number, comment = event
+    counts = defaultdict(int)
+    pages = set()
+    for (page, access_type), count in regions.iteritems():
+        counts[access_type] += count
+        pages.add(page)
+    new_pages = len(pages - seen_pages)
+    seen_pages.update(pages)
+    return {"event": number, "comment": comment, "accesses": sum(counts.values()),
+            "inst_reads": counts["INST_READ"], "data_reads": counts["DATA_READ"],
+            "data_writes": counts["DATA_WRITE"], "pages": len(pages),
+            "new_pages": new_pages, "total_pages": len(seen_pages),
+            "working_set": len(blocks) * BLOCK_SIZE}
+
+def write_event_stats(rows, f):
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(EVENT_COLUMNS)
+    for row in rows:
+        writer.writerow(["" if row[column] is None else row[column] for column in EVENT_COLUMNS])
+
+def scan_pages(it):
+    """
+    Stream through the accesses once and return the sorted list of pages
+    they touch and the number of accesses.
+    """
+    pages = set()
+    count = 0
+    for (access_type, addr) in it:
+        pages.add(get_page(addr))
+        count += 1
+    return sorted(pages), count
+
+def layout_rows(unique_pages):
+    """
+    Assign each page a row, highest address first, leaving a gap that grows
+    with the log of the distance between pages that are far apart.
+    """
+    row_count = 0
+    row_map = {}
+
+    prev = unique_pages[-1]
+    for page in reversed(unique_pages):
+        row_map[page] = row_count
+        if (prev - page) >> 12 > 256:
+            #print hex(prev), hex(page), (page - prev) >> 12
+            row_count += int(math.log(prev-page, 10) * 5)
+        row_count += 1
+        prev = page
+    return row_map, row_count
+
+def render_column(im, i, accessed_pages, row_map):
+    for page in set(page for (page, access_type) in accessed_pages):
+        dr = accessed_pages[(page, "DATA_READ")]
+        dw = accessed_pages[(page, "DATA_WRITE")]
+        ir = accessed_pages[(page, "INST_READ")]
+        total = dr + dw + ir
+        if total:
+            im.putpixel((i, row_map[page]), (int(255.0*dr/total), int(255.0*ir/total), int(255.0*dw/total)))
+
+# Image channel of each access type: red, green and blue
+CHANNELS = {"DATA_READ": 0, "INST_READ": 1, "DATA_WRITE": 2}
+TRACE_CHANNELS = dict((ref_type, CHANNELS[access_type])
+                      for (ref_type, access_type) in trace_mapping.items())
+
+def access_batches(it, batch_size=1 << 16):
+    """
+    Group (access_type, addr) tuples into NumPy arrays of blocks and image
+    channels, batch_size accesses at a time.
+    """
+    import array
+    it = iter(it)
+    while True:
+        blocks = array.array("L")
+        channels = array.array("B")
+        for (access_type, addr) in itertools.islice(it, batch_size):
+            blocks.append(get_block(addr))
+            channels.append(CHANNELS[access_type])
+        if not blocks:
+            return
+        yield (numpy.frombuffer(blocks, dtype=numpy.uint), numpy.frombuffer(channels, dtype=numpy.uint8))
+
+def trace_access_batches(filename):
+    """
+    Like access_batches, but straight from the arrays of a binary trace file.
+    """
+    from tracefile import TraceReader
+    trace = TraceReader(filename)
+    lookup = numpy.zeros(256, dtype=numpy.uint8)
+    for ref_type, channel in TRACE_CHANNELS.items():
+        lookup[ord(ref_type)] = channel
+    for refs in trace.arrays():
+        blocks = (refs["addr"] >> BLOCK_BITS) << BLOCK_BITS
+        yield (blocks, lookup[refs["type"].view(numpy.uint8)])
+    trace.close()
+
+def file_access_batches(filename):
+    from tracefile import is_trace_file
+    if is_trace_file(filename):
+        return trace_access_batches(filename)
+    return access_batches(file_access_blocks(filename))
+
+def sparse_counts(batches, chunk_size):
+    """
+    Count the accesses to each page through each image channel in every
+    timestep. Returns the number of accesses and parallel arrays of
+    timesteps, pages, channels and counts, one entry per combination seen
+    in a batch, which is bounded by pages x timesteps instead of accesses.
+    """
+    position = 0
+    parts = []
+    for blocks, channels in batches:
+        pages = (blocks >> PAGE_BITS) << PAGE_BITS
+        local_pages, local_index = numpy.unique(pages, return_inverse=True)
+        first_chunk = position // chunk_size
+        chunks = (position + numpy.arange(len(pages))) // chunk_size - first_chunk
+        keys = (chunks * len(local_pages) + local_index) * 3 + channels
+        keys, counts = numpy.unique(keys, return_counts=True)
+        cells, key_channels = divmod(keys, 3)
+        key_chunks, key_pages = divmod(cells, len(local_pages))
+        parts.append((key_chunks + first_chunk, local_pages[key_pages], key_channels, counts))
+        position += len(pages)
+    if not parts:
+        empty = numpy.zeros(0, dtype=numpy.int64)
+        return 0, empty, empty, empty, empty
+    return (position,) + tuple(numpy.concatenate([part[i] for part in parts]) for i in range(4))
+
+def column_arrays(columns):
+    """
+    The page counts of chunk_counts or event_columns, one per timestep, as
+    the arrays that sparse_counts returns.
+    """
+    cells = [(i, page, CHANNELS[access_type], count) for (i, column) in enumerate(columns)
+             for ((page, access_type), count) in column.iteritems()]
+    return tuple(numpy.array([cell[field] for cell in cells], dtype=dtype)
+                 for (field, dtype) in enumerate((numpy.int64, numpy.uint, numpy.uint8, numpy.int64)))
+
+def render_counts(num_chunks, chunks, pages, channels, counts, unique_pages, row_map, row_count):
+    """
+    Build the whole image at once from the output of sparse_counts.
+    """
+    page_index = numpy.searchsorted(unique_pages, pages)
+    cells, cell_index = numpy.unique(chunks * len(unique_pages) + page_index,
+                                     return_inverse=True)
+    rgb = numpy.zeros((len(cells), 3))
+    numpy.add.at(rgb, (cell_index, channels), counts)
+    colors = (255.0 * rgb / rgb.sum(axis=1)[:, None]).astype(numpy.uint8)
+
+    rows = numpy.array([row_map[page] for page in unique_pages.tolist()])
+    cell_chunks, cell_pages = divmod(cells, len(unique_pages))
+    image = numpy.empty((row_count, num_chunks, 3), dtype=numpy.uint8)
+    image.fill(255)
+    image[rows[cell_pages], cell_chunks] = colors
+    return Image.fromarray(image, "RGB")
+
 def human_friendly(b):
     GB, b = divmod(b, 2**30)
     MB, b = divmod(b, 2**20)
@@ -126,57 +405,95 @@ def chunk_process(iterable, chunk_size):
             yield chunk
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print "Usage: ./plot.py timestep output_filename < trace_file"
+    if len(sys.argv) not in (3, 4):
+        print "Usage: ./plot.py timestep output_filename [trace_file | binary_trace]"
+        print "       ./plot.py timestep output_filename < trace_file"
+        print "       ./plot.py events output_filename [trace_file]"
+        print "       ./plot.py events output_filename < trace_file"
         sys.exit(1)
 
-    chunk_size = int(sys.argv[1])
+    by_event = sys.argv[1] == "events"
+    if not by_event:
+        chunk_size = int(sys.argv[1])
     output_filename = sys.argv[2]
 
     print "Working..."
 
-    block_accesses = list(memory_access_blocks(sys.stdin))
-    #pages = mark_region_accesses(block_accesses)
-
-    #x = pages.items()
-    #x.sort(key=lambda (key, value): key)
-    
-    #print len(x)
+    if by_event:
+        # One timestep per event marker, in one pass. Only text traces keep
+        # the markers.
+        if len(sys.argv) == 4:
+            from tracefile import is_trace_file
+            if is_trace_file(sys.argv[3]):
+                print "Binary traces have no event markers"
+                sys.exit(1)
+            source = open(sys.argv[3])
+        else:
+            source = sys.stdin
+        events = event_columns(memory_access_blocks(source, events=True))
+        if output_filename.endswith(".csv"):
+            # Just the statistics, holding one event at a time
+            with open(output_filename, "w") as f:
+                write_event_stats((stats for (stats, column) in events), f)
+            print "Event statistics output to %s" % output_filename
+            sys.exit(0)
+
+        rows = []
+        columns = []
+        for stats, column in events:
+            rows.append(stats)
+            columns.append(column)
+        stats_filename = os.path.splitext(output_filename)[0] + ".csv"
+        with open(stats_filename, "w") as f:
+            write_event_stats(rows, f)
+        print "Event statistics output to %s" % stats_filename
+
+        unique_pages = sorted(set(page for column in columns for (page, access_type) in column))
+        num_chunks = len(columns)
+        if numpy is not None:
+            chunks, pages, channels, counts = column_arrays(columns)
+            page_array = numpy.array(unique_pages, dtype=numpy.uint)
+    elif numpy is not None:
+        # One streaming pass that keeps the counts of each page in each
+        # timestep, then one vectorized rendering step
+        if len(sys.argv) == 4:
+            batches = file_access_batches(sys.argv[3])
+        else:
+            batches = access_batches(memory_access_blocks(sys.stdin))
+        access_count, chunks, pages, channels, counts = sparse_counts(batches, chunk_size)
+        num_chunks = access_count/chunk_size + 1
+        page_array = numpy.unique(pages)
+        unique_pages = page_array.tolist()
+    elif len(sys.argv) == 4:
+        # Two streaming passes over the file: one to find the pages and one
+        # to render, holding one timestep's page counts at a time
+        unique_pages, access_count = scan_pages(file_access_blocks(sys.argv[3]))
+        num_chunks = access_count/chunk_size + 1
+        columns = chunk_counts(file_access_blocks(sys.argv[3]), chunk_size)
+    else:
+        # stdin can only be read once, so keep the page counts of every
+        # timestep, which grows with pages x timesteps rather than accesses
+        columns = list(chunk_counts(memory_access_blocks(sys.stdin), chunk_size))
+        unique_pages = sorted(set(page for column in columns for (page, access_type) in column))
+        num_chunks = len(columns)
 
     print "Done reading memory accesses"
 
-    pages = mark_region_accesses(block_accesses)
-    unique_pages = sorted(list(set(addr for (addr, access_type) in pages)))
-
-    print "Done processing unique accesses"
-
-    row_count = 0
-    row_map = {}
+    if not unique_pages:
+        print "No memory accesses found"
+        sys.exit(1)
 
-    prev = unique_pages[-1]
-    for page in reversed(unique_pages):
-        row_map[page] = row_count
-        if (prev - page) >> 12 > 256:
-            #print hex(prev), hex(page), (page - prev) >> 12
-            row_count += int(math.log(prev-page, 10) * 5)
-        row_count += 1
-        prev = page
+    row_map, row_count = layout_rows(unique_pages)
 
     print "Done partitioning segments"
-    
 
-    num_chunks = len(block_accesses)/chunk_size + 1
-
-    im = Image.new("RGB", (num_chunks, row_count), "white")
-    for i,accesses in enumerate(chunk_process(block_accesses, chunk_size)):
-        accessed_pages = mark_region_accesses(accesses)
-        for page in unique_pages:
-            dr = accessed_pages[(page, "DATA_READ")]
-            dw = accessed_pages[(page, "DATA_WRITE")]
-            ir = accessed_pages[(page, "INST_READ")]
-            total = dr + dw + ir
-            if total:
-                im.putpixel((i, row_map[page]), (int(255.0*dr/total), int(255.0*ir/total), int(255.0*dw/total)))
+    if numpy is not None:
+        im = render_counts(num_chunks, chunks, pages, channels, counts,
+                           page_array, row_map, row_count)
+    else:
+        im = Image.new("RGB", (num_chunks, row_count), "white")
+        for i, accessed_pages in enumerate(columns):
+            render_column(im, i, accessed_pages, row_map)
     
     print "Done rendering bitmap"
 
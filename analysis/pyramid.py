@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+Multi-resolution access counts for heatmaps too large to render in one go,
+or to re-render at a different timestep without re-reading the trace.
+
+Building a pyramid reads the trace once and stores, in a directory of .npy
+files, the number of accesses of each type to each page in each timestep of
+base_timestep accesses. Each further level halves both resolutions: twice
+the timestep, and pages merged into aligned regions twice the size. Levels
+are added until a level has at most MIN_COLUMNS timesteps.
+
+Rendering picks the coarsest level that is still fine enough, memory maps
+it, and sums its counts into the requested timestep and region size, so
+only the columns in the requested range of accesses are ever read. At the
+base timestep the image is the same as plot.py's.
+
+The base level takes timesteps x pages x 3 counts on disk, so pick
+base_timestep with the number of pages touched in mind.
+
+Needs NumPy.
+
+Usage: ./pyramid.py build base_timestep pyramid_dir [trace_file | binary_trace]
+       ./pyramid.py build base_timestep pyramid_dir < trace_file
+       ./pyramid.py render pyramid_dir timestep output_filename [region_size [first last]]
+"""
+import json
+import os
+import sys
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from plot import *
+
+MIN_COLUMNS = 512
+
+# Columns downsampled at a time while building, to bound memory
+BLOCK_COLUMNS = 1024
+
+def count_dtype(bound):
+    """
+    Smallest unsigned type that holds counts up to bound.
+    """
+    for dtype in (numpy.uint16, numpy.uint32):
+        if bound <= numpy.iinfo(dtype).max:
+            return dtype
+    return numpy.uint64
+
+def group_regions(regions, bits):
+    """
+    Merge the sorted region addresses into aligned regions of 2**bits bytes.
+    Returns the merged addresses and the index of the first old region in
+    each, as used by numpy.add.reduceat.
+    """
+    keys = regions >> bits
+    starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts] << bits, starts
+
+def downsample(counts, time_factor, starts=None, dtype=None):
+    """
+    Sum a (timesteps, regions, 3) count array over time_factor consecutive
+    timesteps and over the groups of regions beginning at starts.
+    """
+    if time_factor > 1:
+        counts = numpy.add.reduceat(counts, numpy.arange(0, len(counts), time_factor),
+                                    axis=0, dtype=dtype)
+    elif dtype is not None:
+        counts = counts.astype(dtype)
+    if starts is not None:
+        counts = numpy.add.reduceat(counts, starts, axis=1)
+    return counts
+
+def level_paths(directory, level):
+    return (os.path.join(directory, "level_%d.npy" % level),
+            os.path.join(directory, "regions_%d.npy" % level))
+
+def build(batches, timestep, directory, min_columns=MIN_COLUMNS):
+    """
+    Count the (access_type, addr) batches from access_batches or
+    trace_access_batches into a pyramid in directory.
+    """
+    access_count, chunks, pages, channels, counts = sparse_counts(batches, timestep)
+    if not access_count:
+        raise ValueError("No memory accesses found")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    regions = numpy.unique(pages)
+    counts_path, regions_path = level_paths(directory, 0)
+    level = open_memmap(counts_path, "w+", dtype=count_dtype(timestep),
+                        shape=(access_count/timestep + 1, len(regions), 3))
+    numpy.add.at(level, (chunks, numpy.searchsorted(regions, pages), channels), counts)
+    numpy.save(regions_path, regions)
+
+    levels = 1
+    while len(level) > min_columns:
+        next_regions, starts = group_regions(regions, PAGE_BITS + levels)
+        counts_path, regions_path = level_paths(directory, levels)
+        dtype = count_dtype(timestep << levels)
+        next_level = open_memmap(counts_path, "w+", dtype=dtype,
+                                 shape=((len(level) + 1)/2, len(next_regions), 3))
+        for start in xrange(0, len(level), BLOCK_COLUMNS):
+            block = downsample(level[start:start + BLOCK_COLUMNS], 2, starts, dtype)
+            next_level[start/2:start/2 + len(block)] = block
+        numpy.save(regions_path, next_regions)
+        del level
+        level, regions = next_level, next_regions
+        levels += 1
+    level.flush()
+
+    with open(os.path.join(directory, "pyramid.json"), "w") as f:
+        json.dump({"timestep": timestep, "accesses": access_count, "levels": levels}, f)
+
+class Pyramid(object):
+    def __init__(self, directory):
+        with open(os.path.join(directory, "pyramid.json")) as f:
+            meta = json.load(f)
+        self.timestep = meta["timestep"]
+        self.accesses = meta["accesses"]
+        self.levels = []
+        for level in xrange(meta["levels"]):
+            counts_path, regions_path = level_paths(directory, level)
+            self.levels.append((numpy.load(counts_path, mmap_mode="r"), numpy.load(regions_path)))
+
+    def columns(self, timestep):
+        """
+        Number of timesteps of the given size, counted as plot.py does.
+        """
+        return self.accesses/timestep + 1
+
+    def counts(self, timestep, region_bits=PAGE_BITS, first=0, last=None):
+        """
+        Returns the (timesteps, regions, 3) counts for the timesteps of the
+        given size covering accesses first up to last, the addresses of the
+        regions of 2**region_bits bytes, and the number of timesteps, which
+        the counts may fall one short of when the trace ends exactly on a
+        timestep.
+        """
+        if timestep % self.timestep:
+            raise ValueError("The timestep must be a multiple of %d" % self.timestep)
+        if region_bits < PAGE_BITS:
+            raise ValueError("Regions must be at least a page")
+        factor = timestep / self.timestep
+        level = 0
+        while (level + 1 < len(self.levels) and factor % (2 << level) == 0 and
+               PAGE_BITS + level < region_bits):
+            level += 1
+        counts, regions = self.levels[level]
+
+        first_column = first / timestep
+        last_column = self.columns(timestep)
+        if last is not None:
+            last_column = min(max(last - 1, first) / timestep + 1, last_column)
+        group = factor >> level
+        counts = counts[first_column * group:last_column * group]
+
+        starts = None
+        if region_bits > PAGE_BITS + level:
+            regions, starts = group_regions(regions, region_bits)
+        return downsample(counts, group, starts), regions, last_column - first_column
+
+def render(counts, regions, num_columns):
+    """
+    Render counts from Pyramid.counts the way plot.py does.
+    """
+    row_map, row_count = layout_rows(regions.tolist())
+    chunks, region_index, channels = numpy.nonzero(counts)
+    return render_counts(num_columns, chunks, regions[region_index], channels,
+                         counts[chunks, region_index, channels], regions, row_map, row_count)
+
+if __name__ == "__main__":
+    if len(sys.argv) in (4, 5) and sys.argv[1] == "build":
+        if len(sys.argv) == 5:
+            batches = file_access_batches(sys.argv[4])
+        else:
+            batches = access_batches(memory_access_blocks(sys.stdin))
+        build(batches, int(sys.argv[2]), sys.argv[3])
+    elif len(sys.argv) in (5, 6, 8) and sys.argv[1] == "render":
+        pyramid = Pyramid(sys.argv[2])
+        region_bits = PAGE_BITS
+        if len(sys.argv) > 5:
+            region_bits = int(math.log(int(sys.argv[5]), 2))
+        window = [int(arg) for arg in sys.argv[6:]]
+        counts, regions, num_columns = pyramid.counts(int(sys.argv[3]), region_bits, *window)
+        render(counts, regions, num_columns).save(sys.argv[4])
+        print "Image output to %s" % sys.argv[4]
+    else:
+        print "Usage: ./pyramid.py build base_timestep pyramid_dir [trace_file | binary_trace]"
+        print "       ./pyramid.py build base_timestep pyramid_dir < trace_file"
+        print "       ./pyramid.py render pyramid_dir timestep output_filename [region_size [first last]]"
+        sys.exit(1)
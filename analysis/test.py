@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+import os
+import sys
+from cStringIO import StringIO
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+try:
+    import numpy
+    import plot
+    import pageindex
+    import pyramid
+    from plot import Image
+except ImportError:
+    numpy = None
+
+def random_accesses(rng, count):
+    """
+    Blocks accessed in code, two heap segments and the stack, as
+    memory_access_blocks yields them.
+    """
+    regions = [("INST_READ", 0x400000, 0x420000),
+               ("DATA_READ", 0x601000, 0x640000),
+               ("DATA_WRITE", 0x603000, 0x608000),
+               ("DATA_READ", 0x2000000, 0x2004000),
+               ("DATA_WRITE", 0x7fff0000, 0x7fff8000)]
+    accesses = []
+    for i in xrange(count):
+        access_type, low, high = rng.choice(regions)
+        if rng.random() < 0.3:
+            access_type = rng.choice(plot.CHANNELS.keys())
+        accesses.append((access_type, plot.get_block(rng.randrange(low, high))))
+    return accesses
+
+@unittest.skipIf(numpy is None, "NumPy and PIL are needed")
+class TestPageIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def build(self, accesses, timestep):
+        return pageindex.build_index(plot.access_batches(accesses, batch_size=97), timestep)
+
+    def test_segments(self):
+        accesses = random_accesses(self.rng, 3000)
+        index = self.build(accesses, 100)
+        self.assertEquals(index.accesses, 3000)
+        self.assertEquals(index.segments(), plot.find_segments(accesses))
+
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            boundaries = plot.find_boundaries(accesses)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEquals(index.boundaries(), boundaries)
+
+    def test_access_counts(self):
+        accesses = random_accesses(self.rng, 3000)
+        index = self.build(accesses, 100)
+        for low, high in ((0, 2**64), (0x600000, 0x604000), (0x603000, 0x2000000),
+                          (0x2001000, 0x7fff1000), (0x800000, 0x900000)):
+            expected = dict((access_type, 0) for access_type in plot.CHANNELS)
+            for access_type, addr in accesses:
+                if low <= plot.get_page(addr) < high:
+                    expected[access_type] += 1
+            self.assertEquals(index.access_counts(low, high), expected)
+
+    def test_pages_over_time(self):
+        # Ending both part way through a timestep and exactly on one
+        for count, timestep in ((2950, 50), (3000, 100), (1000, 1)):
+            accesses = random_accesses(self.rng, count)
+            pages = [plot.get_page(addr) for (access_type, addr) in accesses]
+            index = self.build(accesses, timestep)
+            chunks = index.num_chunks()
+            self.assertEquals(chunks, count / timestep + 1)
+
+            for window in (timestep, timestep * 3, timestep * 10):
+                self.assertEquals(index.window_pages(window).tolist(),
+                                  [len(set(pages[start:start + window]))
+                                   for start in xrange(0, count + 1, window)])
+                self.assertEquals(index.working_set(window).tolist(),
+                                  [len(set(pages[max((i + 1) * timestep - window, 0):
+                                                 (i + 1) * timestep]))
+                                   for i in xrange(chunks)])
+            self.assertEquals(index.footprint().tolist(),
+                              [len(set(pages[:(i + 1) * timestep])) for i in xrange(chunks)])
+            if timestep > 1:
+                self.assertRaises(ValueError, index.window_pages, timestep + 1)
+                self.assertRaises(ValueError, index.working_set, timestep + 1)
+
+@unittest.skipIf(numpy is None, "NumPy and PIL are needed")
+class TestPyramid(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        inverse = dict((access_type, name) for (name, access_type) in plot.access_mapping.items())
+        self.trace = os.path.join(self.directory, "trace")
+        with open(self.trace, "w") as f:
+            for access_type, addr in random_accesses(random.Random(2), 5000):
+                f.write("%s: %x\n" % (inverse[access_type], addr))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def plot(self, timestep):
+        filename = os.path.join(self.directory, "plot_%d.png" % timestep)
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call([sys.executable, "plot.py", str(timestep), filename, self.trace],
+                                  stdout=devnull,
+                                  cwd=os.path.dirname(os.path.abspath(plot.__file__)))
+        return Image.open(filename)
+
+    def test_render_matches_plot(self):
+        # Renders at the base timestep and multiples of it, which sum the
+        # base level's columns, are pixel for pixel what plot.py draws
+        directory = os.path.join(self.directory, "pyramid")
+        pyramid.build(plot.file_access_batches(self.trace), 50, directory, min_columns=8)
+        built = pyramid.Pyramid(directory)
+        self.assertEquals(len(built.levels), 5)
+        for timestep in (50, 100, 150):
+            expected = self.plot(timestep)
+            image = pyramid.render(*built.counts(timestep))
+            self.assertEquals(image.size, expected.size)
+            self.assertEquals(list(image.getdata()), list(expected.convert("RGB").getdata()))
+
+if __name__ == '__main__':
+    unittest.main()
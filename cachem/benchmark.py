@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the cache simulator.
+
+Usage: ./benchmark.py (batch|generate|policy) [accesses | trace_file]
+
+batch and generate run over a recorded trace (lackey output or a binary
+trace written by tracefile.py) when given a file name instead of a count.
+"""
+import os
+import random
+import sys
+import time
+
+from cachem import *
+
+class ListLRUPolicy(object):
+    """
+    The original list-backed LRU policy, kept around as a baseline. touch and
+    evict are both linear in the number of blocks the level has seen.
+    """
+    def __init__(self):
+        self.access_list = []
+
+    def touch(self, item):
+        if item in self.access_list:
+            index = self.access_list.index(item)
+            self.access_list.append(self.access_list.pop(index))
+        else:
+            self.access_list.append(item)
+
+    def evict(self, choices):
+        for item in self.access_list:
+            if item in choices:
+                self.access_list.remove(item)
+                return item
+        else:
+            return list(choices)[0]
+
+    def clear(self):
+        self.access_list = []
+
+def list_generate_accesses(reference, offset_bits=6, make_repeats=False):
+    """
+    The original byte-stepping generate_accesses, kept around as a baseline.
+    """
+    ref_type, ref_addr, ref_length = reference
+    if ref_type == "I":
+        access_type = "I"
+    elif ref_type == "S" or ref_type == "M":
+        access_type = "W"
+    else:
+        access_type = "R"
+
+    offset_mask = 0
+    for i in xrange(offset_bits):
+        offset_mask |= 1 << i
+
+    accesses = []
+    access_addr = ref_addr
+    while access_addr < ref_addr + ref_length:
+        accesses.append((access_type, access_addr))
+        if not make_repeats:
+            access_addr |= offset_mask
+        access_addr += 1
+    return accesses
+
+class NullMemory(object):
+    """
+    A parent that swallows every access so that only the cache is timed.
+    """
+    def read(self, address):
+        pass
+
+    def write(self, address):
+        pass
+
+def random_refs(count, assoc, index_bits, offset_bits, seed=0):
+    """
+    Generate a reproducible stream of lackey-style references over a working
+    set twice the size of the cache, so that most sets see evictions.
+    """
+    rng = random.Random(seed)
+    blocks = 2 * assoc * (2**index_bits)
+    refs = []
+    for i in xrange(count):
+        op = "S" if rng.random() < 0.3 else "L"
+        refs.append((op, rng.randrange(blocks) << offset_bits, 1))
+    return refs
+
+def lackey_refs(count, seed=0):
+    """
+    Generate a reproducible stream of references shaped like lackey output:
+    instruction fetches walking through a few code regions, interleaved with
+    loads, stores and modifies to a stack and a larger heap.
+    """
+    rng = random.Random(seed)
+    pc = 0x08048000
+    refs = []
+    while len(refs) < count:
+        if rng.random() < 0.05:
+            pc = 0x08048000 + rng.randrange(1 << 16)
+        pc += rng.choice((2, 3, 4, 5, 7))
+        refs.append(("I", pc, rng.choice((2, 3, 4, 5, 7))))
+        if rng.random() < 0.4:
+            op = rng.choice("LLLSM")
+            if rng.random() < 0.6:
+                addr = 0xbe000000 + rng.randrange(1 << 12)
+            else:
+                addr = 0x09000000 + rng.randrange(1 << 24)
+            refs.append((op, addr, rng.choice((1, 2, 4, 8, 16))))
+    return refs
+
+def trace_refs(source):
+    """
+    Load the references of a recorded trace file, or generate source
+    lackey-like references if it is a count.
+    """
+    if not os.path.isfile(source):
+        return lackey_refs(int(source))
+    from tracefile import TraceReader, is_trace_file, lackey_references
+    if is_trace_file(source):
+        trace = TraceReader(source)
+        refs = list(trace)
+        trace.close()
+        return refs
+    with open(source) as f:
+        return list(lackey_references(f))
+
+def time_cache(cache, refs):
+    cache.set_parent(NullMemory())
+    start = time.time()
+    for ref in refs:
+        cache.access(ref)
+    return time.time() - start
+
+def bench_policy(source):
+    """
+    Compare the list-backed and stamp-backed LRU policies as associativity
+    and set count grow.
+    """
+    count = int(source)
+    offset_bits = 6
+    print "%6s %6s %10s %10s %8s" % ("assoc", "sets", "list (s)", "stamp (s)", "speedup")
+    for index_bits in (4, 8, 12):
+        for assoc in (1, 2, 4, 8, 16):
+            refs = random_refs(count, assoc, index_bits, offset_bits)
+            tag_bits = 32 - index_bits - offset_bits
+            old = time_cache(NWayCache(assoc, tag_bits, index_bits, offset_bits, ListLRUPolicy()), refs)
+            new = time_cache(NWayCache(assoc, tag_bits, index_bits, offset_bits, LRUPolicy()), refs)
+            print "%6d %6d %10.3f %10.3f %7.1fx" % (assoc, 2**index_bits, old, new, old / new)
+
+def bench_batch(source):
+    """
+    Compare NehalemCache.access on each reference against simulate_batch.
+    """
+    refs = trace_refs(source)
+    count = len(refs)
+    ref_array = references_to_array(refs)
+    print "%10s %12s %12s %8s" % ("storage", "access/s", "batch/s", "speedup")
+    for compact in (False, True):
+        cache = NehalemCache(compact)
+        cache.L3_cache.set_parent(NullMemory())
+        start = time.time()
+        for ref in refs:
+            cache.access(ref)
+        scalar = time.time() - start
+
+        cache.clear()
+        start = time.time()
+        cache.simulate_batch(ref_array)
+        batch = time.time() - start
+        print "%10s %12d %12d %7.1fx" % (("dict", "compact")[compact],
+            count / scalar, count / batch, scalar / batch)
+
+def time_splitting(split, refs):
+    start = time.time()
+    for ref in refs:
+        for access in split(ref):
+            pass
+    return time.time() - start
+
+def bench_generate(source):
+    """
+    Compare the original generate_accesses against the block-stepping
+    generate_accesses, iter_accesses and batch_accesses, for both block
+    accesses and per-byte repeats (against per-block byte counts).
+    """
+    refs = trace_refs(source)
+    count = len(refs)
+    print "%10s %12s %12s %8s" % ("mode", "function", "refs/s", "speedup")
+    modes = [
+        ("blocks", lambda ref: list_generate_accesses(ref), [
+            ("generate", lambda ref: generate_accesses(ref)),
+            ("iter", lambda ref: iter_accesses(ref)),
+        ]),
+        ("repeats", lambda ref: list_generate_accesses(ref, 6, True), [
+            ("generate", lambda ref: generate_accesses(ref, 6, True)),
+            ("counts", lambda ref: iter_accesses(ref, 6, True)),
+        ]),
+    ]
+    for mode, baseline, splitters in modes:
+        old = time_splitting(baseline, refs)
+        print "%10s %12s %12d %7.1fx" % (mode, "original", count / old, 1.0)
+        for name, split in splitters:
+            new = time_splitting(split, refs)
+            print "%10s %12s %12d %7.1fx" % (mode, name, count / new, old / new)
+        if numpy is not None:
+            ref_array = references_to_array(refs)
+            start = time.time()
+            batch_accesses(ref_array, 6, mode == "repeats")
+            new = time.time() - start
+            print "%10s %12s %12d %7.1fx" % (mode, "batch", count / new, old / new)
+
+BENCHMARKS = {
+    "batch": bench_batch,
+    "generate": bench_generate,
+    "policy": bench_policy,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print "Usage: ./benchmark.py (%s) [accesses | trace_file]" % "|".join(sorted(BENCHMARKS))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](sys.argv[2] if len(sys.argv) > 2 else "20000")
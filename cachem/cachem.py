@@ -1,8 +1,18 @@
 #!/usr/bin/env python
+import array
 import collections
+import csv
+import json
 import os
+import random
+import struct
 import sys
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if os.environ.get("LOGGING", "false").lower() == "true":
     LOGGING_ENABLED = True
 else:
@@ -24,6 +34,39 @@ def parse_reference(line):
         ref_int = 1
     return (ref_type, int(ref_addr, 16), ref_int)
 
+# Map lackey reference types onto the kind of cache access they make
+ACCESS_TYPES = {"I": "I", "L": "R", "S": "W", "M": "W"}
+
+def iter_accesses(reference, offset_bits=6, counts=False):
+    """
+    Generator over the cache block accesses made by a memory reference. The
+    first access is to the reference's own address and the rest are to the
+    start of each following block it spans, so only one tuple is made per
+    block touched however long the reference is.
+
+    If counts is true, (type, addr, count) tuples are yielded instead, where
+    count is the number of bytes of the reference falling in that block.
+    >>> list(iter_accesses(('S', 0x7c, 8), 6, counts=True))
+    [('W', 124, 4), ('W', 128, 4)]
+    """
+    ref_type, ref_addr, ref_length = reference
+    if ref_length <= 0:
+        return
+    access_type = ACCESS_TYPES.get(ref_type, "R")
+    end = ref_addr + ref_length
+    addr = ref_addr
+    for block_addr in xrange(((ref_addr >> offset_bits) + 1) << offset_bits, end,
+                             1 << offset_bits):
+        if counts:
+            yield (access_type, addr, block_addr - addr)
+        else:
+            yield (access_type, addr)
+        addr = block_addr
+    if counts:
+        yield (access_type, addr, end - addr)
+    else:
+        yield (access_type, addr)
+
 def generate_accesses(reference, offset_bits=6, make_repeats=False):
     """
     Takes in a memory reference and generates a list of cache block accesses.
@@ -33,60 +76,404 @@ def generate_accesses(reference, offset_bits=6, make_repeats=False):
  
     If make_repeats is true, multiple cache block accesses are made for
     sequential accesses to bytes within the same block to facilitate LRU
-    approximation algorithms that depend on access counts
+    approximation algorithms that depend on access counts. Prefer
+    iter_accesses with counts=True, which gives the same information as one
+    (type, addr, count) tuple per block.
     >>> generate_accesses(('L', 69327840, 8))
     [('R', 69327840)]
     """
-
     ref_type, ref_addr, ref_length = reference
-    if ref_type == "I":
-        access_type = "I"
-    elif ref_type == "S" or ref_type == "M":
-        access_type = "W"
-    else:
-        access_type = "R"
-    
-    offset_mask = 0
-    for i in xrange(offset_bits):
-        offset_mask |= 1 << i
- 
-    accesses = []
-    access_addr = ref_addr
-    
-    while access_addr < ref_addr + ref_length:
-        accesses.append((access_type, access_addr))
-        if not make_repeats:
-            access_addr |= offset_mask
-        access_addr += 1
+    access_type = ACCESS_TYPES.get(ref_type, "R")
+    if make_repeats:
+        return [(access_type, addr) for addr in xrange(ref_addr, ref_addr + ref_length)]
+    # Most references fall within a single block
+    if ref_length > 0 and (ref_addr ^ (ref_addr + ref_length - 1)) >> offset_bits == 0:
+        return [(access_type, ref_addr)]
+    return list(iter_accesses(reference, offset_bits))
+
+# Record layout of the (type, addr, len) reference arrays accepted by
+# NehalemCache.simulate_batch
+REF_DTYPE = [("type", "S1"), ("addr", "<u8"), ("len", "<u4")]
+
+def references_to_array(refs):
+    """
+    Packs an iterable of references as returned by parse_reference into a
+    NumPy record array of REF_DTYPE.
+    """
+    return numpy.array(list(refs), dtype=REF_DTYPE)
 
-    return accesses
+def batch_accesses(refs, offset_bits=6, byte_counts=False):
+    """
+    Vectorized generate_accesses over a REF_DTYPE array. Returns parallel
+    arrays of access kinds (0 for I, 1 for R, 2 for W) and block addresses,
+    one entry per cache block touched, in trace order.
+
+    If byte_counts is true a third array is returned holding the number of
+    bytes of the reference that fall in each block, as iter_accesses does.
+    """
+    types = refs["type"]
+    kinds = numpy.ones(len(refs), dtype=numpy.uint8)
+    kinds[types == b"I"] = 0
+    kinds[(types == b"S") | (types == b"M")] = 2
+
+    addrs = refs["addr"].astype(numpy.int64)
+    lengths = refs["len"].astype(numpy.int64)
+    first = addrs >> offset_bits
+    last = (addrs + lengths - 1) >> offset_bits
+    counts = numpy.where(lengths > 0, last - first + 1, 0)
+
+    ref_index = numpy.repeat(numpy.arange(len(refs)), counts)
+    starts = numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    blocks = (first[ref_index] + (numpy.arange(len(ref_index)) - starts)) << offset_bits
+    if not byte_counts:
+        return kinds[ref_index], blocks
+    sizes = (numpy.minimum(blocks + (1 << offset_bits), (addrs + lengths)[ref_index]) -
+             numpy.maximum(blocks, addrs[ref_index]))
+    return kinds[ref_index], blocks, sizes
+
+def filter_mru_repeats(cache, blocks, writes, last_block, last_written):
+    """
+    Given the block addresses (and which of them are writes) of a stream of
+    accesses that all go to one cache level and nothing else, returns a mask
+    of the accesses that have to be simulated.
+
+    An access to the block that was the last one touched in its set is always
+    a hit, and touching the most recently used block again does not change
+    the replacement state, so it can be skipped. The one exception is the
+    first write to such a block since it was last touched, which is kept so
+    the block gets marked dirty.
+
+    last_block and last_written are per-set arrays holding the most recently
+    touched block in each set (-1 if none) and whether it has been written
+    since, carried over between successive calls and updated in place.
+    """
+    if not len(blocks):
+        return numpy.zeros(0, dtype=bool)
+    sets = (blocks & cache.index_mask) >> cache.offset_bits
+    order = numpy.argsort(sets, kind="mergesort")
+    sets = sets[order]
+    blocks = blocks[order]
+    writes = writes[order].astype(numpy.int64)
+
+    count = len(blocks)
+    first = numpy.empty(count, dtype=bool)
+    first[0] = True
+    first[1:] = sets[1:] != sets[:-1]
+    last = numpy.empty(count, dtype=bool)
+    last[:-1] = first[1:]
+    last[-1] = True
+
+    previous = numpy.empty(count, dtype=numpy.int64)
+    previous[1:] = blocks[:-1]
+    previous[first] = last_block[sets[first]]
+    head = blocks != previous
+
+    # Count the writes earlier in the same run of repeats, including any
+    # carried over from the previous call.
+    run_start = numpy.maximum.accumulate(
+        numpy.where(head | first, numpy.arange(count), 0))
+    earlier = numpy.cumsum(writes) - writes
+    earlier -= earlier[run_start]
+    carried = first & ~head & last_written[sets]
+    earlier += carried[run_start]
+
+    last_block[sets[last]] = blocks[last]
+    last_written[sets[last]] = (earlier[last] + writes[last]) > 0
+
+    keep = numpy.empty(count, dtype=bool)
+    keep[order] = head | ((writes == 1) & (earlier == 0))
+    return keep
+
+# Longest reuse distance, in accesses to one set, for which filter_lru_hits
+# works out whether an access hits; accesses with longer ones are simulated.
+MAX_REUSE_DISTANCE = 64
+
+def filter_lru_hits(cache, blocks, writes, max_distance=MAX_REUSE_DISTANCE):
+    """
+    Given the block addresses (and which of them are writes) of a stream of
+    accesses that all go to one true LRU cache level and nothing else,
+    returns a mask of the accesses that have to be simulated and the hits
+    among the rest that have to be replayed.
+
+    An access hits if fewer than assoc other blocks of its set have been
+    touched since its own block last was. That is worked out for accesses
+    whose block was touched at most max_distance accesses to the set before,
+    in the same call.
+
+    A dropped hit still moves its block to the top of the LRU order and may
+    dirty it. Only the last hit to each block between two kept accesses to
+    its set matters, so those are returned as parallel arrays: the index of
+    the kept access they must be replayed after, the block address, whether
+    the block has to be touched and whether it has to be marked dirty.
+    Touches must be replayed in the order given.
+    """
+    count = len(blocks)
+    if not count:
+        none = numpy.zeros(0, dtype=numpy.int64)
+        flags = numpy.zeros(0, dtype=bool)
+        return flags, (none, none, flags, flags)
+    assoc = cache.associativity
+    sets = (blocks & cache.index_mask) >> cache.offset_bits
+    order = numpy.argsort(sets, kind="mergesort")
+    blocks = blocks[order]
+    writes = writes[order]
+    positions = numpy.arange(count)
+
+    # The previous and next access to the same block, -1 and count if none
+    by_block = numpy.argsort(blocks, kind="mergesort")
+    same = blocks[by_block[1:]] == blocks[by_block[:-1]]
+    previous = numpy.full(count, -1, dtype=numpy.int64)
+    previous[by_block[1:][same]] = by_block[:-1][same]
+    following = numpy.full(count, count, dtype=numpy.int64)
+    following[by_block[:-1][same]] = by_block[1:][same]
+
+    distance = positions - previous
+    hit = (previous >= 0) & (distance <= assoc)
+    # Otherwise count the other blocks touched in between, as the accesses in
+    # between that are the last ones to their block before this access.
+    undecided = numpy.flatnonzero((previous >= 0) & (distance > assoc) &
+                                  (distance <= max_distance))
+    if len(undecided):
+        span = distance[undecided]
+        others = numpy.zeros(len(undecided), dtype=numpy.int64)
+        for step in xrange(1, int(span.max())):
+            others += (step < span) & (following[undecided - step] > undecided)
+        hit[undecided] = others < assoc
+
+    # The first access to each set is kept, so every hit has a kept access to
+    # its set before it.
+    keep = ~hit
+    anchor = numpy.maximum.accumulate(numpy.where(keep, positions, -1))
+    # Touching a block that nothing else in its set has been touched since
+    # that kept access leaves the order as it is.
+    head = numpy.ones(count, dtype=bool)
+    head[1:] = blocks[1:] != blocks[:-1]
+    run_start = numpy.maximum.accumulate(numpy.where(head, positions, 0))
+    unmoved = run_start <= anchor
+
+    # Group the hits to each block between two kept accesses to its set
+    hits = hit[by_block]
+    anchors = anchor[by_block]
+    breaks = numpy.ones(count, dtype=bool)
+    breaks[1:] = ~same | (anchors[1:] != anchors[:-1]) | ~hits[:-1]
+    group = numpy.cumsum(breaks) - 1
+    dirtied = numpy.bincount(group, weights=hits & writes[by_block]) > 0
+    ends = numpy.empty(count, dtype=bool)
+    ends[:-1] = breaks[1:]
+    ends[-1] = True
+    ends &= hits
+
+    dirty = numpy.zeros(count, dtype=bool)
+    dirty[by_block[ends]] = dirtied[group[ends]]
+    touch = numpy.zeros(count, dtype=bool)
+    touch[by_block[ends]] = True
+    touch &= ~unmoved
+    replayed = numpy.flatnonzero(touch | dirty)
+
+    kept = numpy.empty(count, dtype=bool)
+    kept[order] = keep
+    return kept, (order[anchor[replayed]], blocks[replayed], touch[replayed], dirty[replayed])
+
+def interleave_replays(index, ops, addrs, replays):
+    """
+    Merges the hits to replay from filter_lru_hits into a stream of kept
+    accesses, given as the positions index of those accesses in a chunk and
+    arrays ops and addrs of their operation numbers and block addresses.
+    replays holds an (anchors, block_ids, touch, dirty, touch_op) tuple for
+    each level, with the anchors as positions in the chunk. Touching a block
+    becomes operation touch_op on its id, and marking it dirty touch_op + 1.
+    Returns the merged operations and addresses as lists.
+    """
+    places, new_ops, new_addrs = [], [], []
+    for anchors, block_ids, touch, dirty, touch_op in replays:
+        for flags, op in ((touch, touch_op), (dirty, touch_op + 1)):
+            places.append(numpy.searchsorted(index, anchors[flags]) + 1)
+            new_ops.append(numpy.full(numpy.count_nonzero(flags), op, dtype=ops.dtype))
+            new_addrs.append(block_ids[flags])
+    if places:
+        # Replays after the same access keep their order
+        places = numpy.concatenate(places)
+        ops = numpy.insert(ops, places, numpy.concatenate(new_ops))
+        addrs = numpy.insert(addrs, places, numpy.concatenate(new_addrs))
+    return ops.tolist(), addrs.tolist()
+
+# Cache events reported to sinks attached with NWayCache.subscribe
+READ_HIT = 0
+READ_MISS = 1
+WRITE_HIT = 2
+WRITE_MISS = 3
+EVICT = 4
+WRITEBACK = 5
+FILL = 6
+INVALIDATE = 7
+EVENT_NAMES = ["read_hit", "read_miss", "write_hit", "write_miss",
+               "evict", "writeback", "fill", "invalidate"]
+
+# How the contents of a cache level relate to those of the levels above it.
+# An inclusive level holds everything they hold and invalidates their copies
+# of the blocks it evicts. An exclusive level only holds blocks evicted from
+# them, and hands a block up (removing its own copy) when they read it. A
+# non-inclusive non-exclusive (NINE) level does neither.
+INCLUSIVE = "inclusive"
+EXCLUSIVE = "exclusive"
+NINE = "nine"
+
+class TextEventSink(object):
+    """
+    Writes a human readable line per event, by default to stderr.
+    """
+    FORMATS = {
+        READ_HIT: "read hit on %#010x in index %#x",
+        READ_MISS: "read miss on %#010x in index %#x",
+        WRITE_HIT: "write hit on %#010x in index %#x",
+        WRITE_MISS: "write miss on %#010x in index %#x -- allocating",
+        EVICT: "  capacity conflict -- evicted %#010x (clean)",
+        WRITEBACK: "  capacity conflict -- evicted %#010x (dirty) -- writing back",
+        FILL: "  reading from parent",
+        INVALIDATE: "  invalidated %#010x",
+    }
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stderr
+
+    def event(self, cache, kind, block_id, index):
+        message = self.FORMATS[kind]
+        if kind in (EVICT, WRITEBACK, INVALIDATE):
+            message %= block_id
+        elif kind != FILL:
+            message %= (block_id, index)
+        self.stream.write("%s:\t%s\n" % (cache.name, message))
+
+class BinaryEventSink(object):
+    """
+    Appends fixed size EVENT_RECORD records (cache name, event, block id,
+    set index) to a file, buffering them to keep writes large.
+    """
+    EVENT_RECORD = struct.Struct("<8sBQI")
+
+    def __init__(self, f, buffer_size=65536):
+        self.f = f
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def event(self, cache, kind, block_id, index):
+        self.buffer.append(self.EVENT_RECORD.pack(cache.name, kind, block_id, index))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.buffer))
+        self.buffer = []
+
+class CountingEventSink(object):
+    """
+    Counts events by cache name and event kind.
+    """
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+
+    def event(self, cache, kind, block_id, index):
+        self.counts[(cache.name, kind)] += 1
+
+    def count(self, name, kind):
+        return self.counts[(name, kind)]
+
+class CacheStats(object):
+    """
+    Hit, miss, eviction and writeback counters for one cache level, plus the
+    number of evictions from and misses in each set. A write miss allocates
+    the block with a read, so it is also counted as a read miss, unless the
+    level does not allocate on writes (or is exclusive), in which case it is
+    counted as a bypassed write instead. Every access is then exactly one of
+    a read hit, a write hit, a read miss or a bypassed write.
+    """
+    COUNTERS = ("read_hits", "read_misses", "write_hits", "write_misses",
+                "bypassed_writes", "evictions", "writebacks")
+    HISTOGRAMS = ("set_evictions", "set_misses")
+    __slots__ = COUNTERS + HISTOGRAMS
+
+    def __init__(self, index_bits):
+        self.set_evictions = array.array("L", [0]) * (2**index_bits)
+        self.reset()
+
+    def reset(self):
+        for counter in self.COUNTERS:
+            setattr(self, counter, 0)
+        self.set_evictions = array.array("L", [0]) * len(self.set_evictions)
+        self.set_misses = array.array("L", [0]) * len(self.set_evictions)
+
+    def misses(self):
+        return self.read_misses + self.bypassed_writes
+
+    def accesses(self):
+        return self.read_hits + self.write_hits + self.misses()
+
+    def miss_rate(self):
+        accesses = self.accesses()
+        return float(self.misses()) / accesses if accesses else 0.0
+
+    def get_state(self):
+        return dict((name, getattr(self, name)) for name in self.COUNTERS + self.HISTOGRAMS)
+
+    def set_state(self, state):
+        for counter in self.COUNTERS:
+            setattr(self, counter, state[counter])
+        for histogram in self.HISTOGRAMS:
+            setattr(self, histogram, array.array("L", state[histogram]))
+
+    def as_dict(self, histogram=False):
+        """
+        Returns the counters, and optionally the per-set eviction and miss
+        histograms, as a dict suitable for JSON export.
+        """
+        counters = dict((counter, getattr(self, counter)) for counter in self.COUNTERS)
+        counters["accesses"] = self.accesses()
+        counters["miss_rate"] = self.miss_rate()
+        if histogram:
+            for name in self.HISTOGRAMS:
+                counters[name] = getattr(self, name).tolist()
+        return counters
 
 class NWayCache(object):
-    def __init__(self, assoc, tag_bits, index_bits, offset_bits, policy):
+    """
+    A set associative cache level. By default it is write-back and
+    write-allocate and neither inclusive nor exclusive of the levels above
+    it; see INCLUSIVE, EXCLUSIVE and NINE for the other inclusion policies.
+    A write-through level passes every write on to its parent instead of
+    keeping dirty blocks, and a level without write_allocate sends write
+    misses to its parent without bringing the block in.
+    """
+    def __init__(self, assoc, tag_bits, index_bits, offset_bits, policy,
+                 inclusion=NINE, write_through=False, write_allocate=True):
         self.index_bits = index_bits
         self.offset_bits = offset_bits
         self.tag_bits = tag_bits 
         self.policy = policy
         self.associativity = assoc
+        self.inclusion = inclusion
+        self.write_through = write_through
+        self.write_allocate = write_allocate
 
-        self.tag_mask = 0
-        for i in xrange(tag_bits):
-            self.tag_mask |= 1 << i
-        self.tag_mask <<= (offset_bits + index_bits)
-
-        self.index_mask = 0
-        for i in xrange(index_bits):
-            self.index_mask |= 1 << i
-        self.index_mask <<= offset_bits
-
+        self.tag_mask = ((1 << tag_bits) - 1) << (offset_bits + index_bits)
+        self.index_mask = ((1 << index_bits) - 1) << offset_bits
         self.id_mask = self.tag_mask | self.index_mask
 
         self.sets = collections.defaultdict(set)
         self.dirty = set()
 
         self.parent = None
+        self.children = []
         self.name = repr(self)
 
+        if hasattr(policy, "bind"):
+            policy.bind(self)
+
+        self.stats = CacheStats(index_bits)
+
+        self.sinks = []
+        if LOGGING_ENABLED:
+            self.subscribe(TextEventSink())
+
     def clear(self):
         """
         Simulate flushing the cache so that it is reset to a clean state.
@@ -98,9 +485,14 @@ class NWayCache(object):
     def set_parent(self, parent):
         """
         Set the parent lower level of memory hierarchy that the cache accesses
-        when it has a miss or writes a block back.
+        when it has a miss or writes a block back. The parent learns of its
+        new child so that it can back-invalidate it.
         """
+        if self.parent is not None and self in getattr(self.parent, "children", ()):
+            self.parent.children.remove(self)
         self.parent = parent
+        if hasattr(parent, "children"):
+            parent.children.append(self)
 
     def set_name(self, name):
         """
@@ -108,9 +500,42 @@ class NWayCache(object):
         """
         self.name = name
 
-    def log(self, s):
-        if LOGGING_ENABLED:
-            sys.stderr.write("%s:\t%s\n" % (self.name, s))
+    def subscribe(self, sink):
+        """
+        Attach a sink that will be sent every hit, miss, eviction and
+        writeback event in this cache. Events are only generated while at
+        least one sink is attached.
+        """
+        self.sinks.append(sink)
+
+    def unsubscribe(self, sink):
+        self.sinks.remove(sink)
+
+    def repeats_are_hits(self):
+        """
+        Whether filter_accesses may drop accesses to this cache: touching
+        the most recently used block again must not change the replacement
+        state, no event sink may be expecting to see those accesses, repeated
+        writes must not have to be passed on, every access must leave its
+        block resident, and nothing else may fill this cache or evict from it:
+        no level above it (which could be an entry level of its own) and no
+        inclusive level below.
+        """
+        if self.sinks or self.write_through or not self.write_allocate:
+            return False
+        if self.inclusion == EXCLUSIVE or self.children:
+            return False
+        parent = self.parent
+        while parent is not None:
+            if getattr(parent, "inclusion", NINE) == INCLUSIVE:
+                return False
+            parent = getattr(parent, "parent", None)
+        return getattr(self.policy, "idempotent_touch", self.policy is None)
+
+    def emit(self, kind, block_id):
+        index = (block_id & self.index_mask) >> self.offset_bits
+        for sink in self.sinks:
+            sink.event(self, kind, block_id, index)
 
     def lookup_block(self, address):
         """
@@ -126,20 +551,36 @@ class NWayCache(object):
     def write(self, address):
         """
         Simulate writing data to a block with the given address and flag it as
-        dirty. Since we have a write-allocate policy, if the block isn't in the
-        cache, we first read it in and then write to it.
+        dirty. With a write-allocate policy, if the block isn't in the cache,
+        we first read it in and then write to it. The read that brings the
+        block in is the only access the replacement policy sees. Otherwise
+        (and always for an exclusive level) the write goes straight to the
+        parent. A write-through cache passes the write on rather than
+        flagging the block.
         """
         
         cache_set, present = self.lookup_block(address)
         block_id = address & self.id_mask
         if not present:
-            self.log("write miss on %#010x in index %#x -- allocating" % (block_id, (address & self.index_mask) >> self.offset_bits))
+            self.stats.write_misses += 1
+            if self.sinks:
+                self.emit(WRITE_MISS, block_id)
+            if not self.write_allocate or self.inclusion == EXCLUSIVE:
+                self.stats.bypassed_writes += 1
+                self.stats.set_misses[(address & self.index_mask) >> self.offset_bits] += 1
+                self.parent.write(block_id)
+                return
             self.read(address)
         else:
-            self.log("write hit on %#010x in index %#x" % (block_id, (address & self.index_mask) >> self.offset_bits))
+            self.stats.write_hits += 1
+            if self.sinks:
+                self.emit(WRITE_HIT, block_id)
+            self.policy.touch(block_id)
 
-        self.policy.touch(block_id)
-        self.dirty.add(block_id)
+        if self.write_through:
+            self.parent.write(block_id)
+        else:
+            self.dirty.add(block_id)
 
     def write_back(self, block_id):
         """
@@ -148,31 +589,149 @@ class NWayCache(object):
 
         self.parent.write(block_id)
 
+    def retire(self, evicted, dirty):
+        """
+        Dispose of a block that has just been evicted. An inclusive cache
+        first invalidates the copies above it, then the block is written back
+        if any copy was dirty, or handed to the parent if that is exclusive.
+        """
+        if self.inclusion == INCLUSIVE:
+            for child in self.children:
+                dirty = child.invalidate(evicted) or dirty
+        if dirty:
+            self.stats.writebacks += 1
+            if self.sinks:
+                self.emit(WRITEBACK, evicted)
+        elif self.sinks:
+            self.emit(EVICT, evicted)
+        if getattr(self.parent, "inclusion", NINE) == EXCLUSIVE:
+            self.parent.insert(evicted, dirty)
+        elif dirty:
+            self.write_back(evicted)
+
+    def make_room(self, cache_set, index):
+        """
+        Evict a block from a full set.
+        """
+        evicted = self.policy.evict([(tag | index) for tag in cache_set])
+        cache_set.remove(evicted & self.tag_mask)
+        self.stats.evictions += 1
+        self.stats.set_evictions[index >> self.offset_bits] += 1
+        dirty = evicted in self.dirty
+        if dirty:
+            self.dirty.remove(evicted)
+        self.retire(evicted, dirty)
+
+    def remove(self, cache_set, block_id):
+        """
+        Take a resident block out of the cache without writing it back,
+        returning whether it was dirty.
+        """
+        cache_set.remove(block_id & self.tag_mask)
+        remove = getattr(self.policy, "remove", None)
+        if remove is not None:
+            remove(block_id)
+        if block_id in self.dirty:
+            self.dirty.remove(block_id)
+            return True
+        return False
+
+    def invalidate(self, block_id):
+        """
+        Remove a block from this cache and every cache above it, as an
+        inclusive level below does when it evicts the block. Returns whether
+        any of the removed copies was dirty; none of them are written back.
+        """
+        dirty = False
+        for child in self.children:
+            dirty = child.invalidate(block_id) or dirty
+        block_id &= self.id_mask
+        cache_set, present = self.lookup_block(block_id)
+        if present:
+            if self.sinks:
+                self.emit(INVALIDATE, block_id)
+            dirty = self.remove(cache_set, block_id) or dirty
+        return dirty
+
+    def insert(self, block_id, dirty):
+        """
+        Place a block evicted from a level above into this (exclusive) cache
+        without reading it from the parent.
+        """
+        index = block_id & self.index_mask
+        cache_set, present = self.lookup_block(block_id)
+        if not present:
+            if len(cache_set) == self.associativity:
+                self.make_room(cache_set, index)
+            if self.sinks:
+                self.emit(FILL, block_id)
+            cache_set.add(block_id & self.tag_mask)
+        if dirty:
+            self.dirty.add(block_id)
+        self.policy.touch(block_id)
+
+    def geometry(self):
+        """
+        Describes the storage and replacement policy of this cache, so that
+        a checkpoint is only restored into an identical one.
+        """
+        return [type(self).__name__, self.associativity, self.tag_bits, self.index_bits,
+                self.offset_bits, type(self.policy).__name__]
+
+    def get_state(self):
+        """
+        Returns the contents, replacement state and statistics of the cache
+        as a dict of JSON values and arrays (see checkpoint.py).
+        """
+        return {"geometry": self.geometry(),
+                "blocks": array.array("L", [tag | index for (index, cache_set)
+                                            in self.sets.iteritems() for tag in cache_set]),
+                "dirty": array.array("L", self.dirty),
+                "policy": self.policy.get_state(),
+                "stats": self.stats.get_state()}
+
+    def set_state(self, state):
+        if state["geometry"] != self.geometry():
+            raise ValueError("State of %s does not match %s" % (state["geometry"], self.geometry()))
+        self.sets.clear()
+        for block_id in state["blocks"]:
+            self.sets[block_id & self.index_mask].add(block_id & self.tag_mask)
+        self.dirty = set(state["dirty"])
+        self.policy.set_state(state["policy"])
+        self.stats.set_state(state["stats"])
+
     def read(self, address):
         """
         Simulate reading data from a block with the given address, possibly
         reading it in from another cache level and evicting a block from this
         cache to make room for it.
+
+        Returns whether the block handed up is dirty, which only happens when
+        it comes out of an exclusive level.
         """
         index = address & self.index_mask
         block_id = address & self.id_mask
         cache_set, present = self.lookup_block(address)
         if not present:
-            self.log("read miss on %#010x in index %#x" % (block_id, index >> self.offset_bits))
+            self.stats.read_misses += 1
+            self.stats.set_misses[index >> self.offset_bits] += 1
+            if self.sinks:
+                self.emit(READ_MISS, block_id)
+            if self.inclusion == EXCLUSIVE:
+                return self.parent.read(block_id)
             if len(cache_set) == self.associativity:
-                evicted = self.policy.evict([(tag | index) for tag in cache_set])
-                cache_set.remove(evicted & self.tag_mask)
-                if evicted in self.dirty:
-                    self.log("  capacity conflict -- evicted %#010x (dirty) -- writing back" % evicted)
-                    self.dirty.remove(evicted)
-                    self.write_back(evicted)
-                else:
-                    self.log("  capacity conflict -- evicted %#010x (clean)" % evicted)
-            self.log("  reading from parent")
-            self.parent.read(block_id)
+                self.make_room(cache_set, index)
+            if self.sinks:
+                self.emit(FILL, block_id)
+            if self.parent.read(block_id):
+                self.dirty.add(block_id)
             cache_set.add(address & self.tag_mask)
         else:
-            self.log("read hit on %#010x in index %#x" % (block_id, index >> self.offset_bits))
+            self.stats.read_hits += 1
+            if self.sinks:
+                self.emit(READ_HIT, block_id)
+            if self.inclusion == EXCLUSIVE:
+                return self.remove(cache_set, block_id)
         self.policy.touch(block_id)
     
     def access(self, ref):
@@ -180,72 +739,1065 @@ class NWayCache(object):
         Simulate the sequence of cache accesses generated by a sequential
         memory reference.
         """
-        for (op, addr) in generate_accesses(ref, self.offset_bits, False):
-            if op == "I":
-                self.read(addr)
-            elif op == "R":
-                self.read(addr)
-            elif op == "W":
-                self.write(addr)
+        ref_type, ref_addr, ref_length = ref
+        if ref_length <= 0:
+            return
+        if ref_type == "S" or ref_type == "M":
+            simulate = self.write
+        else:
+            simulate = self.read
+        simulate(ref_addr)
+        offset_bits = self.offset_bits
+        for addr in xrange(((ref_addr >> offset_bits) + 1) << offset_bits,
+                           ref_addr + ref_length, 1 << offset_bits):
+            simulate(addr)
+
+    def filter_accesses(self, blocks, writes, state):
+        """
+        Returns a mask of the given block accesses to this cache that have to
+        be simulated, and the hits among the rest that have to be replayed
+        with hit_replayers, or None if there are none. Only valid if
+        repeats_are_hits. Repeats of the most recently used block of a set
+        are dropped for any policy (see filter_mru_repeats), and for one whose
+        evictions depend only on the order blocks were touched in, so are
+        the other hits found by filter_lru_hits.
+
+        state is a (last_block, last_written) pair of per-set arrays carried
+        from one call to the next; see new_filter_state.
+        """
+        keep = filter_mru_repeats(self, blocks, writes, *state)
+        if not getattr(self.policy, "stack_algorithm", self.policy is None):
+            return keep, None
+        # Leaving out repeats of the most recently used block changes no
+        # count of the other blocks touched since a block was, so the hits
+        # among the rest are what filter_lru_hits finds in those that remain.
+        pos = numpy.flatnonzero(keep)
+        keep[pos], replays = filter_lru_hits(self, blocks[pos], writes[pos])
+        return keep, (pos[replays[0]],) + replays[1:]
+
+    def new_filter_state(self):
+        return (numpy.full(2**self.index_bits, -1, dtype=numpy.int64),
+                numpy.zeros(2**self.index_bits, dtype=bool))
+
+    def hit_replayers(self):
+        """
+        Returns the two functions that redo the effect of a hit dropped by
+        filter_lru_hits on the block with a given id: moving it to the top of
+        the LRU order, and marking it dirty.
+        """
+        return self.policy.touch, self.dirty.add
+
+    def simulate_batch(self, refs, chunk_size=1 << 16):
+        """
+        Simulate a REF_DTYPE array of references, equivalent to calling
+        access on each of them in turn. Accesses that are certain to be hits
+        are dropped in bulk (see filter_accesses and repeats_are_hits).
+        """
+        state = self.new_filter_state()
+        for start in xrange(0, len(refs), chunk_size):
+            kinds, blocks = batch_accesses(refs[start:start + chunk_size], self.offset_bits)
+            handlers = [self.read, self.read, self.write] + list(self.hit_replayers())
+            replays = []
+            if not self.repeats_are_hits():
+                index = numpy.arange(len(blocks))
             else:
-                raise Exception("Invalid operation: %s" % op)
+                keep, level_replays = self.filter_accesses(blocks, kinds == 2, state)
+                index = numpy.flatnonzero(keep)
+                if level_replays is not None:
+                    anchors, replayed, touch, dirty = level_replays
+                    replays.append((anchors, replayed & self.id_mask, touch, dirty, 3))
+                dropped = kinds[~keep]
+                self.stats.read_hits += int(numpy.count_nonzero(dropped != 2))
+                self.stats.write_hits += int(numpy.count_nonzero(dropped == 2))
+
+            ops, addrs = interleave_replays(index, kinds[index], blocks[index], replays)
+            for op, addr in zip(ops, addrs):
+                handlers[op](addr)
+
+class CompactNWayCache(NWayCache):
+    """
+    An NWayCache whose contents live in flat arrays preallocated to
+    2**index_bits * assoc slots instead of a dict of Python sets. Slot
+    set * assoc + way holds the block id resident in that way (or INVALID),
+    its dirty bit and its last access time, a 4 byte stamp that is 0 while
+    the way is empty. Ways are filled in order, and each set also keeps the
+    number of its ways filled so far, so that only those are searched, and
+    the slot a block was last found or placed in, which is checked first.
+
+    If no policy is given, replacement is true LRU driven by the per-slot
+    recency stamps, which evicts exactly the block LRUPolicy would. Any other
+    policy object is consulted through the usual touch/evict interface.
+    """
+    def __init__(self, assoc, tag_bits, index_bits, offset_bits, policy=None,
+                 inclusion=NINE, write_through=False, write_allocate=True):
+        NWayCache.__init__(self, assoc, tag_bits, index_bits, offset_bits, policy,
+                           inclusion, write_through, write_allocate)
+
+        # Use the narrowest array type whose all-ones value can never be a
+        # block id, so that value can mark empty ways.
+        for typecode in ("I", "L"):
+            self.INVALID = (1 << (8 * array.array(typecode).itemsize)) - 1
+            if self.id_mask < self.INVALID:
+                self.typecode = typecode
+                break
+        else:
+            raise ValueError("Addresses of %d bits are too wide" %
+                             (tag_bits + index_bits + offset_bits))
+
+        self.stamp_limit = (1 << (8 * array.array("I").itemsize)) - 1
+        self.slot_count = assoc << index_bits
+        self.clear()
+
+    def clear(self):
+        """
+        Simulate flushing the cache so that it is reset to a clean state.
+        """
+        self.tags = array.array(self.typecode, [self.INVALID]) * self.slot_count
+        self.dirty_bits = bytearray(self.slot_count)
+        self.stamps = array.array("I", [0]) * self.slot_count
+        self.clock = 0
+        self.fills = array.array("I", [0]) * (2**self.index_bits)
+        self.clear_hints()
+        if self.policy is not None:
+            self.policy.clear()
+
+    def clear_hints(self):
+        self.hints = array.array("I", xrange(0, self.slot_count, self.associativity))
+
+    def get_state(self):
+        state = {"geometry": self.geometry(), "tags": self.tags,
+                 "dirty_bits": self.dirty_bits, "stamps": self.stamps, "clock": self.clock,
+                 "fills": self.fills, "stats": self.stats.get_state()}
+        if self.policy is not None:
+            state["policy"] = self.policy.get_state()
+        return state
+
+    def set_state(self, state):
+        if state["geometry"] != self.geometry():
+            raise ValueError("State of %s does not match %s" % (state["geometry"], self.geometry()))
+        self.tags = array.array(self.typecode, state["tags"])
+        self.dirty_bits = bytearray(state["dirty_bits"])
+        self.stamps = array.array("I", state["stamps"])
+        self.clock = state["clock"]
+        self.fills = array.array("I", state["fills"])
+        self.clear_hints()
+        if self.policy is not None:
+            self.policy.set_state(state["policy"])
+        self.stats.set_state(state["stats"])
+
+    def find_slot(self, cache_set, block_id):
+        """
+        Returns the slot of the given set that holds the block, or -1 if it
+        is not in the cache.
+        """
+        slot = self.hints[cache_set]
+        if self.tags[slot] == block_id:
+            return slot
+        base = cache_set * self.associativity
+        ways = self.tags[base:base + self.fills[cache_set]]
+        if block_id in ways:
+            slot = base + ways.index(block_id)
+            self.hints[cache_set] = slot
+            return slot
+        return -1
+
+    def lookup_slot(self, address):
+        """
+        Returns the number of the set that the address indexes into and the
+        slot holding the block corresponding to the address, or -1 if it is
+        not in the cache.
+        """
+        cache_set = (address & self.index_mask) >> self.offset_bits
+        return (cache_set, self.find_slot(cache_set, address & self.id_mask))
+
+    def lookup_block(self, address):
+        cache_set, slot = self.lookup_slot(address)
+        base = cache_set * self.associativity
+        ways = self.tags[base:base + self.associativity]
+        if self.INVALID in ways:
+            ways = [block for block in ways if block != self.INVALID]
+        return (ways, slot >= 0)
+
+    def touch(self, slot, block_id):
+        if self.policy is None:
+            if self.clock == self.stamp_limit:
+                self.renumber()
+            self.clock += 1
+            self.stamps[slot] = self.clock
+        else:
+            self.policy.touch(block_id)
+
+    def renumber(self):
+        """
+        Replace the stamps of the blocks in each set by their order within
+        the set, so that the clock can start again without wrapping around.
+        """
+        assoc = self.associativity
+        for base in xrange(0, self.slot_count, assoc):
+            stamps = self.stamps[base:base + assoc]
+            for rank, way in enumerate(sorted(xrange(assoc), key=stamps.__getitem__)):
+                if stamps[way]:
+                    self.stamps[base + way] = rank + 1
+        self.clock = assoc
+
+    def allocate(self, cache_set):
+        """
+        Find a slot in the given set for a new block, evicting (and retiring)
+        a resident block if the set is full.
+        """
+        base = cache_set * self.associativity
+        fill = self.fills[cache_set]
+        if fill < self.associativity:
+            self.fills[cache_set] = fill + 1
+            self.hints[cache_set] = base + fill
+            return base + fill
+        if self.policy is None:
+            # Ways emptied since they were filled have the lowest stamp, 0
+            stamps = self.stamps[base:base + self.associativity]
+            slot = base + stamps.index(min(stamps))
+        else:
+            ways = self.tags[base:base + self.associativity]
+            if self.INVALID in ways:
+                slot = base + ways.index(self.INVALID)
+            else:
+                slot = base + ways.index(self.policy.evict(list(ways)))
+        self.hints[cache_set] = slot
+        evicted = self.tags[slot]
+        if evicted == self.INVALID:
+            return slot
+        self.tags[slot] = self.INVALID
+        self.stats.evictions += 1
+        self.stats.set_evictions[cache_set] += 1
+        dirty = self.dirty_bits[slot]
+        self.dirty_bits[slot] = 0
+        self.retire(evicted, dirty)
+        return slot
+
+    def remove_slot(self, slot):
+        """
+        Empty a slot without writing its block back, returning whether the
+        block was dirty.
+        """
+        block_id = self.tags[slot]
+        self.tags[slot] = self.INVALID
+        self.stamps[slot] = 0
+        if self.policy is not None:
+            remove = getattr(self.policy, "remove", None)
+            if remove is not None:
+                remove(block_id)
+        dirty = self.dirty_bits[slot] == 1
+        self.dirty_bits[slot] = 0
+        return dirty
+
+    def invalidate(self, block_id):
+        dirty = False
+        for child in self.children:
+            dirty = child.invalidate(block_id) or dirty
+        block_id &= self.id_mask
+        cache_set, slot = self.lookup_slot(block_id)
+        if slot >= 0:
+            if self.sinks:
+                self.emit(INVALIDATE, block_id)
+            dirty = self.remove_slot(slot) or dirty
+        return dirty
+
+    def insert(self, block_id, dirty):
+        cache_set, slot = self.lookup_slot(block_id)
+        if slot < 0:
+            slot = self.allocate(cache_set)
+            if self.sinks:
+                self.emit(FILL, block_id)
+            self.tags[slot] = block_id
+        if dirty:
+            self.dirty_bits[slot] = 1
+        self.touch(slot, block_id)
+
+    def hit_replayers(self):
+        return self.touch_block, self.mark_dirty
+
+    def touch_block(self, block_id):
+        self.touch(self.lookup_slot(block_id)[1], block_id)
+
+    def mark_dirty(self, block_id):
+        self.dirty_bits[self.lookup_slot(block_id)[1]] = 1
+
+    def write(self, address):
+        block_id = address & self.id_mask
+        cache_set = (address & self.index_mask) >> self.offset_bits
+        # The hint check of find_slot, made here to save a call on most hits
+        slot = self.hints[cache_set]
+        if self.tags[slot] != block_id:
+            slot = self.find_slot(cache_set, block_id)
+        if slot < 0:
+            self.stats.write_misses += 1
+            if self.sinks:
+                self.emit(WRITE_MISS, block_id)
+            if not self.write_allocate or self.inclusion == EXCLUSIVE:
+                self.stats.bypassed_writes += 1
+                self.stats.set_misses[cache_set] += 1
+                self.parent.write(block_id)
+                return
+            self.read(address)
+            slot = self.find_slot(cache_set, block_id)
+        else:
+            self.stats.write_hits += 1
+            if self.sinks:
+                self.emit(WRITE_HIT, block_id)
+            self.touch(slot, block_id)
+
+        if self.write_through:
+            self.parent.write(block_id)
+        else:
+            self.dirty_bits[slot] = 1
+
+    def read(self, address):
+        block_id = address & self.id_mask
+        cache_set = (address & self.index_mask) >> self.offset_bits
+        slot = self.hints[cache_set]
+        if self.tags[slot] != block_id:
+            slot = self.find_slot(cache_set, block_id)
+        if slot < 0:
+            self.stats.read_misses += 1
+            self.stats.set_misses[cache_set] += 1
+            if self.sinks:
+                self.emit(READ_MISS, block_id)
+            if self.inclusion == EXCLUSIVE:
+                return self.parent.read(block_id)
+            slot = self.allocate(cache_set)
+            if self.sinks:
+                self.emit(FILL, block_id)
+            if self.parent.read(block_id):
+                self.dirty_bits[slot] = 1
+            self.tags[slot] = block_id
+        else:
+            self.stats.read_hits += 1
+            if self.sinks:
+                self.emit(READ_HIT, block_id)
+            if self.inclusion == EXCLUSIVE:
+                return self.remove_slot(slot)
+        # touch, inlined for LRU as every read ends here
+        if self.policy is None:
+            if self.clock == self.stamp_limit:
+                self.renumber()
+            self.clock += 1
+            self.stamps[slot] = self.clock
+        else:
+            self.policy.touch(block_id)
 
 class RAM(object):
     """
     Represents accesses to RAM, but just prints out accesses instead of
     actually simulating anything
+
+    Accesses go to stream (sys.stdout at the time of the access if None),
+    either as "R 0x..."/"W 0x..." text lines or, if binary is set, as
+    ACCESS_RECORD records: little-endian unsigned 64 bit integers holding
+    address << 1 | is_write, the same on every platform. With a
+    buffer_size, accesses are collected in a preallocated ring buffer and
+    written out buffer_size at a time; call flush at the end of a run.
     """
+    ACCESS_RECORD = struct.Struct("<Q")
+
+    def __init__(self, stream=None, binary=False, buffer_size=0):
+        self.stream = stream
+        self.binary = binary
+        self.pending = 0
+        if buffer_size:
+            # A list rather than an array, as an unsigned long may be too
+            # narrow for address << 1
+            self.buffer = [0] * buffer_size
+        else:
+            self.buffer = None
+
+    def record(self, address, is_write):
+        if self.buffer is None:
+            stream = self.stream or sys.stdout
+            if self.binary:
+                stream.write(self.ACCESS_RECORD.pack(address << 1 | is_write))
+            else:
+                stream.write("%s %#010x\n" % ("RW"[is_write], address))
+        else:
+            self.buffer[self.pending] = address << 1 | is_write
+            self.pending += 1
+            if self.pending == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        """
+        Write out any accesses still held in the buffer.
+        """
+        if not self.pending:
+            return
+        stream = self.stream or sys.stdout
+        if self.pending == len(self.buffer):
+            accesses = self.buffer
+        else:
+            accesses = self.buffer[:self.pending]
+        if self.binary:
+            # ACCESS_RECORD, once per access
+            stream.write(struct.pack("<%dQ" % len(accesses), *accesses))
+        else:
+            stream.write("".join(["%s %#010x\n" % ("RW"[access & 1], access >> 1)
+                                  for access in accesses]))
+        self.pending = 0
+
     def read(self, address):
-        sys.stdout.write("R %#010x\n" % address)
+        self.record(address, 0)
         if LOGGING_ENABLED:
             sys.stderr.write("RAM: R %#010x\n" % address)
 
     def write(self, address):
-        sys.stdout.write("W %#010x\n" % address)
+        self.record(address, 1)
         if LOGGING_ENABLED:
             sys.stderr.write("RAM: W %#010x\n" % address)
 
+class NullRAM(object):
+    """
+    Stands in for RAM when only statistics are wanted: accesses are counted
+    but not written anywhere.
+    """
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+
+    def read(self, address):
+        self.reads += 1
+
+    def write(self, address):
+        self.writes += 1
+
+    def flush(self):
+        pass
+
+def random_state(rng):
+    """
+    The state of a random.Random as a dict for get_state.
+    """
+    version, internal, gauss_next = rng.getstate()
+    return {"version": version, "internal": array.array("L", internal),
+            "gauss_next": gauss_next}
+
+def set_random_state(rng, state):
+    rng.setstate((state["version"], tuple(state["internal"]), state["gauss_next"]))
+
 class LRUPolicy(object):
     """
     Implements a true least recently used block replacement policy
+
+    Each block is stamped with a monotonically increasing counter when it is
+    touched, so touching is a single dict store and eviction only has to look
+    at the stamps of the candidate blocks (one set's worth) rather than
+    scanning every block the cache level has ever seen.
     """
+    idempotent_touch = True
+    # Evictions depend only on the order blocks were last touched in
+    stack_algorithm = True
+
     def __init__(self):
-        self.access_list = []
+        self.stamps = {}
+        self.clock = 0
 
     def touch(self, item):
         """
         Record that this item was accessed.
         """
-        if item in self.access_list:
-            index = self.access_list.index(item)
-            self.access_list.append(self.access_list.pop(index))
-        else:
-            self.access_list.append(item)
+        self.clock += 1
+        self.stamps[item] = self.clock
 
     def evict(self, choices):
         """
         Given a list of candidate blocks to evict, return the block that was
         least recently used as the block to evict.
         """
-        for item in self.access_list:
-            if item in choices:
-                self.access_list.remove(item)
-                return item
-        else:
+        stamps = self.stamps
+        victim = None
+        oldest = None
+        for item in choices:
+            stamp = stamps.get(item)
+            if stamp is not None and (oldest is None or stamp < oldest):
+                victim = item
+                oldest = stamp
+        if victim is None:
             return list(choices)[0]
+        del stamps[victim]
+        return victim
+
+    def remove(self, item):
+        """
+        Forget an item that has left the cache without being evicted.
+        """
+        self.stamps.pop(item, None)
 
     def clear(self):
         """
         Reset our access time information to a clean slate.
         """
-        self.access_list = []
+        self.stamps.clear()
+        self.clock = 0
+
+    def get_state(self):
+        return {"clock": self.clock, "items": array.array("L", self.stamps.keys()),
+                "stamps": array.array("L", self.stamps.values())}
+
+    def set_state(self, state):
+        self.clock = state["clock"]
+        self.stamps = dict(zip(state["items"], state["stamps"]))
+
+class RandomPolicy(object):
+    """
+    Evicts a uniformly random block from the set, using its own seeded
+    random number generator so that runs are reproducible. The candidates
+    are sorted first so that the choice does not depend on the order the
+    cache happens to store them in.
+    """
+    idempotent_touch = True
+
+    def __init__(self, seed=0):
+        self.seed = seed
+        self.clear()
+
+    def touch(self, item):
+        pass
+
+    def remove(self, item):
+        pass
+
+    def evict(self, choices):
+        return self.rng.choice(sorted(choices))
+
+    def clear(self):
+        self.rng = random.Random(self.seed)
+
+    def get_state(self):
+        return {"rng": random_state(self.rng)}
+
+    def set_state(self, state):
+        set_random_state(self.rng, state["rng"])
+
+class WayPolicy(object):
+    """
+    Base class for replacement policies that, like real hardware, keep a few
+    bits of state per set or per way rather than per block.
+
+    The cache calls bind when it is given the policy, so the policy knows the
+    cache's geometry. WayPolicy tracks which way each resident block occupies
+    and turns touch and evict into calls to the subclass's fill, hit and
+    victim methods, which take a set number and a way.
+
+    Subclasses list the attributes holding their per-set or per-way state in
+    STATE so that it is included in checkpoints.
+    """
+    idempotent_touch = True
+    STATE = ()
+
+    def bind(self, cache):
+        self.assoc = cache.associativity
+        self.set_count = 2**cache.index_bits
+        self.index_mask = cache.index_mask
+        self.offset_bits = cache.offset_bits
+        self.clear()
+
+    def clear(self):
+        self.slots = {}
+        self.resident = [None] * (self.set_count * self.assoc)
+
+    def touch(self, item):
+        """
+        Record that this item was accessed.
+        """
+        cache_set = (item & self.index_mask) >> self.offset_bits
+        slot = self.slots.get(item)
+        if slot is None:
+            base = cache_set * self.assoc
+            slot = self.resident.index(None, base, base + self.assoc)
+            self.resident[slot] = item
+            self.slots[item] = slot
+            self.fill(cache_set, slot - base)
+        else:
+            self.hit(cache_set, slot - cache_set * self.assoc)
+
+    def evict(self, choices):
+        """
+        Given the blocks in a full set, pick the one to evict.
+        """
+        cache_set = (choices[0] & self.index_mask) >> self.offset_bits
+        slot = cache_set * self.assoc + self.victim(cache_set)
+        item = self.resident[slot]
+        self.resident[slot] = None
+        del self.slots[item]
+        return item
+
+    def remove(self, item):
+        """
+        Free the way of an item that has left the cache without being evicted.
+        """
+        slot = self.slots.pop(item, None)
+        if slot is not None:
+            self.resident[slot] = None
+
+    def fill(self, cache_set, way):
+        self.hit(cache_set, way)
+
+    def get_state(self):
+        state = dict((name, getattr(self, name)) for name in self.STATE)
+        state["resident"] = array.array("l", [-1 if item is None else item
+                                              for item in self.resident])
+        return state
+
+    def set_state(self, state):
+        self.resident = [None if item < 0 else item for item in state["resident"]]
+        self.slots = dict((item, slot) for (slot, item) in enumerate(self.resident)
+                          if item is not None)
+        for name in self.STATE:
+            setattr(self, name, state[name])
+
+class TreePLRUPolicy(WayPolicy):
+    """
+    Tree pseudo-LRU: each set has assoc - 1 bits forming a binary tree over
+    its ways, and every access flips the bits on its path to point away from
+    it. The victim is found by following the bits from the root. The
+    associativity must be a power of two.
+    """
+    STATE = ("bits",)
+
+    def bind(self, cache):
+        if cache.associativity & (cache.associativity - 1):
+            raise ValueError("Tree PLRU needs a power of two associativity")
+        WayPolicy.bind(self, cache)
+
+    def clear(self):
+        WayPolicy.clear(self)
+        self.bits = array.array("L", [0]) * self.set_count
+
+    def hit(self, cache_set, way):
+        bits = self.bits[cache_set]
+        node = self.assoc + way
+        while node > 1:
+            parent = node >> 1
+            if node & 1:
+                bits &= ~(1 << parent)
+            else:
+                bits |= 1 << parent
+            node = parent
+        self.bits[cache_set] = bits
+
+    def victim(self, cache_set):
+        bits = self.bits[cache_set]
+        node = 1
+        while node < self.assoc:
+            node = 2 * node + ((bits >> node) & 1)
+        return node - self.assoc
+
+class ClockPolicy(WayPolicy):
+    """
+    Clock (second chance): every access sets the way's reference bit, and
+    the per-set hand sweeps past referenced ways, clearing their bits, until
+    it finds one that has not been referenced since the last sweep.
+    """
+    STATE = ("referenced", "hands")
+
+    def clear(self):
+        WayPolicy.clear(self)
+        self.referenced = bytearray(self.set_count * self.assoc)
+        self.hands = array.array("L", [0]) * self.set_count
+
+    def hit(self, cache_set, way):
+        self.referenced[cache_set * self.assoc + way] = 1
+
+    def victim(self, cache_set):
+        base = cache_set * self.assoc
+        hand = self.hands[cache_set]
+        while self.referenced[base + hand]:
+            self.referenced[base + hand] = 0
+            hand = (hand + 1) % self.assoc
+        self.hands[cache_set] = (hand + 1) % self.assoc
+        return hand
+
+class SRRIPPolicy(WayPolicy):
+    """
+    Static re-reference interval prediction (Jaleel et al., ISCA 2010). Each
+    way has an rrpv_bits wide re-reference prediction value: blocks are
+    inserted with a long predicted interval, promoted to 0 on a hit, and the
+    victim is the first way predicted to be re-referenced in the distant
+    future, ageing the whole set until one is.
+    """
+    idempotent_touch = False
+    STATE = ("rrpv",)
+
+    def __init__(self, rrpv_bits=2):
+        self.distant = (1 << rrpv_bits) - 1
+
+    def clear(self):
+        WayPolicy.clear(self)
+        self.rrpv = bytearray([self.distant]) * (self.set_count * self.assoc)
+
+    def fill(self, cache_set, way):
+        self.rrpv[cache_set * self.assoc + way] = self.insertion_rrpv()
+
+    def insertion_rrpv(self):
+        return self.distant - 1
+
+    def hit(self, cache_set, way):
+        self.rrpv[cache_set * self.assoc + way] = 0
+
+    def victim(self, cache_set):
+        base = cache_set * self.assoc
+        ways = self.rrpv[base:base + self.assoc]
+        oldest = max(ways)
+        if oldest < self.distant:
+            ways = bytearray(rrpv + self.distant - oldest for rrpv in ways)
+            self.rrpv[base:base + self.assoc] = ways
+        return ways.index(bytearray([self.distant]))
+
+class BRRIPPolicy(SRRIPPolicy):
+    """
+    Bimodal RRIP: like SRRIP, but blocks are inserted with a distant
+    re-reference prediction except for a random one in every 1/epsilon, which
+    gets SRRIP's long one. This keeps scanning workloads from thrashing.
+    """
+    def __init__(self, rrpv_bits=2, epsilon=1.0/32, seed=0):
+        SRRIPPolicy.__init__(self, rrpv_bits)
+        self.epsilon = epsilon
+        self.seed = seed
+
+    def clear(self):
+        SRRIPPolicy.clear(self)
+        self.rng = random.Random(self.seed)
+
+    def get_state(self):
+        state = SRRIPPolicy.get_state(self)
+        state["rng"] = random_state(self.rng)
+        return state
+
+    def set_state(self, state):
+        SRRIPPolicy.set_state(self, state)
+        set_random_state(self.rng, state["rng"])
+
+    def insertion_rrpv(self):
+        if self.rng.random() < self.epsilon:
+            return self.distant - 1
+        return self.distant
+
+# Replacement policies by the names used in configurations
+POLICIES = {
+    "lru": LRUPolicy,
+    "plru": TreePLRUPolicy,
+    "clock": ClockPolicy,
+    "srrip": SRRIPPolicy,
+    "brrip": BRRIPPolicy,
+    "random": RandomPolicy,
+}
+
+class Hierarchy(object):
+    """
+    A cache hierarchy built from a declarative spec, a dict (or the same
+    thing loaded from JSON) of the form
+
+    {"total_bits": 32, "offset_bits": 6,
+     "levels": [{"name": "L1", "assoc": 8, "size": 32768, "parent": "L2"},
+                {"name": "L2", "assoc": 16, "index_bits": 12,
+                 "policy": "srrip", "inclusion": "inclusive"}],
+     "instruction": "L1", "data": "L1"}
+
+    Each level gives its name, associativity and either index_bits or its
+    size in bytes, and optionally its replacement policy (a POLICIES name,
+    LRU by default), its inclusion policy (INCLUSIVE, EXCLUSIVE or NINE, the
+    default), "write": "through" and "write_allocate": false. The parent of a
+    level is the named level, or ram if it has none. Instruction fetches go
+    to the "instruction" level and data accesses to the "data" level, both
+    defaulting to the first level.
+
+    Every level above an inclusive level, and the levels directly above an
+    exclusive one, must use its block size (offset_bits, which defaults to
+    the top level value).
+    policies maps level names to policy objects that override the spec.
+    """
+    def __init__(self, spec, compact=False, snapshot_interval=0, ram=None, policies=None):
+        self.total_bits = spec.get("total_bits", 32)
+        self.offset_bits = spec.get("offset_bits", 6)
+        self.compact = compact
+        policies = policies or {}
+
+        self.by_name = {}
+        self.level_list = []
+        for level_spec in spec["levels"]:
+            level = self.make_level(level_spec, policies.get(str(level_spec["name"])))
+            if level.name in self.by_name:
+                raise ValueError("Duplicate cache level %s" % level.name)
+            self.by_name[level.name] = level
+            self.level_list.append(level)
+        if not self.level_list:
+            raise ValueError("A hierarchy needs at least one cache level")
+
+        self.ram = ram or RAM()
+        for level_spec, level in zip(spec["levels"], self.level_list):
+            if "parent" in level_spec:
+                level.set_parent(self.level(level_spec["parent"]))
+            else:
+                level.set_parent(self.ram)
+        self.inst_level = self.level(spec.get("instruction", self.level_list[0].name))
+        self.data_level = self.level(spec.get("data", self.level_list[0].name))
+        self.check()
+
+        # Take a snapshot of the statistics every snapshot_interval references
+        self.snapshot_interval = snapshot_interval
+        self.references = 0
+        self.snapshots = []
+
+    def make_level(self, level_spec, policy=None):
+        """
+        Build one cache level from its spec, using compact array storage if
+        requested. The level uses LRU replacement unless another policy is
+        named or given.
+        """
+        name = str(level_spec["name"])
+        assoc = level_spec["assoc"]
+        offset_bits = level_spec.get("offset_bits", self.offset_bits)
+        if "index_bits" in level_spec:
+            index_bits = level_spec["index_bits"]
+        else:
+            sets = level_spec["size"] // (assoc << offset_bits)
+            index_bits = sets.bit_length() - 1
+            if sets < 1 or sets != 1 << index_bits:
+                raise ValueError("%s does not have a power of two number of sets" % name)
+        tag_bits = self.total_bits - index_bits - offset_bits
+        if tag_bits < 0:
+            raise ValueError("%s needs more than %d address bits" % (name, self.total_bits))
+
+        policy_name = level_spec.get("policy", "lru")
+        if policy is None:
+            if policy_name not in POLICIES:
+                raise ValueError("Unknown replacement policy %s for %s" % (policy_name, name))
+            if not (self.compact and policy_name == "lru"):
+                policy = POLICIES[policy_name]()
+        inclusion = level_spec.get("inclusion", NINE)
+        if inclusion not in (INCLUSIVE, EXCLUSIVE, NINE):
+            raise ValueError("Unknown inclusion policy %s for %s" % (inclusion, name))
+        write = level_spec.get("write", "back")
+        if write not in ("back", "through"):
+            raise ValueError("Unknown write policy %s for %s" % (write, name))
 
-#class ClockPolicy(object):
-#    def __init__(self, n):
-#        self.n = n
-#        self.
+        cache_class = CompactNWayCache if self.compact else NWayCache
+        level = cache_class(assoc, tag_bits, index_bits, offset_bits, policy, inclusion,
+                            write == "through", level_spec.get("write_allocate", True))
+        level.set_name(name)
+        return level
 
-class NehalemCache(object):
+    def level(self, name):
+        if name not in self.by_name:
+            raise ValueError("No cache level named %s" % name)
+        return self.by_name[name]
+
+    def check(self):
+        """
+        Make sure the levels form a tree below the entry levels and that the
+        inclusion policies can be honoured.
+        """
+        for level in self.level_list:
+            seen = set([level.name])
+            parent = level.parent
+            while parent in self.level_list:
+                if parent.name in seen:
+                    raise ValueError("Cache levels %s form a cycle" % ", ".join(sorted(seen)))
+                seen.add(parent.name)
+                parent = parent.parent
+            if level.inclusion == EXCLUSIVE and not level.children:
+                raise ValueError("Exclusive level %s has no levels above it" % level.name)
+            above = list(level.children)
+            for child in above:
+                if child.offset_bits != level.offset_bits and level.inclusion != NINE:
+                    raise ValueError("%s and %s have different block sizes" %
+                                     (child.name, level.name))
+                if level.inclusion == INCLUSIVE:
+                    above.extend(child.children)
+
+    def access(self, ref):
+        ref_type, ref_addr, ref_length = ref
+        if ref_type == "I":
+            simulate = self.inst_level.read
+        elif ref_type == "S" or ref_type == "M":
+            simulate = self.data_level.write
+        else:
+            simulate = self.data_level.read
+        if ref_length > 0:
+            simulate(ref_addr)
+            offset_bits = self.offset_bits
+            for addr in xrange(((ref_addr >> offset_bits) + 1) << offset_bits,
+                               ref_addr + ref_length, 1 << offset_bits):
+                simulate(addr)
+        self.references += 1
+        if self.snapshot_interval and self.references % self.snapshot_interval == 0:
+            self.snapshot()
+
+    def levels(self):
+        return list(self.level_list)
+
+    def subscribe(self, sink):
+        """
+        Attach an event sink to every level of the hierarchy.
+        """
+        for level in self.levels():
+            level.subscribe(sink)
+
+    def unsubscribe(self, sink):
+        for level in self.levels():
+            level.unsubscribe(sink)
+
+    def simulate_batch(self, refs, chunk_size=1 << 16):
+        """
+        Simulate a REF_DTYPE array of references, equivalent to calling
+        access on each of them in turn. References are split into block
+        accesses chunk_size references at a time and passed to
+        simulate_accesses.
+        """
+        states = self.filter_states()
+        start = 0
+        while start < len(refs):
+            end = min(start + chunk_size, len(refs))
+            if self.snapshot_interval:
+                end = min(end, start + self.snapshot_interval -
+                          self.references % self.snapshot_interval)
+            kinds, blocks = batch_accesses(refs[start:end], self.offset_bits)
+            self.simulate_accesses(kinds, blocks, states)
+
+            self.references += end - start
+            if self.snapshot_interval and self.references % self.snapshot_interval == 0:
+                self.snapshot()
+            start = end
+
+    def entry_levels(self):
+        if self.inst_level is self.data_level:
+            return [self.inst_level]
+        return [self.inst_level, self.data_level]
+
+    def filter_states(self):
+        """
+        Fresh NWayCache.filter_accesses state for each entry level.
+        """
+        return [level.new_filter_state() for level in self.entry_levels()]
+
+    def simulate_accesses(self, kinds, blocks, states=None):
+        """
+        Simulate block accesses as returned by batch_accesses. Accesses that
+        are certain to be hits in the entry level are dropped in bulk (see
+        NWayCache.filter_accesses), and only the remaining accesses go
+        through the normal per-access path, with the dropped hits that change
+        the replacement state replayed in between. Nothing is dropped for an
+        entry level that has an event sink attached or a policy for which
+        this is not safe (see repeats_are_hits).
+
+        states carries the filter state from one call to the next; see
+        filter_states. It does not count towards references or snapshots.
+        """
+        entries = self.entry_levels()
+        if states is None:
+            states = self.filter_states()
+        keep = numpy.ones(len(blocks), dtype=bool)
+        inst = kinds == 0
+        if len(entries) == 1:
+            masks = [numpy.ones(len(blocks), dtype=bool)]
+        else:
+            masks = [inst, ~inst]
+        # Operations 0 to 2 are the access kinds, then come the hit replayers
+        # of the entry levels that need them
+        handlers = [self.inst_level.read, self.data_level.read, self.data_level.write]
+        replays = []
+        for level, state, mask in zip(entries, states, masks):
+            if level.repeats_are_hits():
+                pos = numpy.flatnonzero(mask)
+                keep[pos], level_replays = level.filter_accesses(blocks[pos], kinds[pos] == 2,
+                                                                 state)
+                if level_replays is not None:
+                    anchors, replayed, touch, dirty = level_replays
+                    replays.append((pos[anchors], replayed & level.id_mask, touch, dirty,
+                                    len(handlers)))
+                    handlers.extend(level.hit_replayers())
+        index = numpy.flatnonzero(keep)
+
+        # The dropped accesses were all hits
+        dropped = kinds[~keep]
+        self.inst_level.stats.read_hits += int(numpy.count_nonzero(dropped == 0))
+        self.data_level.stats.read_hits += int(numpy.count_nonzero(dropped == 1))
+        self.data_level.stats.write_hits += int(numpy.count_nonzero(dropped == 2))
+
+        ops, addrs = interleave_replays(index, kinds[index], blocks[index], replays)
+        for op, addr in zip(ops, addrs):
+            handlers[op](addr)
+
+    def stats(self, histogram=False):
+        """
+        Returns the statistics of every level, keyed by level name.
+        """
+        return dict((level.name, level.stats.as_dict(histogram)) for level in self.levels())
+
+    def snapshot(self):
+        """
+        Record the statistics of every level at the current point in the trace.
+        """
+        self.snapshots.append({"references": self.references, "levels": self.stats()})
+
+    def write_stats_json(self, f):
+        """
+        Write the final statistics, including per-set eviction histograms, and
+        all snapshots taken along the way as JSON.
+        """
+        json.dump({"references": self.references,
+                   "levels": self.stats(histogram=True),
+                   "snapshots": self.snapshots}, f, sort_keys=True)
+
+    def write_stats_csv(self, f):
+        """
+        Write one row per level for every snapshot and for the final
+        statistics as CSV.
+        """
+        writer = csv.writer(f, lineterminator="\n")
+        columns = ("accesses", "miss_rate") + CacheStats.COUNTERS
+        writer.writerow(("references", "level") + columns)
+        rows = list(self.snapshots)
+        if not rows or rows[-1]["references"] != self.references:
+            rows.append({"references": self.references, "levels": self.stats()})
+        for row in rows:
+            for level in self.levels():
+                counters = row["levels"][level.name]
+                writer.writerow([row["references"], level.name] +
+                                [counters[column] for column in columns])
+
+    def get_state(self):
+        """
+        Returns the state of every level, the number of references simulated
+        and the snapshots taken so far (see checkpoint.py).
+        """
+        return {"references": self.references, "snapshots": self.snapshots,
+                "levels": dict((level.name, level.get_state()) for level in self.levels())}
+
+    def set_state(self, state):
+        if sorted(state["levels"]) != sorted(self.by_name):
+            raise ValueError("State has levels %s, not %s" %
+                             (", ".join(sorted(state["levels"])), ", ".join(sorted(self.by_name))))
+        for level in self.levels():
+            level.set_state(state["levels"][level.name])
+        self.references = state["references"]
+        self.snapshots = state["snapshots"]
+
+    def clear(self):
+        for level in self.levels():
+            level.clear()
+
+NEHALEM = {
+    "total_bits": 32,
+    "offset_bits": 6,
+    "levels": [
+        {"name": "L1I", "assoc": 4, "index_bits": 7, "parent": "L2"},
+        {"name": "L1D", "assoc": 8, "index_bits": 6, "parent": "L2"},
+        {"name": "L2", "assoc": 8, "index_bits": 12, "parent": "L3"},
+        # The replacement policy for L3 is not disclosed in the textbook...
+        {"name": "L3", "assoc": 16, "index_bits": 17},
+    ],
+    "instruction": "L1I",
+    "data": "L1D",
+}
+
+class NehalemCache(Hierarchy):
     """ Nehalem Specs
     block size 64 bytes = 0x40
     L1 32 KB Instruction Cache -> 512 entries              O:6
@@ -253,61 +1805,92 @@ class NehalemCache(object):
     L2 256 KB Unified Cache    -> 4096 entries   T:19 I:7  O:6
     L3 8192 KB Unified Cache   -> 131072 entries T:14 I:12 O:6 
     """
-    def __init__(self):
-        self.total_bits = 32
-        self.offset_bits = 6
-        self.L1I_cache = NWayCache(4, self.total_bits - 7 - self.offset_bits, 7, self.offset_bits,
-                              LRUPolicy())
-        self.L1D_cache = NWayCache(8, self.total_bits - 6 - self.offset_bits, 6, self.offset_bits,
-                              LRUPolicy())
+    def __init__(self, compact=False, snapshot_interval=0, ram=None, l3_policy=None):
+        Hierarchy.__init__(self, NEHALEM, compact, snapshot_interval, ram, {"L3": l3_policy})
+        self.L1I_cache = self.level("L1I")
+        self.L1D_cache = self.level("L1D")
+        self.L2_cache = self.level("L2")
+        self.L3_cache = self.level("L3")
 
-        self.L2_cache = NWayCache(8, self.total_bits - 12 - self.offset_bits, 12, self.offset_bits,
-                             LRUPolicy())
+if __name__ == "__main__":
+    output = os.environ.get("OUTPUT", "text").lower()
+    if output == "count":
+        ram = NullRAM()
+    else:
+        ram = RAM(binary=(output == "binary"), buffer_size=1 << 16)
+    compact = os.environ.get("COMPACT", "false").lower() == "true"
+    snapshot_interval = int(os.environ.get("STATS_INTERVAL", "0"))
+    if os.environ.get("HIERARCHY"):
+        # A JSON hierarchy spec in place of the Nehalem one
+        with open(os.environ["HIERARCHY"]) as f:
+            cache = Hierarchy(json.load(f), compact, snapshot_interval, ram)
+    else:
+        cache = NehalemCache(compact, snapshot_interval, ram)
+    stats_filename = os.environ.get("STATS")
 
-        #The replacement policy for L3 is not disclosed in the textbook...
-        self.L3_cache = NWayCache(16, self.total_bits - 17 - self.offset_bits, 17, self.offset_bits,
-                             LRUPolicy())
+    # Checkpoints are written to CHECKPOINT every CHECKPOINT_INTERVAL
+    # references and at the end, and a run can start from one with RESUME
+    # (see checkpoint.py). A resumed run skips the references the
+    # checkpoint has already seen and appends to the earlier output.
+    checkpoint_filename = os.environ.get("CHECKPOINT")
+    checkpoint_interval = int(os.environ.get("CHECKPOINT_INTERVAL", "0"))
+    if checkpoint_filename or os.environ.get("RESUME"):
+        import checkpoint
+    if os.environ.get("RESUME"):
+        checkpoint.load_file(cache, os.environ["RESUME"])
+    skip = cache.references
 
-        self.ram = RAM()
-        
-        self.L1I_cache.set_parent(self.L2_cache)
-        self.L1D_cache.set_parent(self.L2_cache)
-        self.L2_cache.set_parent(self.L3_cache)
-        self.L3_cache.set_parent(self.ram)
-
-        self.L1I_cache.set_name("L1I")
-        self.L1D_cache.set_name("L1D")
-        self.L2_cache.set_name("L2")
-        self.L3_cache.set_name("L3")
-    
-    def access(self, ref):
-        for (op, addr) in generate_accesses(ref, self.offset_bits, False):
-            if op == "I":
-                self.L1I_cache.read(addr)
-            elif op == "R":
-                self.L1D_cache.read(addr)
-            elif op == "W":
-                self.L1D_cache.write(addr)
-            else:
-                raise Exception("Invalid operation: %s" % op)
+    def checkpoint_due():
+        if (checkpoint_filename and checkpoint_interval and
+                cache.references % checkpoint_interval == 0):
+            ram.flush()
+            checkpoint.save_file(cache, checkpoint_filename)
 
-    def clear(self):
-        self.L1I_cache.clear()
-        self.L1D_cache.clear()
-        self.L2_cache.clear()
-        self.L3_cache.clear()
+    if len(sys.argv) > 1:
+        # A binary trace written by tracefile.py
+        from tracefile import TraceReader
+        trace = TraceReader(sys.argv[1])
+        if numpy is not None:
+            for refs in trace.arrays(skip=skip):
+                while len(refs):
+                    count = len(refs)
+                    if checkpoint_filename and checkpoint_interval:
+                        count = min(count, checkpoint_interval -
+                                    cache.references % checkpoint_interval)
+                    cache.simulate_batch(refs[:count])
+                    refs = refs[count:]
+                    checkpoint_due()
+        else:
+            for ref in trace.references(skip):
+                cache.access(ref)
+                checkpoint_due()
+        trace.close()
+    else:
+        for line in sys.stdin:
+            if line.startswith("=="):
+                continue
+            if skip:
+                skip -= 1
+                continue
+            try:
+                ref = parse_reference(line)
+            except:
+                sys.stderr.write("Error parsing lackey memory reference:\n")
+                sys.stderr.write(line)
+                import traceback
+                traceback.print_exc(3, sys.stderr)
+                ram.flush()
+                sys.exit(0)
+            cache.access(ref)
+            checkpoint_due()
 
-if __name__ == "__main__":
-    cache = NehalemCache()
-    for line in sys.stdin:
-        if line.startswith("=="):
-            continue
-        try:
-            ref = parse_reference(line)
-        except:
-            sys.stderr.write("Error parsing lackey memory reference:\n")
-            sys.stderr.write(line)
-            import traceback
-            traceback.print_exc(3, sys.stderr)
-            sys.exit(0)
-        cache.access(ref)
+    ram.flush()
+    if checkpoint_filename:
+        checkpoint.save_file(cache, checkpoint_filename)
+
+    if stats_filename:
+        with open(stats_filename, "w") as f:
+            if stats_filename.endswith(".csv"):
+                cache.write_stats_csv(f)
+            else:
+                cache.write_stats_json(f)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Checkpoints of a simulated cache hierarchy, so that a long run can be
+resumed after it is interrupted, or a cache warmed up once and then used as
+the starting point of many experiments.
+
+A checkpoint holds the get_state() of a Hierarchy (or a single NWayCache):
+the contents, dirty bits, replacement policy state and statistics of every
+level plus the number of references simulated so far, which is also the
+position to resume the trace from. The state is a tree of dicts of JSON
+values and arrays. The arrays are stored after the JSON as zlib compressed
+raw machine values, so restoring one is a decompress and a copy rather than
+a parse, and the JSON refers to them by number.
+
+A file is a HEADER (magic, version, JSON length) followed by the JSON, then
+the arrays in order.
+
+Usage: ./checkpoint.py checkpoint_file
+       prints the position and statistics stored in a checkpoint
+"""
+import array
+import json
+import os
+import struct
+import sys
+import zlib
+
+MAGIC = "MAPCKPNT"
+VERSION = 1
+
+HEADER = struct.Struct("<8sB3xI")
+
+def flatten(value, arrays):
+    """
+    Replace the arrays and bytearrays in a state tree with references to
+    their position in arrays, which they are appended to.
+    """
+    if isinstance(value, dict):
+        return dict((key, flatten(item, arrays)) for (key, item) in value.iteritems())
+    if isinstance(value, list):
+        return [flatten(item, arrays) for item in value]
+    if isinstance(value, bytearray):
+        arrays.append(value)
+        return {"__array__": len(arrays) - 1, "typecode": "bytearray"}
+    if isinstance(value, array.array):
+        arrays.append(value)
+        return {"__array__": len(arrays) - 1, "typecode": value.typecode,
+                "itemsize": value.itemsize}
+    return value
+
+def unflatten(value, arrays):
+    if isinstance(value, dict):
+        if "__array__" in value:
+            return arrays[value["__array__"]]
+        return dict((key, unflatten(item, arrays)) for (key, item) in value.iteritems())
+    if isinstance(value, list):
+        return [unflatten(item, arrays) for item in value]
+    return value
+
+def save(cache, f):
+    """
+    Write a checkpoint of cache to the file object f.
+    """
+    arrays = []
+    state = flatten(cache.get_state(), arrays)
+    sizes = []
+    chunks = []
+    for value in arrays:
+        chunk = zlib.compress(str(value) if isinstance(value, bytearray) else value.tostring(), 1)
+        sizes.append(len(chunk))
+        chunks.append(chunk)
+    header = json.dumps({"state": state, "sizes": sizes, "byteorder": sys.byteorder},
+                        sort_keys=True)
+    f.write(HEADER.pack(MAGIC, VERSION, len(header)))
+    f.write(header)
+    for chunk in chunks:
+        f.write(chunk)
+
+def load(cache, f):
+    """
+    Restore the state of cache from a checkpoint read from the file object
+    f. The cache must have been built the same way as the one saved.
+    Returns the number of references simulated before the checkpoint.
+    """
+    state = read_state(f)
+    cache.set_state(state)
+    return state.get("references", 0)
+
+def find_arrays(value, descriptions):
+    """
+    Collect the array references in a flattened state tree.
+    """
+    if isinstance(value, dict):
+        if "__array__" in value:
+            descriptions.append(value)
+        else:
+            for item in value.itervalues():
+                find_arrays(item, descriptions)
+    elif isinstance(value, list):
+        for item in value:
+            find_arrays(item, descriptions)
+
+def read_state(f):
+    """
+    Read the state tree out of a checkpoint without restoring it.
+    """
+    magic, version, length = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a version %d checkpoint" % VERSION)
+    header = json.loads(f.read(length))
+    if header["byteorder"] != sys.byteorder:
+        raise ValueError("Checkpoint was written on a %s endian machine" % header["byteorder"])
+
+    descriptions = []
+    find_arrays(header["state"], descriptions)
+    descriptions.sort(key=lambda description: description["__array__"])
+    arrays = []
+    for description, size in zip(descriptions, header["sizes"]):
+        data = zlib.decompress(f.read(size))
+        if description["typecode"] == "bytearray":
+            arrays.append(bytearray(data))
+        else:
+            value = array.array(str(description["typecode"]))
+            if value.itemsize != description["itemsize"]:
+                raise ValueError("Checkpoint arrays of type %s have a different size here" %
+                                 description["typecode"])
+            value.fromstring(data)
+            arrays.append(value)
+    return unflatten(header["state"], arrays)
+
+def save_file(cache, filename):
+    """
+    Checkpoint cache to filename, replacing it atomically so that a crash
+    part way through leaves the previous checkpoint intact.
+    """
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        save(cache, f)
+    os.rename(temp_filename, filename)
+
+def load_file(cache, filename):
+    with open(filename, "rb") as f:
+        return load(cache, f)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage: ./checkpoint.py checkpoint_file"
+        sys.exit(1)
+    with open(sys.argv[1], "rb") as f:
+        state = read_state(f)
+    print "references: %d" % state["references"]
+    for name, level in sorted(state["levels"].iteritems()):
+        stats = level["stats"]
+        print "%s: %s" % (name, ", ".join("%s=%d" % (counter, stats[counter]) for counter
+                                          in sorted(stats) if not counter.startswith("set_")))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+Multi-process simulation of a single trace.
+
+A lone NWayCache has no state shared between sets, so its block accesses can
+be split by set index across worker processes. Each worker records what it
+sends to its parent together with the position of the access that caused it
+in the trace, and the records are merged back into trace order.
+
+The levels of a NehalemCache only ever pass accesses downwards, so they can
+be run as a pipeline instead: one process for the two L1 caches, one for L2
+and one for L3, each feeding the accesses it makes to the next.
+
+Both modes need NumPy and a binary trace file written by tracefile.py, which
+every worker memory maps for itself. The output is the same RAM access
+stream cachem.py prints.
+
+Usage: ./parallel.py trace_file assoc index_bits [offset_bits [workers]]
+       ./parallel.py trace_file nehalem
+"""
+import array
+import multiprocessing
+import sys
+
+from cachem import *
+from sweep import build, grid
+from tracefile import TraceReader
+
+class RecordingMemory(object):
+    """
+    A parent that records the accesses made to it, as address << 1 | is_write
+    values, tagged with the current value of seq.
+    """
+    def __init__(self):
+        self.seq = 0
+        self.seqs = array.array("L")
+        self.accesses = array.array("L")
+
+    def read(self, address):
+        self.seqs.append(self.seq)
+        self.accesses.append(address << 1)
+
+    def write(self, address):
+        self.seqs.append(self.seq)
+        self.accesses.append(address << 1 | 1)
+
+    def take(self):
+        """
+        Return and forget the accesses recorded so far.
+        """
+        accesses = self.accesses
+        self.seqs = array.array("L")
+        self.accesses = array.array("L")
+        return accesses
+
+def replay(accesses, target):
+    """
+    Send address << 1 | is_write values to a cache level or RAM.
+    """
+    read = target.read
+    write = target.write
+    for access in accesses:
+        if access & 1:
+            write(access >> 1)
+        else:
+            read(access >> 1)
+
+def merge_stats(stats):
+    """
+    Add up the CacheStats.as_dict(histogram=True) dicts of several shards.
+    """
+    total = dict((counter, 0) for counter in CacheStats.COUNTERS)
+    for histogram in CacheStats.HISTOGRAMS:
+        total[histogram] = [0] * len(stats[0][histogram])
+    for shard in stats:
+        for counter in CacheStats.COUNTERS:
+            total[counter] += shard[counter]
+        for histogram in CacheStats.HISTOGRAMS:
+            for i, count in enumerate(shard[histogram]):
+                total[histogram][i] += count
+    stats = CacheStats(0)
+    stats.set_state(total)
+    return stats.as_dict(histogram=True)
+
+def run_shard(job):
+    """
+    Simulate the sets of one shard and return the parent accesses they made,
+    with the sequence numbers of the block accesses that caused them.
+    """
+    config, filename, shard, shards = job
+    cache = build(config)
+    recorder = RecordingMemory()
+    cache.set_parent(recorder)
+    state = (numpy.full(2**cache.index_bits, -1, dtype=numpy.int64),
+             numpy.zeros(2**cache.index_bits, dtype=bool))
+
+    trace = TraceReader(filename)
+    seq = 0
+    for refs in trace.arrays():
+        kinds, blocks = batch_accesses(refs, cache.offset_bits)
+        sets = (blocks & cache.index_mask) >> cache.offset_bits
+        mine = numpy.flatnonzero(sets % shards == shard)
+        if cache.repeats_are_hits():
+            keep = filter_mru_repeats(cache, blocks[mine], kinds[mine] == 2, *state)
+            dropped = kinds[mine[~keep]]
+            cache.stats.read_hits += int(numpy.count_nonzero(dropped != 2))
+            cache.stats.write_hits += int(numpy.count_nonzero(dropped == 2))
+            mine = mine[keep]
+
+        for i, op, addr in zip((mine + seq).tolist(), kinds[mine].tolist(),
+                               blocks[mine].tolist()):
+            recorder.seq = i
+            if op == 2:
+                cache.write(addr)
+            else:
+                cache.read(addr)
+        seq += len(blocks)
+    trace.close()
+    return recorder.seqs, recorder.accesses, cache.stats.as_dict(histogram=True)
+
+def simulate_sharded(config, filename, ram, workers=None):
+    """
+    Simulate a single cache level configuration (see sweep.grid) over a
+    trace file with its sets split across workers processes, sending its
+    accesses to ram in trace order. Returns the level's statistics.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(run_shard, [(config, filename, shard, workers)
+                                       for shard in xrange(workers)])
+    finally:
+        pool.close()
+        pool.join()
+
+    seqs = numpy.concatenate([numpy.frombuffer(result[0], dtype="L")
+                              for result in results])
+    accesses = numpy.concatenate([numpy.frombuffer(result[1], dtype="L")
+                                  for result in results])
+    # Accesses caused by the same block access all come from one shard, so a
+    # stable sort keeps them in the order they were made.
+    order = numpy.argsort(seqs, kind="mergesort")
+    replay(accesses[order].tolist(), ram)
+    return merge_stats([result[2] for result in results])
+
+def run_l1_stage(filename, compact, output, results):
+    cache = NehalemCache(compact, ram=NullRAM())
+    recorder = RecordingMemory()
+    cache.L1I_cache.set_parent(recorder)
+    cache.L1D_cache.set_parent(recorder)
+    trace = TraceReader(filename)
+    for refs in trace.arrays():
+        cache.simulate_batch(refs)
+        output.put(recorder.take())
+    trace.close()
+    output.put(None)
+    for level in (cache.L1I_cache, cache.L1D_cache):
+        results.put((level.name, level.stats.as_dict(histogram=True)))
+
+def run_level_stage(name, compact, input, output, results):
+    cache = NehalemCache(compact, ram=NullRAM())
+    level = getattr(cache, name + "_cache")
+    recorder = RecordingMemory()
+    level.set_parent(recorder)
+    for accesses in iter(input.get, None):
+        replay(accesses, level)
+        output.put(recorder.take())
+    output.put(None)
+    results.put((level.name, level.stats.as_dict(histogram=True)))
+
+def simulate_pipelined(filename, ram, compact=False):
+    """
+    Simulate the Nehalem hierarchy over a trace file with L1, L2 and L3 each
+    in their own process, sending the RAM accesses to ram. Returns the
+    statistics of every level, keyed by level name.
+    """
+    l2_input = multiprocessing.Queue(16)
+    l3_input = multiprocessing.Queue(16)
+    ram_input = multiprocessing.Queue(16)
+    results = multiprocessing.Queue()
+    stages = [
+        multiprocessing.Process(target=run_l1_stage,
+                                args=(filename, compact, l2_input, results)),
+        multiprocessing.Process(target=run_level_stage,
+                                args=("L2", compact, l2_input, l3_input, results)),
+        multiprocessing.Process(target=run_level_stage,
+                                args=("L3", compact, l3_input, ram_input, results)),
+    ]
+    for stage in stages:
+        stage.start()
+    for accesses in iter(ram_input.get, None):
+        replay(accesses, ram)
+    stats = dict(results.get() for stage in xrange(4))
+    for stage in stages:
+        stage.join()
+    return stats
+
+if __name__ == "__main__":
+    ram = RAM(buffer_size=1 << 16)
+    if len(sys.argv) == 3 and sys.argv[2] == "nehalem":
+        simulate_pipelined(sys.argv[1], ram)
+    elif 4 <= len(sys.argv) <= 6:
+        args = [int(arg) for arg in sys.argv[2:]]
+        config = grid([args[0]], [args[1]], args[2:3] or (6,))[0]
+        simulate_sharded(config, sys.argv[1], ram, *args[3:])
+    else:
+        print "Usage: ./parallel.py trace_file assoc index_bits [offset_bits [workers]]"
+        print "       ./parallel.py trace_file nehalem"
+        sys.exit(1)
+    ram.flush()
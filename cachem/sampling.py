@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""
+Sampled simulation of a cache hierarchy, trading a bounded loss of accuracy
+for speed on traces too long to simulate in full.
+
+Set sampling only simulates the block accesses whose block number has its
+low set_bits bits equal to residue. Those bits are part of the set index of
+every level, so each level sees all of the accesses to one in 2**set_bits
+of its sets and none to the rest. Counts are scaled back up by 2**set_bits,
+and the spread of the misses across the sampled sets bounds the error.
+
+Time sampling (as in SMARTS, Wunderlich et al., ISCA 2003) only measures a
+window of references at the end of every period. The references in between
+either still go through the caches without being counted (functional
+warming, which keeps the estimate unbiased but saves little here, where
+warming costs as much as measuring) or, if a warmup is given, are skipped
+except for the last warmup of them. The spread of the miss rates of the
+windows bounds the error.
+
+Needs NumPy and a binary trace file written by tracefile.py. The hierarchy
+is Nehalem unless the HIERARCHY environment variable names a JSON spec, as
+for cachem.py.
+
+Usage: ./sampling.py trace_file set_bits [period window [warmup]]
+"""
+import json
+import math
+import os
+import sys
+
+from cachem import *
+from tracefile import TraceReader
+
+# Two-sided normal critical values by confidence level
+Z_SCORES = {0.9: 1.645, 0.95: 1.96, 0.99: 2.576}
+
+class SampledSimulation(object):
+    """
+    Runs set and/or time sampling over a Hierarchy, whose output should go
+    to a NullRAM since only part of it is ever produced.
+    """
+    def __init__(self, cache, set_bits=0, period=0, window=0, warmup=None, residue=0):
+        for level in cache.levels():
+            if level.offset_bits != cache.offset_bits:
+                raise ValueError("Set sampling needs every level to use the same block size")
+            if level.index_bits < set_bits:
+                raise ValueError("%s has fewer than 2**%d sets" % (level.name, set_bits))
+        if period and not 0 < window <= period - (warmup or 0):
+            raise ValueError("The window and warmup do not fit in the period")
+        self.cache = cache
+        self.set_bits = set_bits
+        self.residue = residue
+        self.period = period
+        self.window = window
+        self.warmup = warmup
+        self.position = 0
+        self.measured = 0
+        self.states = cache.filter_states()
+
+        # (misses, accesses) of every level in each finished window
+        self.windows = []
+        self.window_start = None
+
+    def counts(self):
+        return [(level.stats.misses(), level.stats.accesses()) for level in self.cache.levels()]
+
+    def simulate(self, refs):
+        """
+        Simulate the sampled part of a REF_DTYPE array of the references
+        that follow those already simulated.
+        """
+        while len(refs):
+            count, measure, simulate = self.phase()
+            count = min(count, len(refs))
+            if measure and self.window_start is None:
+                self.window_start = self.counts()
+            if simulate:
+                kinds, blocks = batch_accesses(refs[:count], self.cache.offset_bits)
+                if self.set_bits:
+                    sampled = ((blocks >> self.cache.offset_bits) &
+                               ((1 << self.set_bits) - 1)) == self.residue
+                    kinds = kinds[sampled]
+                    blocks = blocks[sampled]
+                self.cache.simulate_accesses(kinds, blocks, self.states)
+            refs = refs[count:]
+            self.position += count
+            self.cache.references += count
+            if measure:
+                self.measured += count
+                if not self.period or self.position % self.period == 0:
+                    self.end_window()
+
+    def phase(self):
+        """
+        Returns how many references remain in the current phase of the
+        period, and whether they are to be measured and simulated.
+        """
+        if not self.period:
+            return (sys.maxint, True, True)
+        offset = self.position % self.period
+        measure_start = self.period - self.window
+        if offset >= measure_start:
+            return (self.period - offset, True, True)
+        if self.warmup is None:
+            return (measure_start - offset, False, True)
+        warmup_start = measure_start - self.warmup
+        if offset >= warmup_start:
+            return (measure_start - offset, False, True)
+        return (warmup_start - offset, False, False)
+
+    def end_window(self):
+        if self.window_start is not None:
+            self.windows.append([(misses - start_misses, accesses - start_accesses)
+                                 for ((misses, accesses), (start_misses, start_accesses))
+                                 in zip(self.counts(), self.window_start)])
+            self.window_start = None
+
+    def results(self, confidence=0.95):
+        """
+        Returns a dict per level of its estimated miss rate, the bounds of
+        the confidence interval around it (None if there is too little data)
+        and its estimated accesses and misses over the whole trace.
+
+        Time sampling intervals come from the spread of the per-window miss
+        rates. Otherwise set sampling intervals come from the spread of the
+        per-set miss counts, treating the level's access count as exact.
+        """
+        if confidence not in Z_SCORES:
+            raise ValueError("Confidence must be one of %s" % sorted(Z_SCORES))
+        z = Z_SCORES[confidence]
+        self.end_window()
+        scale = float(1 << self.set_bits)
+        if self.measured:
+            scale *= float(self.position) / self.measured
+
+        results = []
+        for i, level in enumerate(self.cache.levels()):
+            misses = numpy.array([window[i][0] for window in self.windows], dtype=float)
+            accesses = numpy.array([window[i][1] for window in self.windows], dtype=float)
+            rate = misses.sum() / accesses.sum() if accesses.sum() else 0.0
+            if self.period:
+                half = ratio_half_width(misses, accesses, z)
+            else:
+                half = set_half_width(level, self.set_bits, self.residue, z)
+            results.append({"level": level.name, "miss_rate": rate,
+                            "ci_low": None if half is None else max(rate - half, 0.0),
+                            "ci_high": None if half is None else min(rate + half, 1.0),
+                            "accesses": int(round(accesses.sum() * scale)),
+                            "misses": int(round(misses.sum() * scale))})
+        return results
+
+def ratio_half_width(misses, accesses, z):
+    """
+    Half width of the confidence interval of sum(misses) / sum(accesses)
+    over a sample of windows, using the usual ratio estimator variance.
+    """
+    n = len(misses)
+    if n < 2 or not accesses.sum():
+        return None
+    rate = misses.sum() / accesses.sum()
+    residuals = misses - rate * accesses
+    variance = (residuals ** 2).sum() / (n - 1)
+    return z * math.sqrt(variance / n) / accesses.mean()
+
+def set_half_width(level, set_bits, residue, z):
+    """
+    Half width of the confidence interval of a level's miss rate from the
+    spread of the misses across its sampled sets.
+    """
+    if not set_bits:
+        return 0.0
+    sampled = numpy.array(level.stats.set_misses[residue::1 << set_bits], dtype=float)
+    n = len(sampled)
+    if n < 2 or not level.stats.accesses():
+        return None
+    # Total over every set estimated from a simple random sample of n of
+    # them, with the finite population correction
+    total_sets = n << set_bits
+    variance = total_sets ** 2 * (1 - 1.0 / (1 << set_bits)) * sampled.var(ddof=1) / n
+    return z * math.sqrt(variance) / (level.stats.accesses() << set_bits)
+
+def run(filename, sampler):
+    trace = TraceReader(filename)
+    for refs in trace.arrays():
+        sampler.simulate(refs)
+    trace.close()
+
+if __name__ == "__main__":
+    if not 3 <= len(sys.argv) <= 6 or len(sys.argv) == 4:
+        print "Usage: ./sampling.py trace_file set_bits [period window [warmup]]"
+        sys.exit(1)
+    args = [int(arg) for arg in sys.argv[2:]]
+    compact = os.environ.get("COMPACT", "false").lower() == "true"
+    if os.environ.get("HIERARCHY"):
+        with open(os.environ["HIERARCHY"]) as f:
+            cache = Hierarchy(json.load(f), compact, ram=NullRAM())
+    else:
+        cache = NehalemCache(compact, ram=NullRAM())
+    sampler = SampledSimulation(cache, *args)
+    run(sys.argv[1], sampler)
+
+    print "level,miss_rate,ci_low,ci_high,accesses,misses"
+    for row in sampler.results():
+        print "%s,%f,%s,%s,%d,%d" % (row["level"], row["miss_rate"],
+            "" if row["ci_low"] is None else "%f" % row["ci_low"],
+            "" if row["ci_high"] is None else "%f" % row["ci_high"],
+            row["accesses"], row["misses"])
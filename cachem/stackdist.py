@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""
+One-pass LRU miss ratio curves using Mattson's stack distance algorithm.
+
+Under LRU an access hits in an assoc-way set exactly when fewer than assoc
+other blocks mapping to the same set were touched since the block was last
+used, regardless of the cache's associativity. Recording that stack distance
+for every access, once per candidate number of index bits, gives the miss
+count of every NWayCache(assoc, tag_bits, index_bits, offset_bits,
+LRUPolicy()) configuration from a single pass over the trace.
+
+Usage: ./stackdist.py [max_assoc] [binary_trace] < trace_file
+"""
+import collections
+import sys
+
+from cachem import parse_reference
+
+class ReuseStack(object):
+    """
+    The LRU stack of one cache set. Each block's most recent access time is
+    marked in a Fenwick tree, so the number of distinct blocks touched since
+    then is a prefix sum difference. The tree grows by one node per access
+    and is rebuilt over just the live marks when it gets too sparse.
+    """
+    def __init__(self):
+        self.tree = [0]
+        self.last = {}
+
+    def prefix(self, i):
+        tree = self.tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i &= i - 1
+        return total
+
+    def add(self, i, delta):
+        tree = self.tree
+        size = len(tree)
+        while i < size:
+            tree[i] += delta
+            i += i & -i
+
+    def touch(self, block):
+        """
+        Record an access to block and return its stack distance, or None if
+        it has not been seen before.
+        """
+        now = len(self.tree)
+        before = self.prefix(now - 1)
+        previous = self.last.get(block)
+        if previous is None:
+            distance = None
+        else:
+            distance = before - self.prefix(previous)
+            self.add(previous, -1)
+            before -= 1
+
+        # Append a marked node covering (now - lowbit(now), now]
+        self.tree.append(1 + before - self.prefix(now - (now & -now)))
+        self.last[block] = now
+
+        if now > 2 * len(self.last) + 64:
+            self.compact()
+        return distance
+
+    def compact(self):
+        """
+        Renumber the live marks 1..n in access order, dropping the times that
+        are no longer the latest access of any block.
+        """
+        order = sorted(self.last, key=self.last.get)
+        self.last = dict((block, i + 1) for i, block in enumerate(order))
+        self.tree = [0] + [i & -i for i in xrange(1, len(order) + 1)]
+
+class StackDistanceAnalyzer(object):
+    """
+    Collects stack distance histograms for every number of index bits in
+    index_bits_range at once.
+    """
+    def __init__(self, offset_bits=6, index_bits_range=range(0, 13)):
+        self.offset_bits = offset_bits
+        self.index_bits_range = list(index_bits_range)
+        self.stacks = dict((index_bits, collections.defaultdict(ReuseStack))
+                           for index_bits in self.index_bits_range)
+        self.histograms = dict((index_bits, collections.defaultdict(int))
+                               for index_bits in self.index_bits_range)
+        self.cold = 0
+        self.accesses = 0
+
+    def access(self, ref):
+        """
+        Record the cache block accesses generated by a memory reference.
+        """
+        ref_type, ref_addr, ref_length = ref
+        if ref_length > 0:
+            for block in xrange(ref_addr >> self.offset_bits,
+                                ((ref_addr + ref_length - 1) >> self.offset_bits) + 1):
+                self.touch(block)
+
+    def touch(self, block):
+        self.accesses += 1
+        for index_bits in self.index_bits_range:
+            cache_set = block & ((1 << index_bits) - 1)
+            distance = self.stacks[index_bits][cache_set].touch(block)
+            if distance is None:
+                if index_bits == self.index_bits_range[0]:
+                    self.cold += 1
+            else:
+                self.histograms[index_bits][distance] += 1
+
+    def misses(self, assoc, index_bits):
+        """
+        Number of misses an LRU cache with 2**index_bits sets of assoc ways
+        would have had, counting compulsory misses.
+        """
+        histogram = self.histograms[index_bits]
+        return self.cold + sum(count for (distance, count) in histogram.iteritems()
+                               if distance >= assoc)
+
+    def miss_ratio(self, assoc, index_bits):
+        if not self.accesses:
+            return 0.0
+        return float(self.misses(assoc, index_bits)) / self.accesses
+
+    def miss_ratio_curves(self, max_assoc=16):
+        """
+        Returns {index_bits: [miss ratio for assoc 1..max_assoc]}.
+        """
+        curves = {}
+        for index_bits in self.index_bits_range:
+            histogram = self.histograms[index_bits]
+            misses = self.accesses
+            curve = []
+            for assoc in xrange(1, max_assoc + 1):
+                misses -= histogram.get(assoc - 1, 0)
+                curve.append(float(misses) / self.accesses if self.accesses else 0.0)
+            curves[index_bits] = curve
+        return curves
+
+if __name__ == "__main__":
+    max_assoc = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    analyzer = StackDistanceAnalyzer()
+    if len(sys.argv) > 2:
+        from tracefile import TraceReader
+        trace = TraceReader(sys.argv[2])
+        for ref in trace:
+            analyzer.access(ref)
+        trace.close()
+    else:
+        for line in sys.stdin:
+            if line.startswith("=="):
+                continue
+            analyzer.access(parse_reference(line))
+
+    print "index_bits,sets,assoc,size_bytes,misses,miss_ratio"
+    curves = analyzer.miss_ratio_curves(max_assoc)
+    for index_bits in analyzer.index_bits_range:
+        for assoc, ratio in enumerate(curves[index_bits], 1):
+            print "%d,%d,%d,%d,%d,%f" % (index_bits, 2**index_bits, assoc,
+                (assoc << index_bits) << analyzer.offset_bits,
+                analyzer.misses(assoc, index_bits), ratio)
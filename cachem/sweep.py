@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Runs a grid of cache configurations over one binary trace file in parallel
+and collects their statistics into a single CSV table.
+
+Every worker process memory maps the trace itself, so the trace is shared
+read-only through the page cache instead of being re-read for each
+configuration.
+
+Usage: ./sweep.py trace_file assoc_list index_bits_list [offset_bits_list [policy_list]]
+       ./sweep.py trace_file nehalem [l3_policy_list]
+       ./sweep.py trace_file hierarchy spec_file...
+
+Lists are comma separated, e.g. ./sweep.py trace.bin 1,2,4,8 6,8,10 6 lru,plru
+Policies are named as in cachem.POLICIES. Spec files hold JSON hierarchy
+specs as described in cachem.Hierarchy.
+"""
+import csv
+import itertools
+import json
+import multiprocessing
+import sys
+
+from cachem import *
+from tracefile import TraceReader
+
+def grid(assoc, index_bits, offset_bits=(6,), policies=("lru",), total_bits=32):
+    """
+    Returns the configurations of every combination of the given
+    associativities, index bits, offset bits and replacement policies.
+    """
+    return [{"kind": "cache", "assoc": a, "index_bits": i, "offset_bits": o,
+             "tag_bits": total_bits - i - o, "policy": p}
+            for (a, i, o, p) in itertools.product(assoc, index_bits, offset_bits, policies)]
+
+def policy_name(cache):
+    for name, policy in POLICIES.iteritems():
+        if type(cache.policy) is policy:
+            return name
+    return "lru"
+
+def build(config):
+    """
+    Build the simulator described by a configuration, with its output going
+    to a NullRAM.
+    """
+    if config["kind"] == "nehalem":
+        l3_policy = config.get("l3_policy")
+        return NehalemCache(compact=config.get("compact", False), ram=NullRAM(),
+                            l3_policy=l3_policy and POLICIES[l3_policy]())
+    if config["kind"] == "hierarchy":
+        return Hierarchy(config["spec"], compact=config.get("compact", False), ram=NullRAM())
+    cache = NWayCache(config["assoc"], config["tag_bits"], config["index_bits"],
+                      config["offset_bits"], POLICIES[config.get("policy", "lru")]())
+    cache.set_parent(NullRAM())
+    cache.set_name("cache")
+    return cache
+
+def simulate(cache, filename):
+    trace = TraceReader(filename)
+    if numpy is not None:
+        for refs in trace.arrays():
+            cache.simulate_batch(refs)
+    else:
+        for ref in trace:
+            cache.access(ref)
+    trace.close()
+
+def run_config(job):
+    """
+    Simulate one configuration over the trace and return its statistics as
+    a list of table rows, one per cache level.
+    """
+    number, config, filename = job
+    cache = build(config)
+    simulate(cache, filename)
+    if config["kind"] == "cache":
+        levels = [cache]
+    else:
+        levels = cache.levels()
+    rows = []
+    for level in levels:
+        row = {"config": number, "level": level.name, "policy": policy_name(level),
+               "assoc": level.associativity, "index_bits": level.index_bits,
+               "offset_bits": level.offset_bits}
+        row.update(level.stats.as_dict())
+        rows.append(row)
+    return rows
+
+def sweep(configs, filename, processes=None):
+    """
+    Run every configuration over the trace file on a pool of processes (one
+    per core by default) and return all of their rows in config order.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [(number, config, filename) for (number, config) in enumerate(configs)]
+        results = pool.imap_unordered(run_config, jobs)
+        rows = [row for result in results for row in result]
+    finally:
+        pool.close()
+        pool.join()
+    rows.sort(key=lambda row: row["config"])
+    return rows
+
+COLUMNS = ("config", "level", "policy", "assoc", "index_bits", "offset_bits", "accesses",
+           "miss_rate") + CacheStats.COUNTERS
+
+def write_table(rows, f):
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow([row[column] for column in COLUMNS])
+
+def parse_list(s):
+    return [int(x) for x in s.split(",")]
+
+if __name__ == "__main__":
+    if len(sys.argv) in (3, 4) and sys.argv[2] == "nehalem":
+        policies = sys.argv[3].split(",") if len(sys.argv) == 4 else [None]
+        configs = [{"kind": "nehalem", "l3_policy": policy} for policy in policies]
+    elif len(sys.argv) >= 4 and sys.argv[2] == "hierarchy":
+        configs = []
+        for spec_filename in sys.argv[3:]:
+            with open(spec_filename) as f:
+                configs.append({"kind": "hierarchy", "spec": json.load(f)})
+    elif len(sys.argv) in (4, 5, 6):
+        configs = grid(*(map(parse_list, sys.argv[2:5]) + [arg.split(",") for arg in sys.argv[5:]]))
+    else:
+        print "Usage: ./sweep.py trace_file assoc_list index_bits_list [offset_bits_list [policy_list]]"
+        print "       ./sweep.py trace_file nehalem [l3_policy_list]"
+        print "       ./sweep.py trace_file hierarchy spec_file..."
+        sys.exit(1)
+
+    write_table(sweep(configs, sys.argv[1]), sys.stdout)
@@ -1,8 +1,20 @@
 #!/usr/bin/env python
 from cachem import *
+from benchmark import ListLRUPolicy, lackey_refs, list_generate_accesses, random_refs
 import sys
 from cStringIO import StringIO
+import json
+import os
+import random
+import struct
+import tempfile
 import unittest
+import checkpoint
+import parallel
+import sampling
+import stackdist
+import sweep
+import tracefile
 
 def pad(iterable, length, padding=''):
     for count, i in enumerate(iterable):
@@ -37,6 +49,11 @@ def sequentialMemory(inst, start, count, inc):
 
 class TestSmallCache(unittest.TestCase):
 
+    def newCache(self, assoc, tag_bits, index_bits, offset_bits, policy=None):
+        cache = NWayCache(assoc, tag_bits, index_bits, offset_bits, policy or LRUPolicy())
+        cache.set_parent(RAM())
+        return cache
+
     def runPattern(self, pattern, cache):
         old_stdout = sys.stdout
 
@@ -71,8 +88,7 @@ class TestSmallCache(unittest.TestCase):
 
 
     def test_alignment(self):
-        cache = NWayCache(5, 20, 4, 8, LRUPolicy())
-        cache.set_parent(RAM())
+        cache = self.newCache(5, 20, 4, 8)
 
         cases = [
             (sequentialAccess('L', 0X00000000, 1, 0X101, ''), sequentialMemory('R', 0X00000000, 1, 0X100)),
@@ -81,8 +97,7 @@ class TestSmallCache(unittest.TestCase):
         self.runCases(cases, cache)
 
     def test_associativity(self):
-        cache = NWayCache(5, 20, 4, 8, LRUPolicy())
-        cache.set_parent(RAM())
+        cache = self.newCache(5, 20, 4, 8)
 
         cases = [
             (sequentialAccess('L', 0X00000000, 5, 0X10000, ''), sequentialMemory('R', 0X00000000, 5, 0X10000)),
@@ -94,8 +109,7 @@ class TestSmallCache(unittest.TestCase):
         self.runCases(cases, cache)
     
     def test_fill_cache(self):
-        cache = NWayCache(5, 20, 4, 8, LRUPolicy())
-        cache.set_parent(RAM())
+        cache = self.newCache(5, 20, 4, 8)
 
         totalCacheBlocks = (2**4)*5
 
@@ -110,8 +124,7 @@ class TestSmallCache(unittest.TestCase):
         self.runCases(cases, cache)
 
     def test_sequential_access(self):
-        cache = NWayCache(1, 28, 3, 0, LRUPolicy())
-        cache.set_parent(RAM())
+        cache = self.newCache(1, 28, 3, 0)
 
         cases = [
             (['L 0X00000000,17'], sequentialMemory('R', 0X00000000, 17, 0x1)),
@@ -125,8 +138,7 @@ class TestSmallCache(unittest.TestCase):
 
     def test_writeback(self):
         Nset = 3
-        cache = NWayCache(Nset, 24, 4, 4, LRUPolicy())
-        cache.set_parent(RAM())
+        cache = self.newCache(Nset, 24, 4, 4)
         cache.set_name(" L3")
 
         totalBlocks = 3*(2**4)
@@ -165,5 +177,627 @@ class TestSmallCache(unittest.TestCase):
             ]
         self.runCases(cases, cache)
 
+    def test_events(self):
+        cache = self.newCache(5, 20, 4, 8)
+        sink = CountingEventSink()
+        cache.subscribe(sink)
+        self.runPattern(sequentialAccess('L', 0X00000000, 6, 0X10000, '')*5 + ['S 0X00000000,1'], cache)
+        cache.unsubscribe(sink)
+        self.runPattern(sequentialAccess('L', 0X00000000, 6, 0X10000, ''), cache)
+
+        name = cache.name
+        self.assertEquals(sink.count(name, READ_MISS), 31)
+        self.assertEquals(sink.count(name, FILL), 31)
+        self.assertEquals(sink.count(name, EVICT), 26)
+        self.assertEquals(sink.count(name, READ_HIT), 0)
+        self.assertEquals(sink.count(name, WRITE_MISS), 1)
+        self.assertEquals(sink.count(name, WRITEBACK), 0)
+        self.assertEquals(cache.stats.read_misses, 37)
+        self.assertEquals(cache.stats.evictions, 27)
+        self.assertEquals(sum(cache.stats.set_evictions), 27)
+        self.assertEquals(cache.stats.write_misses, 1)
+
+    def test_lru_matches_list_policy(self):
+        refs = [' '.join((op, '%x,%d' % (addr, length)))
+                for (op, addr, length) in random_refs(3000, 4, 3, 6, seed=161)]
+        expected = self.runPattern(refs, self.makeCache(ListLRUPolicy()))
+        result = self.runPattern(refs, self.makeCache(LRUPolicy()))
+        self.assertEquals(result, expected)
+
+    def makeCache(self, policy):
+        return self.newCache(4, 23, 3, 6, policy)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_drops_lru_hits(self):
+        # Cycling through three blocks of a set hits after the first round
+        # without ever repeating the most recently used block, and the blocks
+        # written along the way are written back once evicted.
+        refs = [('S' if i % 7 == 0 else 'L', 0x200 * (i % 3), 4) for i in xrange(60)]
+        refs += [('L', 0x200 * i, 4) for i in xrange(3, 8)]
+        cache = self.makeCache(LRUPolicy())
+        kinds, blocks = batch_accesses(references_to_array(refs[:60]))
+        keep, replays = cache.filter_accesses(blocks, kinds == 2, cache.new_filter_state())
+        self.assertEquals(numpy.flatnonzero(keep).tolist(), [0, 1, 2])
+
+        expected = self.runPattern(['%s %x,%d' % ref for ref in refs], cache)
+        expected_stats = cache.stats.as_dict(histogram=True)
+        old_stdout = sys.stdout
+        sys.stdout = mystdout = StringIO()
+        try:
+            cache.clear()
+            cache.stats.reset()
+            cache.simulate_batch(references_to_array(refs), 40)
+        finally:
+            sys.stdout = old_stdout
+        self.assertEquals(mystdout.getvalue().strip().upper(), expected)
+        self.assertEquals(expected.count('W'), 3)
+        self.assertEquals(cache.stats.as_dict(histogram=True), expected_stats)
+
+class TestCompactCache(TestSmallCache):
+
+    def newCache(self, assoc, tag_bits, index_bits, offset_bits, policy=None):
+        cache = CompactNWayCache(assoc, tag_bits, index_bits, offset_bits, policy)
+        cache.set_parent(RAM())
+        return cache
+
+    def test_stamp_renumbering(self):
+        refs = [' '.join((op, '%x,%d' % (addr, length)))
+                for (op, addr, length) in random_refs(3000, 4, 3, 6, seed=161)]
+        expected = self.runPattern(refs, TestSmallCache.newCache(self, 4, 23, 3, 6))
+        cache = self.newCache(4, 23, 3, 6)
+        cache.stamp_limit = 100
+        self.assertEquals(self.runPattern(refs, cache), expected)
+        self.assertTrue(cache.clock <= 100)
+
+class TestPolicies(unittest.TestCase):
+
+    def evictions(self, policy, blocks, cache_class=NWayCache):
+        cache = cache_class(4, 24, 0, 8, policy)
+        ram = StringIO()
+        cache.set_parent(RAM(ram))
+        for block in blocks:
+            cache.access(('L', block << 8, 1))
+        return [int(line.split()[1], 16) >> 8 for line in ram.getvalue().split('\n') if line]
+
+    def test_tree_plru(self):
+        # After A B C D A the tree points at C, where true LRU would pick B
+        self.assertEquals(self.evictions(TreePLRUPolicy(), [1, 2, 3, 4, 1, 5, 3]),
+                          [1, 2, 3, 4, 5, 3])
+        self.assertEquals(self.evictions(LRUPolicy(), [1, 2, 3, 4, 1, 5, 2]),
+                          [1, 2, 3, 4, 5, 2])
+
+    def test_clock(self):
+        # The first sweep clears every reference bit and takes way 0; B is
+        # then referenced again so the hand skips it and takes C
+        self.assertEquals(self.evictions(ClockPolicy(), [1, 2, 3, 4, 5, 2, 6, 1, 3]),
+                          [1, 2, 3, 4, 5, 6, 1, 3])
+
+    def test_srrip(self):
+        # Only A is promoted, so ageing the set makes B the first distant way
+        self.assertEquals(self.evictions(SRRIPPolicy(), [1, 2, 3, 4, 1, 5, 1, 2]),
+                          [1, 2, 3, 4, 5, 2])
+
+    def test_random_is_reproducible(self):
+        blocks = [random.Random(161).randrange(12) for i in range(500)]
+        self.assertEquals(self.evictions(RandomPolicy(7), blocks),
+                          self.evictions(RandomPolicy(7), blocks))
+
+    def test_policies_match_across_paths(self):
+        refs = random_refs(3000, 4, 3, 6, seed=161)
+        for name, policy in sorted(POLICIES.items()):
+            expected = StringIO()
+            cache = NWayCache(4, 23, 3, 6, policy())
+            cache.set_parent(RAM(expected))
+            for ref in refs:
+                cache.access(ref)
+
+            result = StringIO()
+            compact = CompactNWayCache(4, 23, 3, 6, policy())
+            compact.set_parent(RAM(result))
+            for ref in refs:
+                compact.access(ref)
+            self.assertEquals(result.getvalue(), expected.getvalue(), name)
+
+            if numpy is not None:
+                result = StringIO()
+                batch = NWayCache(4, 23, 3, 6, policy())
+                batch.set_parent(RAM(result))
+                batch.simulate_batch(references_to_array(refs), 100)
+                self.assertEquals(result.getvalue(), expected.getvalue(), name)
+
+class TestAccessSplitting(unittest.TestCase):
+
+    def refs(self):
+        refs = lackey_refs(2000, seed=161)
+        refs += [('L', 0x3f, 2), ('S', 0x40, 64), ('M', 0x41, 200), ('I', 0x80, 0),
+                 ('X', 0x100, 1), ('L', 0x7ff, 1)]
+        return refs
+
+    def test_matches_original(self):
+        for ref in self.refs():
+            for offset_bits in (2, 6):
+                for repeats in (False, True):
+                    self.assertEquals(generate_accesses(ref, offset_bits, repeats),
+                                      list_generate_accesses(ref, offset_bits, repeats))
+                self.assertEquals(list(iter_accesses(ref, offset_bits)),
+                                  list_generate_accesses(ref, offset_bits))
+
+    def test_counts(self):
+        for ref in self.refs():
+            counts = list(iter_accesses(ref, 6, counts=True))
+            self.assertEquals([access[:2] for access in counts], generate_accesses(ref))
+            self.assertEquals(sum(count for (op, addr, count) in counts), max(ref[2], 0))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_counts(self):
+        refs = self.refs()
+        kinds, blocks, sizes = batch_accesses(references_to_array(refs), 6, True)
+        expected = [count for ref in refs for (op, addr, count) in iter_accesses(ref, 6, True)]
+        self.assertEquals(sizes.tolist(), expected)
+        self.assertEquals(len(blocks), len(expected))
+
+class TestNehalemCache(unittest.TestCase):
+
+    def runRefs(self, cache, simulate):
+        old_stdout = sys.stdout
+        sys.stdout = mystdout = StringIO()
+        try:
+            simulate(cache)
+        finally:
+            sys.stdout = old_stdout
+        return mystdout.getvalue()
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_matches_access(self):
+        refs = lackey_refs(20000, seed=161)
+        refs += [('S', 0xbe000010, 4), ('L', 0xbe000010, 4), ('I', 0x08048000, 0)]
+        def scalar(cache):
+            for ref in refs:
+                cache.access(ref)
+        expected_cache = NehalemCache(snapshot_interval=1000)
+        expected = self.runRefs(expected_cache, scalar)
+        result_cache = NehalemCache(snapshot_interval=1000)
+        result = self.runRefs(result_cache,
+            lambda cache: cache.simulate_batch(references_to_array(refs), 777))
+        self.assertTrue(expected)
+        self.assertEquals(result, expected)
+        for level in ("L1I_cache", "L1D_cache", "L2_cache", "L3_cache"):
+            expected_level = getattr(expected_cache, level)
+            result_level = getattr(result_cache, level)
+            self.assertEquals(result_level.dirty, expected_level.dirty)
+            self.assertEquals(dict(result_level.sets), dict(expected_level.sets))
+        self.assertEquals(result_cache.stats(True), expected_cache.stats(True))
+        self.assertEquals(result_cache.snapshots, expected_cache.snapshots)
+        self.assertEquals(len(result_cache.snapshots), len(refs) / 1000)
+
+    def test_stats_export(self):
+        cache = NehalemCache(snapshot_interval=2)
+        self.runRefs(cache, lambda cache: map(cache.access, lackey_refs(5, seed=161)))
+        self.assertEquals(cache.stats()["L1I"]["read_misses"], 1)
+        self.assertEquals(cache.stats()["L1I"]["read_hits"], 4)
+
+        f = StringIO()
+        cache.write_stats_csv(f)
+        rows = f.getvalue().strip().split('\n')
+        self.assertEquals(rows[0], 'references,level,accesses,miss_rate,read_hits,'
+                          'read_misses,write_hits,write_misses,bypassed_writes,evictions,'
+                          'writebacks')
+        self.assertEquals([row.split(',')[0] for row in rows[1::4]], ['2', '4', '5'])
+
+        f = StringIO()
+        cache.write_stats_json(f)
+        stats = json.loads(f.getvalue())
+        self.assertEquals(stats["references"], 5)
+        self.assertEquals(len(stats["levels"]["L2"]["set_evictions"]), 2**12)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_replays_lru_hits(self):
+        # Hits to three blocks of an L1D set that are dropped still have to
+        # keep them in the right LRU order and dirty, so that the right ones
+        # are evicted and written back to L2 when the set is flooded.
+        refs = [('S' if i % 7 == 0 else 'L', 0x1000 * (i % 3), 4) for i in xrange(60)]
+        refs += [('L', 0x1000 * i, 4) for i in xrange(3, 10)]
+        refs += [('M', 0x1000, 4)] + [('L', 0x1000 * i, 4) for i in xrange(10, 20)]
+        def scalar(cache):
+            for ref in refs:
+                cache.access(ref)
+        expected_cache = NehalemCache()
+        expected = self.runRefs(expected_cache, scalar)
+        result_cache = NehalemCache()
+        result = self.runRefs(result_cache,
+            lambda cache: cache.simulate_batch(references_to_array(refs), 40))
+        self.assertEquals(result, expected)
+        self.assertTrue(expected_cache.L2_cache.dirty)
+        for level in ("L1D_cache", "L2_cache"):
+            expected_level = getattr(expected_cache, level)
+            result_level = getattr(result_cache, level)
+            self.assertEquals(result_level.dirty, expected_level.dirty)
+            self.assertEquals(dict(result_level.sets), dict(expected_level.sets))
+
+def residentBlocks(level):
+    if isinstance(level, CompactNWayCache):
+        return set(level.tags) - set([level.INVALID])
+    return set(tag | index for (index, tags) in level.sets.items() for tag in tags)
+
+class TestHierarchy(unittest.TestCase):
+
+    def makeSpec(self, inclusion=NINE, **options):
+        l1 = {"name": "L1", "assoc": 2, "index_bits": 1, "parent": "L2"}
+        l1.update(options)
+        return {"levels": [l1, {"name": "L2", "assoc": 4, "index_bits": 1,
+                                "inclusion": inclusion}]}
+
+    def runSpec(self, spec, refs, compact=False, check=None):
+        ram = RAM(StringIO())
+        cache = Hierarchy(spec, compact, ram=ram)
+        for ref in refs:
+            cache.access(ref)
+            if check:
+                check(cache.level("L1"), cache.level("L2"))
+        return cache, ram.stream.getvalue()
+
+    def refs(self):
+        return random_refs(3000, 4, 2, 6, seed=161)
+
+    def test_nehalem_spec(self):
+        cache = Hierarchy(NEHALEM, ram=NullRAM())
+        self.assertEquals([level.name for level in cache.levels()], ["L1I", "L1D", "L2", "L3"])
+        self.assertEquals(cache.level("L1D").parent, cache.level("L2"))
+        self.assertEquals(cache.level("L2").children, [cache.level("L1I"), cache.level("L1D")])
+        self.assertEquals(cache.level("L3").index_bits, 17)
+
+    def test_single_level_matches_nway(self):
+        refs = self.refs()
+        _, result = self.runSpec({"levels": [{"name": "L1", "assoc": 4, "size": 1024}]}, refs)
+        expected = StringIO()
+        cache = NWayCache(4, 24, 2, 6, LRUPolicy())
+        cache.set_parent(RAM(expected))
+        for ref in refs:
+            cache.access(ref)
+        self.assertEquals(result, expected.getvalue())
+
+    def test_inclusive(self):
+        def check(l1, l2):
+            self.assertTrue(residentBlocks(l1) <= residentBlocks(l2))
+        outputs = [self.runSpec(self.makeSpec(INCLUSIVE), self.refs(), compact, check)[1]
+                   for compact in (False, True)]
+        self.assertEquals(outputs[0], outputs[1])
+
+        # Block 0 stays hot in L1, so L2 only sees its first access and
+        # evicts it. The dirty L1 copy is invalidated and written back, and
+        # has to be read in again
+        refs = [('S', 0x0, 1)]
+        for i in xrange(1, 5):
+            refs += [('L', i << 7, 1), ('L', 0x0, 1)]
+        cache, output = self.runSpec(self.makeSpec(INCLUSIVE), refs)
+        self.assertEquals(output.split('\n')[-4:],
+                          ['W 0x00000000', 'R 0x00000200', 'R 0x00000000', ''])
+        self.assertFalse(cache.level("L1").dirty)
+
+    def test_exclusive(self):
+        def check(l1, l2):
+            self.assertFalse(residentBlocks(l1) & residentBlocks(l2))
+        outputs = [self.runSpec(self.makeSpec(EXCLUSIVE), self.refs(), compact, check)[1]
+                   for compact in (False, True)]
+        self.assertEquals(outputs[0], outputs[1])
+
+    def test_write_through_no_allocate(self):
+        cache = Hierarchy(self.makeSpec(write="through", write_allocate=False), ram=NullRAM())
+        l1 = cache.level("L1")
+        l2 = cache.level("L2")
+        for ref in self.refs():
+            write_misses = l1.stats.write_misses
+            cache.access(ref)
+            self.assertFalse(l1.dirty)
+            if l1.stats.write_misses > write_misses:
+                self.assertFalse(ref[1] in residentBlocks(l1))
+        self.assertTrue(l1.stats.write_misses)
+        self.assertEquals(l2.stats.write_hits + l2.stats.write_misses,
+                          l1.stats.write_hits + l1.stats.write_misses)
+        # Write misses that go around L1 still count as accesses and misses
+        self.assertEquals(l1.stats.bypassed_writes, l1.stats.write_misses)
+        self.assertEquals(l1.stats.accesses(), len(self.refs()))
+        self.assertEquals(l1.stats.misses(), l1.stats.read_misses + l1.stats.write_misses)
+        self.assertEquals(sum(l1.stats.set_misses), l1.stats.misses())
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch_matches_access(self):
+        refs = lackey_refs(5000, seed=161)
+        specs = [self.makeSpec(inclusion, index_bits=3)
+                 for inclusion in (INCLUSIVE, EXCLUSIVE, NINE)]
+        specs += [self.makeSpec(write="through", index_bits=3),
+                  self.makeSpec(write_allocate=False, index_bits=3),
+                  self.makeSpec(write="through", write_allocate=False, index_bits=3),
+                  {"levels": [{"name": "L1", "assoc": 2, "index_bits": 1,
+                               "write_allocate": False}]}]
+        # Instruction fetches fill and evict from the data entry level, which
+        # may also be exclusive of them
+        for inclusion in (NINE, EXCLUSIVE):
+            specs.append(self.makeSpec(inclusion, index_bits=3))
+            specs[-1].update({"instruction": "L1", "data": "L2"})
+        for spec in specs:
+            expected_cache, expected = self.runSpec(spec, refs)
+            ram = RAM(StringIO())
+            cache = Hierarchy(spec, ram=ram)
+            cache.simulate_batch(references_to_array(refs), 777)
+            self.assertEquals(ram.stream.getvalue(), expected, spec)
+            self.assertEquals(cache.stats(), expected_cache.stats())
+
+        # A write miss that does not allocate leaves the block out of the cache
+        spec = {"levels": [{"name": "L1", "assoc": 2, "index_bits": 1, "write_allocate": False}]}
+        ram = RAM(StringIO())
+        Hierarchy(spec, ram=ram).simulate_batch(
+            references_to_array([('S', 0x1000, 4), ('L', 0x1000, 4)]))
+        self.assertEquals(ram.stream.getvalue(), 'W 0x00001000\nR 0x00001000\n')
+
+    def test_invalid_specs(self):
+        bad = [
+            {"levels": []},
+            {"levels": [{"name": "L1", "assoc": 3, "size": 1000}]},
+            {"levels": [{"name": "L1", "assoc": 1, "index_bits": 1, "policy": "fifo"}]},
+            {"levels": [{"name": "L1", "assoc": 1, "index_bits": 1, "inclusion": "exclusive"}]},
+            {"levels": [{"name": "L1", "assoc": 1, "index_bits": 1, "parent": "L2"}]},
+            {"levels": [{"name": "L1", "assoc": 1, "index_bits": 1, "parent": "L2"},
+                        {"name": "L2", "assoc": 1, "index_bits": 1, "parent": "L1"}]},
+            {"levels": [{"name": "L1", "assoc": 1, "index_bits": 1, "parent": "L2",
+                         "offset_bits": 5},
+                        {"name": "L2", "assoc": 1, "index_bits": 1, "inclusion": "inclusive"}]},
+        ]
+        for spec in bad:
+            self.assertRaises(ValueError, Hierarchy, spec, ram=NullRAM())
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_resume_matches_uninterrupted(self):
+        refs = lackey_refs(3000, seed=161)
+        # The L3 policy varies; the others are LRU, which compact storage
+        # implements itself
+        cases = [(False, name) for name in sorted(POLICIES)] + [(True, "lru"), (True, "srrip")]
+        for compact, name in cases:
+            policy = POLICIES[name]
+            expected = StringIO()
+            cache = NehalemCache(compact, 1000, RAM(expected), policy())
+            for ref in refs:
+                cache.access(ref)
+
+            result = StringIO()
+            first = NehalemCache(compact, 1000, RAM(result), policy())
+            for ref in refs[:1200]:
+                first.access(ref)
+            f = StringIO()
+            checkpoint.save(first, f)
+            f.seek(0)
+
+            second = NehalemCache(compact, 1000, RAM(result), policy())
+            self.assertEquals(checkpoint.load(second, f), 1200)
+            for ref in refs[1200:]:
+                second.access(ref)
+            self.assertEquals(result.getvalue(), expected.getvalue(), name)
+            self.assertEquals(second.stats(True), cache.stats(True))
+            self.assertEquals(second.snapshots, cache.snapshots)
+
+    def test_mismatched_cache(self):
+        cache = NehalemCache(ram=NullRAM())
+        cache.access(('L', 0x1000, 4))
+        f = StringIO()
+        checkpoint.save(cache, f)
+        f.seek(0)
+        self.assertRaises(ValueError, checkpoint.load,
+                          NehalemCache(ram=NullRAM(), l3_policy=TreePLRUPolicy()), f)
+
+class TestRAM(unittest.TestCase):
+
+    def runRAM(self, ram, refs):
+        cache = NWayCache(2, 24, 2, 6, LRUPolicy())
+        cache.set_parent(ram)
+        for ref in refs:
+            cache.access(ref)
+        ram.flush()
+
+    def test_buffered_output(self):
+        refs = random_refs(500, 2, 2, 6, seed=161)
+        expected = StringIO()
+        self.runRAM(RAM(expected), refs)
+        self.assertTrue(expected.getvalue())
+
+        for buffer_size in (1, 7, 4096):
+            result = StringIO()
+            self.runRAM(RAM(result, buffer_size=buffer_size), refs)
+            self.assertEquals(result.getvalue(), expected.getvalue())
+
+            result = StringIO()
+            self.runRAM(RAM(result, binary=True, buffer_size=buffer_size), refs)
+            self.assertEquals(len(result.getvalue()), 8 * len(expected.getvalue().split('\n')[:-1]))
+            decoded = struct.unpack('<%dQ' % (len(result.getvalue()) / 8), result.getvalue())
+            self.assertEquals(''.join('%s %#010x\n' % ('RW'[access & 1], access >> 1)
+                                      for access in decoded), expected.getvalue())
+
+        for buffer_size in (0, 2):
+            result = StringIO()
+            ram = RAM(result, binary=True, buffer_size=buffer_size)
+            ram.read(0x123456789c0)
+            ram.write(0x40)
+            ram.flush()
+            self.assertEquals(result.getvalue(), '\x80\x13\xcf\x8a\x46\x02\x00\x00'
+                                                 '\x81\x00\x00\x00\x00\x00\x00\x00')
+
+        ram = NullRAM()
+        self.runRAM(ram, refs)
+        lines = expected.getvalue().split()[::2]
+        self.assertEquals((ram.reads, ram.writes), (lines.count('R'), lines.count('W')))
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.refs = references_to_array(lackey_refs(20000, seed=161))
+        self.full = NehalemCache(ram=NullRAM())
+        self.full.simulate_batch(self.refs)
+
+    def sample(self, *args):
+        sampler = sampling.SampledSimulation(NehalemCache(ram=NullRAM()), *args)
+        for start in xrange(0, len(self.refs), 3000):
+            sampler.simulate(self.refs[start:start + 3000])
+        return sampler, sampler.results()
+
+    def test_unsampled_is_exact(self):
+        sampler, results = self.sample()
+        for row, level in zip(results, self.full.levels()):
+            self.assertEquals(row["miss_rate"], level.stats.miss_rate())
+            self.assertEquals(row["misses"], level.stats.read_misses)
+            self.assertEquals(row["ci_low"], row["ci_high"])
+
+    def test_set_sampling(self):
+        sampler, results = self.sample(2, 0, 0, None, 1)
+        for row, level in zip(results[:2], self.full.levels()):
+            self.assertTrue(row["ci_low"] < level.stats.miss_rate() < row["ci_high"], row)
+            self.assertTrue(abs(row["accesses"] - level.stats.accesses()) <
+                            0.05 * level.stats.accesses())
+
+    def test_time_sampling(self):
+        sampler, results = self.sample(0, 2000, 500)
+        self.assertEquals(len(sampler.windows), 10)
+        self.assertEquals(sampler.measured, 5000)
+        for row, level in zip(results[:2], self.full.levels()):
+            self.assertTrue(row["ci_low"] < level.stats.miss_rate() < row["ci_high"], row)
+
+        sampler, results = self.sample(0, 2000, 500, 500)
+        self.assertEquals(len(sampler.windows), 10)
+        # Only half of the references are simulated
+        for sampled, level in zip(sampler.cache.levels()[:2], self.full.levels()):
+            self.assertTrue(sampled.stats.accesses() < 0.6 * level.stats.accesses())
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, sampling.SampledSimulation, NehalemCache(ram=NullRAM()), 7)
+        self.assertRaises(ValueError, sampling.SampledSimulation, NehalemCache(ram=NullRAM()),
+                          0, 100, 80, 40)
+
+class TestStackDistance(unittest.TestCase):
+
+    def test_matches_simulation(self):
+        refs = random_refs(3000, 4, 2, 6, seed=161) + lackey_refs(3000, seed=161)
+        analyzer = stackdist.StackDistanceAnalyzer(6, range(0, 4))
+        for ref in refs:
+            analyzer.access(ref)
+        curves = analyzer.miss_ratio_curves(6)
+
+        for index_bits in range(0, 4):
+            for assoc in (1, 2, 3, 6):
+                cache = NWayCache(assoc, 26 - index_bits, index_bits, 6, LRUPolicy())
+                cache.set_parent(NullRAM())
+                for ref in refs:
+                    cache.access(ref)
+                self.assertEquals(analyzer.misses(assoc, index_bits), cache.stats.read_misses)
+                self.assertAlmostEquals(curves[index_bits][assoc - 1],
+                    float(cache.stats.read_misses) / cache.stats.accesses())
+
+def writeTrace(refs):
+    fd, filename = tempfile.mkstemp()
+    writer = tracefile.TraceWriter(os.fdopen(fd, 'wb'))
+    for ref in refs:
+        writer.write(ref)
+    writer.close()
+    return filename
+
+class TestSweep(unittest.TestCase):
+
+    def test_sweep_matches_simulation(self):
+        refs = lackey_refs(4000, seed=161)
+        filename = writeTrace(refs)
+        try:
+            configs = sweep.grid([1, 4], [2, 5])
+            rows = sweep.sweep(configs, filename, processes=2)
+        finally:
+            os.remove(filename)
+
+        self.assertEquals([row["config"] for row in rows], range(len(configs)))
+        for config, row in zip(configs, rows):
+            cache = sweep.build(config)
+            for ref in refs:
+                cache.access(ref)
+            self.assertEquals(row["read_misses"], cache.stats.read_misses)
+            self.assertEquals(row["accesses"], cache.stats.accesses())
+            self.assertEquals(row["write_hits"], cache.stats.write_hits)
+
+    def test_hierarchy_config(self):
+        refs = lackey_refs(2000, seed=161)
+        filename = writeTrace(refs)
+        try:
+            config = {"kind": "hierarchy", "spec": NEHALEM}
+            rows = sweep.sweep([config], filename, processes=1)
+        finally:
+            os.remove(filename)
+
+        cache = NehalemCache(ram=NullRAM())
+        for ref in refs:
+            cache.access(ref)
+        self.assertEquals([row["level"] for row in rows], ["L1I", "L1D", "L2", "L3"])
+        for row, level in zip(rows, cache.levels()):
+            self.assertEquals(row["read_misses"], level.stats.read_misses)
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.refs = lackey_refs(4000, seed=161)
+        self.filename = writeTrace(self.refs)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_sharded_matches_simulation(self):
+        config = sweep.grid([2], [3])[0]
+        expected = StringIO()
+        cache = sweep.build(config)
+        cache.set_parent(RAM(expected))
+        for ref in self.refs:
+            cache.access(ref)
+
+        result = StringIO()
+        stats = parallel.simulate_sharded(config, self.filename, RAM(result), 3)
+        self.assertEquals(result.getvalue(), expected.getvalue())
+        self.assertEquals(stats, cache.stats.as_dict(histogram=True))
+
+    def test_pipelined_matches_simulation(self):
+        expected = StringIO()
+        cache = NehalemCache(ram=RAM(expected))
+        for ref in self.refs:
+            cache.access(ref)
+
+        result = StringIO()
+        stats = parallel.simulate_pipelined(self.filename, RAM(result))
+        self.assertEquals(result.getvalue(), expected.getvalue())
+        self.assertEquals(stats, cache.stats(histogram=True))
+
+class TestTraceFile(unittest.TestCase):
+
+    def roundTrip(self, refs, encoding):
+        fd, filename = tempfile.mkstemp()
+        try:
+            writer = tracefile.TraceWriter(os.fdopen(fd, 'wb'), encoding)
+            for ref in refs:
+                writer.write(ref)
+            writer.close()
+            trace = tracefile.TraceReader(filename)
+            result = list(trace)
+            if numpy is not None:
+                arrays = list(trace.arrays(1000))
+                self.assertEquals(references_to_array(refs).tolist(),
+                                  numpy.concatenate(arrays).tolist())
+            trace.close()
+        finally:
+            os.remove(filename)
+        return result
+
+    def test_round_trip(self):
+        refs = lackey_refs(5000, seed=161) + [('L', 0xffffffff, 8), ('S', 0, 1)]
+        self.assertEquals(self.roundTrip(refs, tracefile.FIXED), refs)
+        self.assertEquals(self.roundTrip(refs, tracefile.DELTA), refs)
+
+    def test_parse_lackey(self):
+        lines = ['==1234== Lackey\n', 'I  0421dbe0,3\n', ' L 0421dbe0,8\n', ' M bef8c3a0,4\n']
+        self.assertEquals(list(tracefile.lackey_references(lines)),
+                          [('I', 0x0421dbe0, 3), ('L', 0x0421dbe0, 8), ('M', 0xbef8c3a0, 4)])
+
 if __name__ == '__main__':
     unittest.main()
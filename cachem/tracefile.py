@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Compact binary storage for memory reference traces, so that a lackey trace
+only has to be parsed once and can then be replayed by every experiment.
+
+A trace file is a HEADER followed by records in one of two encodings:
+
+FIXED records are (type, addr, len) packed little-endian into 13 bytes, the
+same layout as cachem.REF_DTYPE, so the file can be memory mapped and used as
+a NumPy array without copying.
+
+DELTA records are a type byte, the length as a varint and the zigzag encoded
+difference from the previous address as a varint. They are usually 3-5 bytes
+but have to be decoded sequentially.
+
+Usage: ./tracefile.py (lackey|plot) [--delta] output_filename < trace_file
+"""
+import itertools
+import mmap
+import struct
+import sys
+
+from cachem import REF_DTYPE, numpy, parse_reference
+
+MAGIC = "MAPTRACE"
+VERSION = 1
+FIXED = 0
+DELTA = 1
+
+HEADER = struct.Struct("<8sBB6x")
+RECORD = struct.Struct("<cQI")
+
+# Map the access types of the plot.py trace format onto lackey's
+PLOT_TYPES = {"ir": "I", "dr": "L", "dw": "S"}
+
+def lackey_references(it):
+    """
+    Parse lackey output into references, skipping valgrind's own messages.
+    """
+    for line in it:
+        if line.startswith("==") or not line.strip():
+            continue
+        yield parse_reference(line)
+
+def plot_references(it):
+    """
+    Parse the "ir: addr" / "dr: addr" / "dw: addr" format read by plot.py
+    into single byte references, skipping lines it cannot parse.
+    """
+    for i, line in enumerate(it):
+        if line.startswith("==") or line.startswith("--"):
+            continue
+        try:
+            access_type, addr_str = [x.strip().lower() for x in line.strip().split(":")]
+            yield (PLOT_TYPES[access_type], int(addr_str, 16), 1)
+        except (ValueError, KeyError):
+            sys.stderr.write("Error parsing line %d\n" % (i+1))
+
+def encode_varint(value):
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return "".join(out)
+
+class TraceWriter(object):
+    """
+    Writes references to a binary trace file.
+    """
+    def __init__(self, f, encoding=FIXED):
+        self.f = f
+        self.encoding = encoding
+        self.prev_addr = 0
+        self.buffer = []
+        f.write(HEADER.pack(MAGIC, VERSION, encoding))
+
+    def write(self, ref):
+        ref_type, ref_addr, ref_length = ref
+        if self.encoding == FIXED:
+            self.buffer.append(RECORD.pack(ref_type, ref_addr, ref_length))
+        else:
+            delta = ref_addr - self.prev_addr
+            self.prev_addr = ref_addr
+            zigzag = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+            self.buffer.append(ref_type + encode_varint(ref_length) + encode_varint(zigzag))
+        if len(self.buffer) >= 65536:
+            self.flush()
+
+    def flush(self):
+        self.f.write("".join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class TraceReader(object):
+    """
+    Reads references back out of a memory mapped binary trace file.
+    """
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.encoding = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a version %d trace file" % (filename, VERSION))
+
+    def __iter__(self):
+        """
+        Yield (type, addr, len) reference tuples.
+        """
+        return self.references()
+
+    def references(self, skip=0):
+        """
+        Yield the reference tuples after the first skip.
+        """
+        if self.encoding == FIXED:
+            unpack_from = RECORD.unpack_from
+            for offset in xrange(HEADER.size + skip * RECORD.size, len(self.map), RECORD.size):
+                yield unpack_from(self.map, offset)
+        else:
+            for ref in itertools.islice(self.decode_delta(), skip, None):
+                yield ref
+
+    def decode_delta(self):
+        data = self.map
+        end = len(data)
+        offset = HEADER.size
+        addr = 0
+        while offset < end:
+            ref_type = data[offset]
+            offset += 1
+            fields = []
+            for i in (0, 1):
+                value = shift = 0
+                while True:
+                    byte = ord(data[offset])
+                    offset += 1
+                    value |= (byte & 0x7f) << shift
+                    shift += 7
+                    if byte < 0x80:
+                        break
+                fields.append(value)
+            ref_length, zigzag = fields
+            addr += (zigzag >> 1) if not zigzag & 1 else -((zigzag + 1) >> 1)
+            yield (ref_type, addr, ref_length)
+
+    def __len__(self):
+        if self.encoding == FIXED:
+            return (len(self.map) - HEADER.size) // RECORD.size
+        return sum(1 for ref in self.decode_delta())
+
+    def arrays(self, chunk_size=1 << 20, skip=0):
+        """
+        Yield the trace as NumPy arrays of REF_DTYPE with up to chunk_size
+        references each, leaving out the first skip references. FIXED traces
+        are returned as views of the mapped file rather than copies.
+        """
+        if self.encoding == FIXED:
+            dtype = numpy.dtype(REF_DTYPE)
+            count = len(self)
+            for start in xrange(skip, count, chunk_size):
+                yield numpy.frombuffer(self.map, dtype, min(chunk_size, count - start),
+                                       HEADER.size + start * RECORD.size)
+        else:
+            chunk = []
+            for ref in itertools.islice(self.decode_delta(), skip, None):
+                chunk.append(ref)
+                if len(chunk) == chunk_size:
+                    yield numpy.array(chunk, dtype=REF_DTYPE)
+                    chunk = []
+            if chunk:
+                yield numpy.array(chunk, dtype=REF_DTYPE)
+
+    def close(self):
+        self.map.close()
+
+def is_trace_file(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    encoding = FIXED
+    if "--delta" in args:
+        args.remove("--delta")
+        encoding = DELTA
+    if len(args) != 2 or args[0] not in ("lackey", "plot"):
+        print "Usage: ./tracefile.py (lackey|plot) [--delta] output_filename < trace_file"
+        sys.exit(1)
+
+    parse = lackey_references if args[0] == "lackey" else plot_references
+    writer = TraceWriter(open(args[1], "wb"), encoding)
+    for ref in parse(sys.stdin):
+        writer.write(ref)
+    writer.close()
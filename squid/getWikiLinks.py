@@ -1,7 +1,31 @@
+#! /usr/bin/python
 
+# Crawls wikipedia from a seed page and prints the pages found as a --S
+# site list for runAccessPattern.py.
+#
+# Usage: ./getWikiLinks.py [-b base_url] [-s seed_path] [-n max_sites]
+#                          [-c workers] [-d host_delay] [-f state_file]
+#
+# Pages are fetched by a pool of workers threads (4 by default), with
+# requests to any one host at least host_delay seconds apart (1 by default).
+# Links are picked out of each body as it streams in. Crawling stops once
+# max_sites pages (1000 by default) have been found, or none are left to
+# fetch.
+#
+# The pages found and which of them are still to be fetched are kept in an
+# sqlite database, in memory unless a state_file is given. Running again
+# with the same state_file resumes the crawl, e.g. with a larger max_sites.
+# localWiki.py serves a made up wiki to crawl offline.
 
-import urllib2
+import sys
+import getopt
 import re
+import sqlite3
+import time
+import urllib2
+import urlparse
+from Queue import Queue
+from threading import Lock, Thread
 
 user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.19'\
     ' (KHTML, like Gecko) Chrome/18.0.1025.142 Safari/535.19'
@@ -12,27 +36,191 @@ base = 'http://en.wikipedia.org'
 
 seed = '/wiki/Main_Page'
 
-sites_seen = set([seed])
+SITE_PATN = r'href="(?P<site>/wiki/[^:"]*)"'
+site_regex = re.compile(SITE_PATN)
+
+MAX_SITES = 1000
+WORKERS = 4
+HOST_DELAY = 1.0
+TIMEOUT = 30
+CHUNK_SIZE = 16384
+# Longest link looked for across the boundary between chunks
+MAX_LINK_LENGTH = 2048
+COMMIT_INTERVAL = 100
 
-sites_to_visit = [seed]
+# States of a site in the database
+QUEUED = 0
+FETCHING = 1
+DONE = 2
+FAILED = 3
 
-SITE_PATN = r'href="(?P<site>/wiki/[^:"]*)"'
+def extractLinks(chunks):
+    # Yields the sites linked to by a page arriving in chunks. The end of
+    # each chunk after the last link found is kept, up to MAX_LINK_LENGTH,
+    # in case a link straddles the next chunk.
+    tail = ''
+    for chunk in chunks:
+        text = tail + chunk
+        end = 0
+        for m in site_regex.finditer(text):
+            yield m.group('site')
+            end = m.end()
+        tail = text[max(end, len(text) - MAX_LINK_LENGTH):]
+
+def fetchLinks(url):
+    response = urllib2.urlopen(urllib2.Request(url, None, headers), timeout=TIMEOUT)
+    try:
+        return list(extractLinks(iter(lambda: response.read(CHUNK_SIZE), '')))
+    finally:
+        response.close()
+
+class HostRateLimiter(object):
+    # Spaces out the requests to each host by at least delay seconds
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = Lock()
+        self.next_request = {}
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request.get(host, 0))
+            self.next_request[host] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+class CrawlState(object):
+    # The sites found by a crawl and their states, in an sqlite database.
+    # Only to be used from the thread that made it.
+
+    def __init__(self, filename=':memory:'):
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sites ('
+                        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                        'site TEXT UNIQUE NOT NULL, '
+                        'state INTEGER NOT NULL)')
+        # So that claim and count only visit the sites in one state
+        self.db.execute('CREATE INDEX IF NOT EXISTS sites_state ON sites(state, id)')
+        # Sites being fetched when an earlier crawl stopped are fetched again
+        self.db.execute('UPDATE sites SET state = ? WHERE state = ?', (QUEUED, FETCHING))
+        self.db.commit()
+        self.size = self.db.execute('SELECT COUNT(*) FROM sites').fetchone()[0]
+
+    def add(self, site):
+        # Returns whether the site is new
+        cursor = self.db.execute('INSERT OR IGNORE INTO sites (site, state) VALUES (?, ?)',
+                                 (site, QUEUED))
+        self.size += cursor.rowcount
+        return cursor.rowcount > 0
+
+    def claim(self, count):
+        # The most recently found sites still to fetch, as the original
+        # crawler took the last site off its list
+        rows = self.db.execute('SELECT id, site FROM sites WHERE state = ? '
+                               'ORDER BY id DESC LIMIT ?', (QUEUED, count)).fetchall()
+        self.db.executemany('UPDATE sites SET state = ? WHERE id = ?',
+                            [(FETCHING, row[0]) for row in rows])
+        return [row[1] for row in rows]
+
+    def finish(self, site, state):
+        self.db.execute('UPDATE sites SET state = ? WHERE site = ?', (state, site))
+
+    def count(self, state):
+        return self.db.execute('SELECT COUNT(*) FROM sites WHERE state = ?', (state,)).fetchone()[0]
+
+    def sites(self):
+        for row in self.db.execute('SELECT site FROM sites ORDER BY id'):
+            yield row[0]
+
+    def commit(self):
+        self.db.commit()
+
+class Crawler(object):
+    def __init__(self, state, base=base, max_sites=MAX_SITES, workers=WORKERS,
+                 host_delay=HOST_DELAY):
+        self.state = state
+        self.base = base
+        self.max_sites = max_sites
+        self.workers = workers
+        self.limiter = HostRateLimiter(host_delay)
+        self.work = Queue()
+        self.results = Queue()
+
+    def fetch(self):
+        while True:
+            site = self.work.get()
+            if site is None:
+                return
+            url = self.base + site
+            self.limiter.wait(urlparse.urlsplit(url).netloc)
+            try:
+                self.results.put((site, fetchLinks(url), None))
+            except Exception, e:
+                self.results.put((site, None, e))
+
+    def crawl(self, seed=seed):
+        self.state.add(seed)
+        threads = [Thread(target=self.fetch) for i in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        in_flight = 0
+        finished = 0
+        while True:
+            if self.state.size < self.max_sites and in_flight < self.workers:
+                for site in self.state.claim(self.workers - in_flight):
+                    self.work.put(site)
+                    in_flight += 1
+            if not in_flight:
+                break
+            site, links, error = self.results.get()
+            in_flight -= 1
+            if error is not None:
+                sys.stderr.write('Error: %s%s: %s\n' % (self.base, site, error))
+                self.state.finish(site, FAILED)
+            else:
+                # A site whose links did not all fit is left to be fetched
+                # again if the crawl is resumed with a larger max_sites
+                done = DONE
+                for link in links:
+                    if self.state.size >= self.max_sites:
+                        done = QUEUED
+                        break
+                    self.state.add(link)
+                self.state.finish(site, done)
+            finished += 1
+            if finished % COMMIT_INTERVAL == 0:
+                self.state.commit()
+                sys.stderr.write('%d fetched, %d found\n' % (self.state.count(DONE), self.state.size))
+
+        # Give back any sites left unfetched once enough were found
+        self.state.db.execute('UPDATE sites SET state = ? WHERE state = ?', (QUEUED, FETCHING))
+        self.state.commit()
+        for t in threads:
+            self.work.put(None)
+        for t in threads:
+            t.join()
+
+def usage():
+    print 'Usage: ./getWikiLinks.py [-b base_url] [-s seed_path] [-n max_sites]'
+    print '                         [-c workers] [-d host_delay] [-f state_file]'
+    exit(1)
+
+if __name__ == '__main__':
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'b:s:n:c:d:f:')
+    except getopt.GetoptError:
+        usage()
+    if args:
+        usage()
+    opts = dict(opts)
+    state = CrawlState(opts.get('-f', ':memory:'))
+    crawler = Crawler(state, opts.get('-b', base), int(opts.get('-n', MAX_SITES)),
+                      int(opts.get('-c', WORKERS)), float(opts.get('-d', HOST_DELAY)))
+    crawler.crawl(opts.get('-s', seed))
 
-while len(sites_seen) + len(sites_to_visit) < 1000 and len(sites_to_visit) != 0:
-    site = sites_to_visit.pop()
-    url = base + site
-    html = urllib2.urlopen(urllib2.Request(url, None, headers)).read()
-    urls = re.findall(SITE_PATN, html)
-#    print html
-    for u in urls:
-#        print u
-        if u not in sites_seen:
-            sites_seen.add(u)
-            sites_to_visit.append(u)
-    
-
-print '--S'
-for site in sites_seen:
-    print 1, base + site
-for site in sites_to_visit:
-    print 1, base + site
+    print '--S'
+    for site in state.sites():
+        print 1, crawler.base + site
@@ -0,0 +1,73 @@
+#! /usr/bin/python
+
+# A stand-in for squid and the origin servers behind it, for trying out
+# runAccessPattern.py without a network.
+#
+# Usage: ./localProxy.py [port [miss_delay_ms [body_bytes]]]
+#
+# Takes proxy requests (GET http://host/path) on keep-alive connections and
+# answers each url with body_bytes of filler that depend only on the url.
+# The first request for a url waits miss_delay_ms, as if fetched from the
+# origin, and is answered with X-Cache: MISS; later ones are answered at
+# once with X-Cache: HIT, as squid does.
+
+import sys
+import time
+import hashlib
+import BaseHTTPServer
+import SocketServer
+from threading import Lock
+
+PORT = 3128
+MISS_DELAY_MS = 50
+BODY_BYTES = 16384
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send the headers and body together rather than a packet per header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    cache = set()
+    lock = Lock()
+    miss_delay = MISS_DELAY_MS / 1000.0
+    body_bytes = BODY_BYTES
+
+    def do_GET(self):
+        with self.lock:
+            hit = self.path in self.cache
+            self.cache.add(self.path)
+        if not hit:
+            time.sleep(self.miss_delay)
+        digest = hashlib.sha1(self.path).hexdigest()
+        body = (digest * (self.body_bytes / len(digest) + 1))[:self.body_bytes]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Cache', '%s from localProxy' % ('HIT' if hit else 'MISS'))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        print 'Usage: ./localProxy.py [port [miss_delay_ms [body_bytes]]]'
+        exit(1)
+    args = [int(arg) for arg in sys.argv[1:]]
+    port = args[0] if len(args) > 0 else PORT
+    if len(args) > 1:
+        ProxyHandler.miss_delay = args[1] / 1000.0
+    if len(args) > 2:
+        ProxyHandler.body_bytes = args[2]
+    server = ThreadedHTTPServer(('127.0.0.1', port), ProxyHandler)
+    print 'Serving on port %d' % port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
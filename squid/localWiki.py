@@ -0,0 +1,83 @@
+#! /usr/bin/python
+
+# Serves a made up wiki, for crawling with getWikiLinks.py without a network.
+#
+# Usage: ./localWiki.py [port [pages [links_per_page [delay_ms]]]]
+#
+# /wiki/Main_Page and /wiki/Page_0 up to /wiki/Page_<pages - 1> each link to
+# links_per_page other pages, chosen the same way every time, among filler
+# text and links the crawler should ignore, and are answered after delay_ms.
+# Every request is logged to stderr so repeated fetches can be spotted.
+
+import sys
+import time
+import BaseHTTPServer
+import SocketServer
+
+PORT = 8080
+PAGES = 10000
+LINKS_PER_PAGE = 20
+DELAY_MS = 10
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+class WikiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    pages = PAGES
+    links_per_page = LINKS_PER_PAGE
+    delay = DELAY_MS / 1000.0
+
+    def page(self, number):
+        parts = ['<html><head><title>Page %d</title></head><body>' % number,
+                 '<a href="/wiki/Special:Random">Random</a>']
+        for k in range(self.links_per_page):
+            target = (number * 7919 + (k + 1) * 104729) % self.pages
+            parts.append('<p>%s</p><a href="/wiki/Page_%d" title="Page %d">Page %d</a>' %
+                         ('filler ' * (37 * k % 300), target, target, target))
+            parts.append('<a href="/wiki/File:Image_%d.png">image</a>' % target)
+        parts.append('</body></html>')
+        return ''.join(parts)
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        number = None
+        if self.path == '/wiki/Main_Page':
+            number = 0
+        elif self.path.startswith('/wiki/Page_'):
+            try:
+                number = int(self.path[len('/wiki/Page_'):])
+            except ValueError:
+                pass
+        if number is None or not 0 <= number < self.pages:
+            self.send_error(404)
+            return
+        body = self.page(number)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        sys.stderr.write('%s\n' % self.path)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 5:
+        print 'Usage: ./localWiki.py [port [pages [links_per_page [delay_ms]]]]'
+        exit(1)
+    args = [int(arg) for arg in sys.argv[1:]]
+    port = args[0] if len(args) > 0 else PORT
+    if len(args) > 1:
+        WikiHandler.pages = args[1]
+    if len(args) > 2:
+        WikiHandler.links_per_page = args[2]
+    if len(args) > 3:
+        WikiHandler.delay = args[3] / 1000.0
+    server = ThreadedHTTPServer(('127.0.0.1', port), WikiHandler)
+    print 'Serving on port %d' % port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,78 +1,284 @@
 #! /usr/bin/python
 
+# Replays the URLs in a site list through the proxy at HOST.
+#
+# Usage: ./runAccessPattern.py [-c concurrency] [-r requests_per_second]
+#                              [-p proxy_host:port] [-s seed] [-o log_file] url_file
+#
+# A site list is made of sections, each a --S or --R line followed by lines
+# of "times url" (times defaults to 1). A --S section requests each url
+# times times in the order listed, a --R section requests the same pool of
+# urls shuffled. Sections run one after the other. The list is streamed
+# through workload.py, so a --S section of any length takes no memory and a
+# --R section takes memory for its distinct entries only.
+#
+# Requests are sent by concurrency worker threads (1 by default, which
+# replays the list serially), each over one keep-alive connection to the
+# proxy, and are started in list order, at most requests_per_second a
+# second if given. localProxy.py stands in for squid and the origin servers
+# to try this out offline.
+#
+# Each request is timed: connecting (for requests that open a connection),
+# until the response headers arrive, and until the whole body is read. At
+# the end a summary gives the throughput, bytes transferred, the hit ratio
+# from squid's X-Cache headers and percentiles of each time. With -o every
+# request is also logged as a row of LOG_COLUMNS to a CSV file.
+
 import sys
-import urllib2
+import csv
+import getopt
+import math
+import httplib
+import socket
+import time
+import urlparse
 import random
+from Queue import Queue
+from threading import Lock, Thread
 
-import re
+from workload import siteListSections, sectionOrder
 
 HOST = '192.168.1.13:3128'
-TYPE = 'http'
 user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.19'\
     ' (KHTML, like Gecko) Chrome/18.0.1025.142 Safari/535.19'
 headers = { 'User-Agent' : user_agent }
 
-SEQUENTIAL = '--S'
-RANDOM = '--R'
-
-def streamifyFile(file):
-    l = file.readline()
-    yield l.strip()
-    data = []
-    for line in file:
-        if line == SEQUENTIAL or line == RANDOM:
-            yield data
-            data = []
-            yield line.strip()
-        else:
-            data.append(line.strip())
-    yield data
-
-def getAccessTypeAndURLsFromFile(file):
-    def timesURLPair(l):
-        url_regex = '(\S+)\s*$'
-        patn = '(\d+)\s+' + url_regex
-        m = re.match(patn, l)
-        if m:
-            return (int(m.group(1)), m.group(2))
-        else:
-            m = re.match(url_regex, l)
-            if not m:
-                print 'Error: malformed line "%s"' % l
-                exit(1)
-            return (1, m.group(1))
-    s = streamifyFile(file)
-    for accessType in s:
-        data = s.next()
-        data = map(timesURLPair, data)
-        yield(accessType, data)
-    
-def openURL(url):
-    print 'Accessing: %s' % url
-    req = urllib2.Request(url, None, headers)
-    req.set_proxy(HOST, TYPE)
-    handle = urllib2.urlopen(req)
-    return handle
+TIMEOUT = 30
+
+PERCENTILES = (50, 90, 99, 99.9)
+LOG_COLUMNS = ('start', 'section', 'url', 'status', 'cache', 'bytes', 'reused',
+               'connect_ms', 'first_byte_ms', 'total_ms', 'error')
+
+class ProxyConnection(object):
+    # A keep-alive connection to the proxy, reopened whenever the proxy
+    # closes it
+
+    def __init__(self, host):
+        self.host = host
+        self.conn = None
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def get(self, url):
+        # Returns the response, its body, and the seconds taken to connect
+        # (None on a reused connection), to the end of the response headers
+        # and to the end of the body. A request on a reused connection is
+        # retried once on a fresh one, since the proxy may have dropped it
+        # while idle.
+        reused = self.conn is not None
+        start = time.time()
+        connect = None
+        try:
+            if not reused:
+                self.conn = httplib.HTTPConnection(self.host, timeout=TIMEOUT)
+                self.conn.connect()
+                connect = time.time() - start
+            request_headers = dict(headers)
+            request_headers['Host'] = urlparse.urlsplit(url).netloc
+            self.conn.request('GET', url, None, request_headers)
+            response = self.conn.getresponse()
+            first_byte = time.time() - start
+            body = response.read()
+            total = time.time() - start
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            if reused:
+                return self.get(url)
+            raise
+        if response.will_close:
+            self.close()
+        return response, body, connect, first_byte, total
+
+class LatencyHistogram(object):
+    # Counts of times in microseconds, bucketed as in HDR histograms: each
+    # power of two is split into linear sub-buckets, so every time is known
+    # to within 1 part in 2**(SUB_BUCKET_BITS - 1) at any scale, in space
+    # logarithmic in the largest time
+
+    SUB_BUCKET_BITS = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        shift = max(value.bit_length() - self.SUB_BUCKET_BITS, 0)
+        key = (shift, value >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        # The highest time in the bucket holding the p-th percentile, in
+        # seconds, or None if nothing has been recorded
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(p / 100.0 * self.count)), 1)
+        seen = 0
+        for shift, sub_bucket in sorted(self.counts):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= rank:
+                return min(((sub_bucket + 1) << shift) - 1, self.max) / 1e6
+
+class ReplayStats(object):
+    # Totals, latency histograms and the optional CSV log of a replay run,
+    # shared by the worker threads
+
+    def __init__(self, log=None):
+        self.lock = Lock()
+        self.start = time.time()
+        self.end = None
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.cache = {}
+        self.connect = LatencyHistogram()
+        self.first_byte = LatencyHistogram()
+        self.total = LatencyHistogram()
+        self.log = log and csv.writer(log, lineterminator='\n')
+        if self.log:
+            self.log.writerow(LOG_COLUMNS)
+
+    def record(self, start, section, url, response=None, body='', connect=None,
+               first_byte=None, total=None, error=None):
+        cache = ''
+        if response is not None:
+            cache = (response.getheader('X-Cache') or '').split(' ')[0].upper()
+        with self.lock:
+            self.requests += 1
+            if error is not None:
+                self.errors += 1
+            else:
+                self.bytes += len(body)
+                if cache:
+                    self.cache[cache] = self.cache.get(cache, 0) + 1
+                if connect is not None:
+                    self.connect.record(connect)
+                self.first_byte.record(first_byte)
+                self.total.record(total)
+            if self.log:
+                milliseconds = lambda t: '' if t is None else '%.3f' % (t * 1000)
+                self.log.writerow(('%.6f' % (start - self.start), section, url,
+                                   '' if response is None else response.status, cache,
+                                   len(body), int(response is not None and connect is None),
+                                   milliseconds(connect), milliseconds(first_byte),
+                                   milliseconds(total), error or ''))
+
+    def summary(self):
+        elapsed = (self.end or time.time()) - self.start
+        lines = ['requests: %d (%d failed) in %.1fs, %.1f/s' %
+                 (self.requests, self.errors, elapsed, self.requests / elapsed),
+                 'bytes: %d, %.2fMB/s' % (self.bytes, self.bytes / elapsed / 2**20)]
+        hits = self.cache.get('HIT', 0)
+        looked_up = hits + self.cache.get('MISS', 0)
+        if looked_up:
+            lines.append('cache: %d hits, %d misses, hit ratio %.1f%%' %
+                         (hits, looked_up - hits, 100.0 * hits / looked_up))
+        lines.append('%-12s%10s' % ('time (ms)', 'count') +
+                     ''.join('%10s' % ('p%g' % p) for p in PERCENTILES) + '%10s' % 'max')
+        for name, histogram in (('connect', self.connect), ('first byte', self.first_byte),
+                                ('total', self.total)):
+            if histogram.count:
+                lines.append('%-12s%10d' % (name, histogram.count) +
+                             ''.join('%10.2f' % (histogram.percentile(p) * 1000)
+                                     for p in PERCENTILES + (100,)))
+        return '\n'.join(lines)
+
+class Replayer(object):
+    # Replays lists of urls on a pool of worker threads
+
+    def __init__(self, host=HOST, concurrency=1, rate=None, stats=None):
+        self.host = host
+        self.rate = rate
+        self.stats = stats or ReplayStats()
+        self.queue = Queue(concurrency)
+        self.lock = Lock()
+        self.threads = []
+        for i in range(concurrency):
+            t = Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        conn = ProxyConnection(self.host)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                conn.close()
+                self.queue.task_done()
+                return
+            section, url = item
+            start = time.time()
+            try:
+                self.stats.record(start, section, url, *self.fetch(conn, url))
+            except Exception, e:
+                with self.lock:
+                    print 'Error: %s: %s' % (url, e)
+                self.stats.record(start, section, url, total=time.time() - start,
+                                  error=str(e) or e.__class__.__name__)
+            finally:
+                self.queue.task_done()
+
+    def fetch(self, conn, url):
+        with self.lock:
+            print 'Accessing: %s' % url
+        return conn.get(url)
+
+    def replay(self, urls, section=0):
+        # Hand the urls to the workers in order, pacing them to the target
+        # rate, and wait for them all to finish
+        start = time.time()
+        for i, url in enumerate(urls):
+            if self.rate:
+                delay = start + i / self.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            self.queue.put((section, url))
+        self.queue.join()
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.stats.end = time.time()
+
+def usage():
+    print 'Usage: ./runAccessPattern.py [-c concurrency] [-r requests_per_second]'
+    print '                             [-p proxy_host:port] [-s seed] [-o log_file] url_file'
+    exit(1)
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print 'Expecting a file name with URLs as an argument'
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'c:r:p:s:o:')
+    except getopt.GetoptError:
+        usage()
+    if len(args) != 1:
+        usage()
+    opts = dict(opts)
+    rng = random.Random(int(opts['-s']) if '-s' in opts else None)
+    log = open(opts['-o'], 'w') if '-o' in opts else None
+    replayer = Replayer(opts.get('-p', HOST), int(opts.get('-c', 1)),
+                        float(opts['-r']) if '-r' in opts else None, ReplayStats(log))
+    f = open(args[0], 'r')
+
+    try:
+        for section, (accessType, entries) in enumerate(siteListSections(f)):
+            replayer.replay(sectionOrder(accessType, entries, rng), section)
+    except ValueError, e:
+        print 'Error: %s' % e
         exit(1)
-    f = open(sys.argv[1], 'r')
-    
-    for accessType, data in getAccessTypeAndURLsFromFile(f):
-        if accessType == SEQUENTIAL:
-            for times, url in data:
-                for x in range(times):
-                    handle = openURL(url)
-#                    print handle.read()
-        elif accessType == RANDOM:
-            URLPool = []
-            for times, url in data:
-                URLPool += times * [url]
-            random.shuffle(URLPool)
-            for url in URLPool:
-                handle = openURL(url)
-#                print handle.read()
 
     f.close()
+    replayer.close()
+    if log:
+        log.close()
+    print replayer.stats.summary()
+    if replayer.stats.errors:
+        exit(1)
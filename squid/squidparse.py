@@ -1,26 +1,254 @@
 #!/usr/bin/env python
-import re
+"""
+Pulls the dispatch (D) events, when requests are issued to the disk, out of
+blkparse output, optionally only those of one process (squid's).
+
+By default each event is written as a CSV line of pid, timestamp, RWBS and
+first sector. With -o the events are instead stored as columns (see
+COLUMNS) in a NumPy .npz file, and with -a aggregates are printed instead:
+each process's dispatches per bucket of bucket_sectors sectors (2**21, or
+1GiB, by default), the distribution of seek distances from the end of one
+request to the start of the next on the same device, in power of two
+buckets, and the dispatches and megabytes per window of window_seconds (1
+by default).
+
+Input is read in CHUNK_SIZE pieces and split on whitespace without regexes,
+and lines that cannot be dispatches are passed over without being split.
+
+Usage: ./squidparse.py [-o columns.npz] [-a] [-b bucket_sectors] [-w window_seconds]
+                       [squid_pid] < blkparse_output
+"""
+import getopt
 import sys
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CHUNK_SIZE = 1 << 22
+
+SECTOR_SIZE = 512
+BUCKET_SECTORS = 2**21
+
+# Bits of the flags column, from the RWBS field
+RWBS_FLAGS = {"R": 1, "W": 2, "D": 4, "S": 8, "M": 16, "F": 32, "A": 64, "N": 128}
+
+# Column name and array typecode of the events stored by -o
+COLUMNS = (("dev", "L"), ("pid", "l"), ("ts", "d"), ("flags", "B"),
+           ("sector", "l"), ("sectors", "l"))
 
 def parse_line(line):
-    line = re.sub("\s+", " ", line.strip())
-    dev, cpu_id, seq_no, ts, pid, action, rwbs, stuff = line.split(" ", 7)
-    return (pid, ts, action, rwbs, stuff)
+    dev, cpu_id, seq_no, ts, pid, action, rwbs, stuff = line.split(None, 7)
+    return (pid, ts, action, rwbs, stuff.strip())
+
+def read_lines(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of the complete lines in each chunk_size read from f.
+    """
+    tail = ""
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        yield lines
+    if tail:
+        yield [tail]
+
+def dispatch_batches(f, pid=None):
+    """
+    Yield lists of the whitespace separated fields (up to the sector count)
+    of the dispatch events in each chunk of blkparse output, of process pid
+    if given.
+    """
+    for lines in read_lines(f):
+        batch = []
+        for line in lines:
+            # The action is a field of its own, so this rules out most lines
+            # before splitting them
+            if " D " not in line and "\t" not in line:
+                continue
+            fields = line.split(None, 10)
+            if len(fields) < 8 or fields[5] != "D":
+                continue
+            if pid is not None and fields[4] != pid:
+                continue
+            batch.append(fields)
+        yield batch
+
+def rwbs_flags(rwbs):
+    flags = 0
+    for c in rwbs:
+        flags |= RWBS_FLAGS.get(c, 0)
+    return flags
+
+def device_number(dev):
+    major, minor = dev.split(",")
+    return (int(major) << 20) | int(minor)
+
+def batch_columns(batch):
+    """
+    The values of the COLUMNS of a batch of dispatch events, as lists.
+    Events without a sector, like flushes, get sector -1.
+    """
+    devs = {}
+    flags = {}
+    for fields in batch:
+        if fields[0] not in devs:
+            devs[fields[0]] = device_number(fields[0])
+        if fields[6] not in flags:
+            flags[fields[6]] = rwbs_flags(fields[6])
+    return ([devs[fields[0]] for fields in batch],
+            [int(fields[4]) for fields in batch],
+            [float(fields[3]) for fields in batch],
+            [flags[fields[6]] for fields in batch],
+            [int(fields[7]) if fields[7].isdigit() else -1 for fields in batch],
+            [int(fields[9]) if len(fields) > 9 and fields[8] == "+" else 0 for fields in batch])
+
+def seek_bucket(distance):
+    """
+    The power of two bucket of a seek distance in sectors: 0 for none,
+    otherwise +-k for distances of 2**(k-1) up to 2**k - 1 either way.
+    """
+    if distance < 0:
+        return -(-distance).bit_length()
+    return distance.bit_length()
+
+def bucket_range(bucket):
+    if bucket == 0:
+        return (0, 0)
+    low, high = 1 << (abs(bucket) - 1), (1 << abs(bucket)) - 1
+    if bucket < 0:
+        return (-high, -low)
+    return (low, high)
+
+class DiskStats(object):
+    """
+    Aggregates of dispatch events, added one at a time or in batches of
+    columns.
+    """
+    def __init__(self, bucket_sectors=BUCKET_SECTORS, window=1.0):
+        self.bucket_sectors = bucket_sectors
+        self.window = window
+        self.pid_buckets = defaultdict(int)
+        self.seeks = defaultdict(int)
+        self.windows = defaultdict(lambda: [0, 0])
+        # Sector after the last request dispatched to each device
+        self.heads = {}
+
+    def add_columns(self, dev, pid, ts, flags, sector, sectors):
+        """
+        Add a batch of events, given as NumPy arrays of the COLUMNS.
+        """
+        windows, window_index, counts = numpy.unique((ts / self.window).astype(numpy.int64),
+                                                     return_inverse=True, return_counts=True)
+        window_sectors = numpy.bincount(window_index, weights=sectors, minlength=len(windows))
+        for window, count, total in zip(windows.tolist(), counts.tolist(), window_sectors.tolist()):
+            self.windows[window][0] += count
+            self.windows[window][1] += int(total)
+
+        has_sector = sector >= 0
+        if not has_sector.any():
+            return
+        dev, pid, sector, sectors = dev[has_sector], pid[has_sector], sector[has_sector], sectors[has_sector]
+        keys, counts = numpy.unique(numpy.stack((pid, sector // self.bucket_sectors), axis=1),
+                                    axis=0, return_counts=True)
+        for (key_pid, bucket), count in zip(keys.tolist(), counts.tolist()):
+            self.pid_buckets[(key_pid, bucket)] += count
+
+        for device in numpy.unique(dev).tolist():
+            on_device = dev == device
+            starts = sector[on_device]
+            ends = starts + sectors[on_device]
+            distances = starts[1:] - ends[:-1]
+            if device in self.heads:
+                distances = numpy.concatenate(([starts[0] - self.heads[device]], distances))
+            # The exponent frexp finds is the bit length of the distance
+            buckets = numpy.frexp(numpy.abs(distances))[1] * numpy.sign(distances)
+            for bucket, count in zip(*[x.tolist() for x in numpy.unique(buckets, return_counts=True)]):
+                self.seeks[bucket] += count
+            self.heads[device] = int(ends[-1])
+
+    def add(self, dev, pid, ts, flags, sector, sectors):
+        window = self.windows[int(ts / self.window)]
+        window[0] += 1
+        window[1] += sectors
+        if sector < 0:
+            return
+        self.pid_buckets[(pid, sector / self.bucket_sectors)] += 1
+        if dev in self.heads:
+            self.seeks[seek_bucket(sector - self.heads[dev])] += 1
+        self.heads[dev] = sector + sectors
+
+    def write(self, f):
+        f.write("pid,first_sector,dispatches\n")
+        for (pid, bucket), count in sorted(self.pid_buckets.iteritems()):
+            f.write("%d,%d,%d\n" % (pid, bucket * self.bucket_sectors, count))
+        f.write("\nmin_seek_sectors,max_seek_sectors,dispatches\n")
+        for bucket, count in sorted(self.seeks.iteritems()):
+            f.write("%d,%d,%d\n" % (bucket_range(bucket) + (count,)))
+        f.write("\nwindow_start,iops,mb_per_s\n")
+        if self.windows:
+            for i in xrange(min(self.windows), max(self.windows) + 1):
+                count, sectors = self.windows.get(i, (0, 0))
+                f.write("%g,%g,%g\n" % (i * self.window, count / self.window,
+                                        sectors * SECTOR_SIZE / self.window / 2**20))
+
+def usage():
+    print "Usage: ./squidparse.py [-o columns.npz] [-a] [-b bucket_sectors] [-w window_seconds]"
+    print "                       [squid_pid] < blkparse_output"
+    sys.exit(1)
 
 if __name__ == "__main__":
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:ab:w:")
+    except getopt.GetoptError:
+        usage()
+    if len(args) > 1:
+        usage()
+    opts = dict(opts)
     squid_pid = None
-    if len(sys.argv) > 1:
+    if args:
         try:
-            int(sys.argv[1])
-            squid_pid = str(int(sys.argv[1]))
+            int(args[0])
+            squid_pid = str(int(args[0]))
         except ValueError:
             sys.stderr.write("Unable to interpret squid pid - defaulting to no pid filtering\n")
-    for line in sys.stdin:
-        try:
-            pid, ts, action, rwbs, output = parse_line(line)
-        except ValueError:
+    if "-o" in opts and numpy is None:
+        sys.stderr.write("Columnar output needs NumPy\n")
+        sys.exit(1)
+
+    batches = dispatch_batches(sys.stdin, squid_pid)
+    if "-o" not in opts and "-a" not in opts:
+        write = sys.stdout.write
+        for batch in batches:
+            write("".join(",".join((fields[4], fields[3], fields[6], fields[7])) + "\n"
+                          for fields in batch))
+        sys.exit(0)
+
+    columns = [array(typecode) for (name, typecode) in COLUMNS]
+    stats = DiskStats(int(opts.get("-b", BUCKET_SECTORS)), float(opts.get("-w", 1.0)))
+    for batch in batches:
+        if not batch:
             continue
-        if squid_pid is None or pid == squid_pid:
-            if action == "D":
-                sector = output.split(" ")[0]
-                sys.stdout.write(",".join((pid,ts,rwbs,sector))+"\n")
+        values = batch_columns(batch)
+        batch_arrays = [array(typecode, column) for ((name, typecode), column) in zip(COLUMNS, values)]
+        if "-o" in opts:
+            for column, batch_array in zip(columns, batch_arrays):
+                column.extend(batch_array)
+        if "-a" in opts and numpy is not None:
+            stats.add_columns(*[numpy.frombuffer(batch_array, dtype=typecode) for
+                                ((name, typecode), batch_array) in zip(COLUMNS, batch_arrays)])
+        elif "-a" in opts:
+            for event in zip(*values):
+                stats.add(*event)
+
+    if "-o" in opts:
+        numpy.savez(opts["-o"], **dict((name, numpy.frombuffer(column, dtype=typecode))
+                                       for ((name, typecode), column) in zip(COLUMNS, columns)))
+    if "-a" in opts:
+        stats.write(sys.stdout)
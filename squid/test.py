@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+import sys
+from cStringIO import StringIO
+import csv
+import os
+import random
+import tempfile
+import unittest
+from threading import Thread
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import getWikiLinks
+import localProxy
+import localWiki
+import squidparse
+from runAccessPattern import Replayer, ReplayStats
+from workload import siteListSections, sectionOrder
+
+def serve(server):
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return '%s:%d' % server.server_address
+
+SITE_LIST = '''--S
+2 http://a.example.com/1
+http://a.example.com/2
+http://b.example.com/1
+--R
+3 http://a.example.com/1
+2 http://c.example.com/1
+'''
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        localProxy.ProxyHandler.cache = set()
+        localProxy.ProxyHandler.miss_delay = 0
+        localProxy.ProxyHandler.body_bytes = 100
+        self.server = localProxy.ThreadedHTTPServer(('127.0.0.1', 0), localProxy.ProxyHandler)
+        self.host = serve(self.server)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def replay(self, site_list, seed, concurrency=1):
+        log = StringIO()
+        replayer = Replayer(self.host, concurrency, stats=ReplayStats(log))
+        rng = random.Random(seed)
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            for section, (accessType, entries) in enumerate(siteListSections(StringIO(site_list))):
+                replayer.replay(sectionOrder(accessType, entries, rng), section)
+            replayer.close()
+        finally:
+            sys.stdout = old_stdout
+        return replayer.stats, list(csv.DictReader(StringIO(log.getvalue())))
+
+    def test_replay_order(self):
+        stats, rows = self.replay(SITE_LIST, 1)
+        self.assertEquals(stats.requests, 9)
+        self.assertEquals(stats.errors, 0)
+        self.assertEquals(stats.bytes, 900)
+        self.assertEquals(stats.cache, {'HIT': 5, 'MISS': 4})
+
+        rng = random.Random(1)
+        expected = []
+        for section, (accessType, entries) in enumerate(siteListSections(StringIO(SITE_LIST))):
+            expected.extend((str(section), url) for url in sectionOrder(accessType, entries, rng))
+        self.assertEquals([(row['section'], row['url']) for row in rows], expected)
+        self.assertEquals(expected[:4], [('0', 'http://a.example.com/1')] * 2 +
+                          [('0', 'http://a.example.com/2'), ('0', 'http://b.example.com/1')])
+        self.assertEquals(sorted(url for (section, url) in expected[4:]),
+                          ['http://a.example.com/1'] * 3 + ['http://c.example.com/1'] * 2)
+
+        # Only the first request for each url misses
+        seen = set()
+        for row in rows:
+            self.assertEquals(row['cache'], 'HIT' if row['url'] in seen else 'MISS')
+            self.assertEquals(row['status'], '200')
+            seen.add(row['url'])
+        # One worker keeps its connection open for the whole run
+        self.assertEquals([row['reused'] for row in rows], ['0'] + ['1'] * 8)
+
+    def test_concurrent_replay(self):
+        site_list = '--S\n' + ''.join('2 http://example.com/%d\n' % i for i in range(20))
+        stats, rows = self.replay(site_list, None, concurrency=4)
+        self.assertEquals(stats.requests, 40)
+        self.assertEquals(stats.errors, 0)
+        # The proxy decides hits under a lock, so each url misses once
+        # however the requests for it interleave
+        self.assertEquals(stats.cache, {'HIT': 20, 'MISS': 20})
+        self.assertEquals(sorted(row['url'] for row in rows),
+                          sorted('http://example.com/%d' % i for i in range(20) for j in range(2)))
+
+class QuietWikiHandler(localWiki.WikiHandler):
+    pages = 60
+    links_per_page = 3
+    delay = 0
+    fetched = []
+
+    def log_message(self, format, *args):
+        self.fetched.append(self.path)
+
+def wikiSites(handler):
+    # The sites a crawl from /wiki/Main_Page should find, by following the
+    # links localWiki makes
+    found = set(['/wiki/Main_Page'])
+    pending = [0]
+    seen = set()
+    while pending:
+        number = pending.pop()
+        for k in range(handler.links_per_page):
+            target = (number * 7919 + (k + 1) * 104729) % handler.pages
+            found.add('/wiki/Page_%d' % target)
+            if target not in seen:
+                seen.add(target)
+                pending.append(target)
+    return found
+
+class TestCrawl(unittest.TestCase):
+
+    def setUp(self):
+        QuietWikiHandler.fetched = []
+        self.server = localWiki.ThreadedHTTPServer(('127.0.0.1', 0), QuietWikiHandler)
+        self.base = 'http://' + serve(self.server)
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.filename)
+
+    def crawl(self, max_sites):
+        state = getWikiLinks.CrawlState(self.filename)
+        getWikiLinks.Crawler(state, self.base, max_sites, workers=3, host_delay=0).crawl()
+        sites = list(state.sites())
+        counts = [state.count(s) for s in (getWikiLinks.QUEUED, getWikiLinks.FETCHING,
+                                            getWikiLinks.DONE, getWikiLinks.FAILED)]
+        state.db.close()
+        return sites, counts
+
+    def test_crawl(self):
+        expected = wikiSites(QuietWikiHandler)
+        sites, counts = self.crawl(1000)
+        self.assertEquals(len(sites), len(expected))
+        self.assertEquals(set(sites), expected)
+        self.assertEquals(counts, [0, 0, len(expected), 0])
+        self.assertEquals(sorted(QuietWikiHandler.fetched), sorted(expected))
+
+    def test_resume(self):
+        expected = wikiSites(QuietWikiHandler)
+        sites, counts = self.crawl(5)
+        self.assertEquals(len(sites), 5)
+        self.assertEquals(sites[0], '/wiki/Main_Page')
+        self.assertEquals(counts[1], 0)
+        self.assertEquals(counts[0] + counts[2], 5)
+        self.assertTrue(counts[0])
+
+        # A crawl killed while fetching the seed leaves it marked in the
+        # database, to be fetched again
+        db = getWikiLinks.CrawlState(self.filename).db
+        db.execute('UPDATE sites SET state = ? WHERE site = ?',
+                   (getWikiLinks.FETCHING, sites[0]))
+        db.commit()
+        db.close()
+        state = getWikiLinks.CrawlState(self.filename)
+        self.assertEquals(state.count(getWikiLinks.FETCHING), 0)
+        self.assertEquals(state.count(getWikiLinks.QUEUED), counts[0] + 1)
+        state.db.close()
+
+        resumed, counts = self.crawl(1000)
+        self.assertEquals(resumed[:5], sites)
+        self.assertEquals(set(resumed), expected)
+        self.assertEquals(counts, [0, 0, len(expected), 0])
+        # Only the interrupted site and those whose links were cut off are
+        # fetched again
+        fetched = QuietWikiHandler.fetched
+        self.assertEquals(set(fetched), expected)
+        refetched = set(site for site in fetched if fetched.count(site) > 1)
+        self.assertTrue(sites[0] in refetched)
+        self.assertTrue(refetched <= set(sites))
+
+def blkparseOutput(rng, events):
+    # Dispatches and other actions of two processes on two devices, in the
+    # layout blkparse prints, with seeks of every size including none
+    lines = []
+    ts = 0.0
+    heads = {'8,0': 0, '8,16': 0}
+    for i in range(events):
+        dev = rng.choice(sorted(heads))
+        pid = rng.choice(('1234', '5678'))
+        ts += rng.random() * 0.3
+        sectors = rng.choice((8, 16, 256))
+        seek = rng.choice((0, 0, 1, -1, 4096, -4096, 2**rng.randrange(40), -2**rng.randrange(40)))
+        sector = max(heads[dev] + seek + rng.choice((0, rng.randrange(-999, 999))), 0)
+        if rng.random() < 0.05:
+            lines.append('%5s %3d %8d %14.9f %5s  D  FN [squid]' % (dev, 1, i, ts, pid))
+            continue
+        action = 'D' if rng.random() < 0.8 else rng.choice(('Q', 'C', 'I'))
+        lines.append('%5s %3d %8d %14.9f %5s  %s %3s %d + %d [squid]' %
+                     (dev, 1, i, ts, pid, action, rng.choice(('R', 'W', 'WS', 'RM')), sector, sectors))
+        if action == 'D':
+            heads[dev] = sector + sectors
+    lines.append('CPU1 (8,0):')
+    lines.append(' Reads Queued:           0,        0KiB\t Writes Queued:           0,        0KiB')
+    return '\n'.join(lines) + '\n'
+
+class TestSquidParse(unittest.TestCase):
+
+    def test_read_lines(self):
+        text = blkparseOutput(random.Random(3), 200)
+        for chunk_size in (1, 7, 100, len(text) + 1):
+            lines = [line for lines in squidparse.read_lines(StringIO(text), chunk_size)
+                     for line in lines]
+            self.assertEquals(lines, text.split('\n')[:-1])
+
+    def test_dispatch_columns(self):
+        text = '\n'.join(['8,0 1 1 0.5 42 D W 100 + 8 [squid]',
+                           '8,16 1 2 0.75 43 D FN [squid]',
+                           '8,0 1 3 1.0 42 Q W 108 + 8 [squid]', ''])
+        batch = [fields for batch in squidparse.dispatch_batches(StringIO(text)) for fields in batch]
+        self.assertEquals(squidparse.batch_columns(batch),
+                          ([8 << 20, (8 << 20) | 16], [42, 43], [0.5, 0.75],
+                           [squidparse.RWBS_FLAGS['W'],
+                            squidparse.RWBS_FLAGS['F'] | squidparse.RWBS_FLAGS['N']],
+                           [100, -1], [8, 0]))
+        self.assertEquals(len(list(squidparse.dispatch_batches(StringIO(text), '43'))[0]), 1)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_aggregates(self):
+        # Batches of columns aggregated with NumPy give the same results as
+        # the events added one at a time
+        for seed, batch_size, bucket_sectors, window in ((1, 7, 2**21, 1.0), (2, 1, 4096, 0.25),
+                                                          (3, 1000, 2**30, 10.0)):
+            text = blkparseOutput(random.Random(seed), 500)
+            events = [fields for batch in squidparse.dispatch_batches(StringIO(text))
+                      for fields in batch]
+            scalar = squidparse.DiskStats(bucket_sectors, window)
+            batched = squidparse.DiskStats(bucket_sectors, window)
+            for start in range(0, len(events), batch_size):
+                values = squidparse.batch_columns(events[start:start + batch_size])
+                for event in zip(*values):
+                    scalar.add(*event)
+                batched.add_columns(*[numpy.array(column, dtype=typecode) for
+                                      ((name, typecode), column) in zip(squidparse.COLUMNS, values)])
+
+            self.assertEquals(dict(batched.pid_buckets), dict(scalar.pid_buckets))
+            self.assertEquals(dict(batched.seeks), dict(scalar.seeks))
+            self.assertEquals(dict(batched.windows), dict(scalar.windows))
+            self.assertEquals(batched.heads, scalar.heads)
+            self.assertEquals(sum(scalar.seeks.values()),
+                              len([fields for fields in events if fields[7].isdigit()]) - 2)
+            scalar_output, batched_output = StringIO(), StringIO()
+            scalar.write(scalar_output)
+            batched.write(batched_output)
+            self.assertEquals(batched_output.getvalue(), scalar_output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
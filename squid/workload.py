@@ -0,0 +1,226 @@
+#! /usr/bin/python
+
+# Streaming reading and generation of the site lists runAccessPattern.py
+# replays, in memory that grows with the number of distinct urls but never
+# with the number of requests.
+#
+# Usage: ./workload.py order site_list [seed]
+#        ./workload.py zipf requests corpus_size|corpus_file [exponent [seed]]
+#
+# order prints, as a --S site list, the requests that a site list makes in
+# the order runAccessPattern.py makes them with the same seed.
+#
+# zipf prints a --S site list of requests drawn independently from a corpus
+# of urls whose popularity follows Zipf's law: the url of rank k is drawn in
+# proportion to 1 / k**exponent (exponent 1 by default). The corpus is the
+# urls of a site list or a file of urls, most popular first, or
+# corpus_size synthetic urls made from SYNTHETIC_URL.
+
+import sys
+import random
+from array import array
+
+SEQUENTIAL = '--S'
+RANDOM = '--R'
+
+SYNTHETIC_URL = 'http://www.example.com/page/%d'
+
+def parseEntry(line):
+    # A "times url" line of a site list, where times is optional
+    fields = line.split()
+    if len(fields) == 1:
+        return (1, fields[0])
+    if len(fields) == 2 and fields[0].isdigit():
+        return (int(fields[0]), fields[1])
+    raise ValueError('malformed line "%s"' % line.strip())
+
+def siteListSections(f):
+    # Yields (accessType, entries) for each section of a site list, where
+    # entries iterates over the (times, url) pairs of the section straight
+    # from the file. Any entries left unread are skipped when the next
+    # section is asked for. Blank lines are ignored.
+    lines = iter(f)
+    nextMarker = [None]
+
+    def entries():
+        nextMarker[0] = None
+        for line in lines:
+            line = line.strip()
+            if line == SEQUENTIAL or line == RANDOM:
+                nextMarker[0] = line
+                return
+            if line:
+                yield parseEntry(line)
+
+    for line in lines:
+        if line.strip():
+            nextMarker[0] = line.strip()
+            break
+    while nextMarker[0] is not None:
+        accessType = nextMarker[0]
+        if accessType != SEQUENTIAL and accessType != RANDOM:
+            raise ValueError('expected %s or %s, not "%s"' % (SEQUENTIAL, RANDOM, accessType))
+        section = entries()
+        yield accessType, section
+        for entry in section:
+            pass
+
+def sectionOrder(accessType, entries, rng=random):
+    # The urls requested by a section, in order. A --S section is streamed;
+    # a --R section is read in, once per distinct entry, and then drawn
+    # from without expanding the repetitions.
+    if accessType == SEQUENTIAL:
+        return (url for (times, url) in entries for i in xrange(times))
+    return shuffledRequests(list(entries), rng)
+
+def shuffledRequests(entries, rng=random):
+    # Each url of the (times, url) entries times over, in an order drawn
+    # uniformly from all orders, like shuffling the expanded list
+    urls = [url for (times, url) in entries]
+    tree = WeightTree([times for (times, url) in entries])
+    while tree.total:
+        i = tree.find(rng.randrange(tree.total))
+        tree.add(i, -1)
+        yield urls[i]
+
+class WeightTree(object):
+    # A Fenwick tree of integer weights, for drawing an index in proportion
+    # to its weight and then changing the weight, each in O(log n)
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = array('l', [0]) + array('l', weights)
+        for i in xrange(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(weights)
+        self.top = 1
+        while self.top * 2 <= self.size:
+            self.top *= 2
+
+    def add(self, index, delta):
+        self.total += delta
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, value):
+        # The index at which the running total of the weights first
+        # exceeds value
+        position = 0
+        step = self.top
+        while step:
+            if position + step <= self.size and self.tree[position + step] <= value:
+                position += step
+                value -= self.tree[position]
+            step >>= 1
+        return position
+
+class AliasSampler(object):
+    # Draws indices in proportion to fixed weights in O(1) each, by Vose's
+    # alias method
+
+    def __init__(self, weights, rng=random):
+        self.rng = rng
+        self.size = len(weights)
+        total = float(sum(weights))
+        scaled = array('d', (weight * self.size / total for weight in weights))
+        self.probability = array('d', [1.0]) * self.size
+        self.alias = array('l', [0]) * self.size
+        small = [i for i in xrange(self.size) if scaled[i] < 1.0]
+        large = [i for i in xrange(self.size) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.probability[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+
+    def sample(self):
+        i = int(self.rng.random() * self.size)
+        if self.rng.random() < self.probability[i]:
+            return i
+        return self.alias[i]
+
+def zipfWeights(size, exponent=1.0):
+    return array('d', (1.0 / rank ** exponent for rank in xrange(1, size + 1)))
+
+def zipfRequests(corpus, count, exponent=1.0, rng=random):
+    # count urls drawn independently from corpus, the first of which is
+    # the most popular
+    sampler = AliasSampler(zipfWeights(len(corpus), exponent), rng)
+    for i in xrange(count):
+        yield corpus[sampler.sample()]
+
+class SyntheticCorpus(object):
+    # size made up urls, made as they are needed
+
+    def __init__(self, size, pattern=SYNTHETIC_URL):
+        self.size = size
+        self.pattern = pattern
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        return self.pattern % i
+
+def readCorpus(f):
+    # The distinct urls of a site list or a file of urls, in file order
+    urls = []
+    seen = set()
+    for line in f:
+        line = line.strip()
+        if line and line != SEQUENTIAL and line != RANDOM:
+            times, url = parseEntry(line)
+            if url not in seen:
+                seen.add(url)
+                urls.append(url)
+    return urls
+
+def writeSiteList(f, urls, accessType=SEQUENTIAL):
+    # Write urls as one section, with runs of the same url on one line
+    f.write(accessType + '\n')
+    last = None
+    times = 0
+    for url in urls:
+        if url == last:
+            times += 1
+            continue
+        if times:
+            f.write('%d %s\n' % (times, last))
+        last = url
+        times = 1
+    if times:
+        f.write('%d %s\n' % (times, last))
+
+def usage():
+    print 'Usage: ./workload.py order site_list [seed]'
+    print '       ./workload.py zipf requests corpus_size|corpus_file [exponent [seed]]'
+    exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) in (3, 4) and sys.argv[1] == 'order':
+        rng = random.Random(int(sys.argv[3]) if len(sys.argv) == 4 else None)
+        with open(sys.argv[2]) as f:
+            writeSiteList(sys.stdout, (url for (accessType, entries) in siteListSections(f)
+                                       for url in sectionOrder(accessType, entries, rng)))
+    elif 4 <= len(sys.argv) <= 6 and sys.argv[1] == 'zipf':
+        if sys.argv[3].isdigit():
+            corpus = SyntheticCorpus(int(sys.argv[3]))
+        else:
+            with open(sys.argv[3]) as f:
+                corpus = readCorpus(f)
+        exponent = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+        rng = random.Random(int(sys.argv[5]) if len(sys.argv) > 5 else None)
+        writeSiteList(sys.stdout, zipfRequests(corpus, int(sys.argv[2]), exponent, rng))
+    else:
+        usage()